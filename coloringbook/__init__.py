@@ -30,6 +30,10 @@
     PYTHONPATH, and then run `import your_module` and
     `create_app(your_module)`.
 
+    The database connection pool is configured as described in
+    coloringbook.pool. Read-only admin views can be served from a
+    replica of the database, see coloringbook.replica.
+
     Instead of importing the module, you may also pass the path to the module
     as a string.
 
@@ -48,19 +52,25 @@ from .views import site
 from .admin import create_admin
 from .mail import create_mail
 from .task_worker import celery_init_app
+from .pool import configure_pool, monitor_pool
+from .replica import REPLICA
 
 
 migrate = Migrate()
 
-def compose_db_uri():
+def compose_db_uri(host_variable="DB_HOST", port_variable="DB_PORT"):
     """
     Compose the database URI (SQLALCHEMY_DATABASE_URI)
     from environment variables.
+
+    The host and port are read from the environment variables named by
+    `host_variable` and `port_variable`, so that the URI of a replica
+    with the same credentials can be composed as well.
     """
     db_username = environ.get("DB_USER")
     db_password = environ.get("DB_PASSWORD")
-    db_host = environ.get("DB_HOST")
-    db_port = environ.get("DB_PORT")
+    db_host = environ.get(host_variable)
+    db_port = environ.get(port_variable)
     db_name = environ.get("DB_DB")
 
     if not all([db_username, db_password, db_host, db_port, db_name]):
@@ -118,8 +128,19 @@ def create_app(config, disable_admin=False, create_db=False, use_test_db=False,
         app.config["SQLALCHEMY_DATABASE_URI"] = 'sqlite://'
     else:
         app.config["SQLALCHEMY_DATABASE_URI"] = compose_db_uri()
+        if environ.get("DB_REPLICA_HOST"):
+            binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+            binds.setdefault(REPLICA, compose_db_uri(
+                "DB_REPLICA_HOST",
+                "DB_REPLICA_PORT" if environ.get("DB_REPLICA_PORT") else "DB_PORT",
+            ))
+            app.config["SQLALCHEMY_BINDS"] = binds
+        configure_pool(app.config)
 
     db.init_app(app)
+    monitor_pool(app)
+    if REPLICA in (app.config.get("SQLALCHEMY_BINDS") or {}):
+        monitor_pool(app, REPLICA)
     if create_db:
         db.create_all(app=app)
 
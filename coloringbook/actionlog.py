@@ -0,0 +1,185 @@
+# (c) 2014-2023 Research Software Lab, Centre for Digital Humanities, Utrecht University
+# Licensed under the EUPL-1.2 or later. You may obtain a copy of the license at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12.
+
+"""
+    Packed per-page action logs.
+
+    When a subject's data are stored, all actions on each page are also
+    written as a single ActionLog row, so that the timeline of a page
+    can be fetched as one row instead of sorting the Fill and Action
+    rows. The actions are encoded as compact JSON:
+
+        {"areas": [A0, A1, ...], "colors": [C0, C1, ...],
+         "events": [[DT, AI, CI], [DT, "ACTION"], ...]}
+
+    where A* and C* are the distinct area and color IDs that occur on
+    the page, DT is the time since the previous event (or since the
+    start of the page), AI and CI are positions in the area and color
+    lists for a fill, and ACTION is the name of any other action.
+
+    >>> import coloringbook.testing as t
+    >>> testapp = t.get_fixture_app()
+    >>> def stored_actions(survey, subject, page):
+    ...     fills = subject.fills.filter_by(survey=survey, page=page).all()
+    ...     actions = subject.actions.filter_by(survey=survey, page=page).all()
+    ...     return sorted(fills + actions, key=lambda action: action.time)
+    >>> def as_timeline(actions):
+    ...     return [
+    ...         (a.time, getattr(a, 'action', 'fill'),
+    ...          getattr(a, 'area_id', None), getattr(a, 'color_id', None))
+    ...         for a in actions
+    ...     ]
+    >>> with testapp.app_context():
+    ...     survey = t.generate_survey_data(subjects=2, pages=2)
+    ...     page = survey.pages[0]
+    ...     logged, unlogged = survey.subjects
+    ...     stored = stored_actions(survey, logged, page)
+    ...     db.session.add(log_actions(survey, page, logged, stored))
+    ...     db.session.commit()
+    ...     from_log = get_timeline(survey, logged, page) == as_timeline(stored)
+    ...     from_rows = get_timeline(survey, unlogged, page) == as_timeline(
+    ...         stored_actions(survey, unlogged, page))
+    >>> from_log, from_rows
+    (True, True)
+"""
+
+from collections import namedtuple
+
+from flask import json
+
+from .models import db, ActionLog, Fill, Action
+from .archive import include_archive
+
+
+TimelineEntry = namedtuple('TimelineEntry', 'time action area_id color_id')
+
+
+def encode_actions(actions):
+    """
+        Pack a list of Fill and Action objects into a JSON string.
+
+        The objects must be in chronological order. Areas and colors
+        must have IDs, i.e., they must already be in the database.
+
+        >>> import coloringbook.models as m
+        >>> red, blue = m.Color(id=3), m.Color(id=5)
+        >>> door = m.Area(id=12)
+        >>> encode_actions([
+        ...     m.Fill(area=door, color=red, time=1200),
+        ...     m.Fill(area=door, color=blue, time=1850),
+        ...     m.Action(action='resume', time=4000),
+        ... ])
+        '{"areas":[12],"colors":[3,5],"events":[[1200,0,0],[650,0,1],[2150,"resume"]]}'
+    """
+    areas, colors = [], []
+    area_index, color_index = {}, {}
+    events = []
+    previous = 0
+    for action in actions:
+        delta = action.time - previous
+        previous = action.time
+        if isinstance(action, Fill):
+            area_id = action.area_id or action.area.id
+            color_id = action.color_id or action.color.id
+            if area_id not in area_index:
+                area_index[area_id] = len(areas)
+                areas.append(area_id)
+            if color_id not in color_index:
+                color_index[color_id] = len(colors)
+                colors.append(color_id)
+            events.append([delta, area_index[area_id], color_index[color_id]])
+        else:
+            events.append([delta, action.action])
+    return json.dumps(
+        {'areas': areas, 'colors': colors, 'events': events},
+        separators=(',', ':'),
+        sort_keys=True,
+    )
+
+
+def decode_actions(packed):
+    """
+        Unpack a string from encode_actions into a list of TimelineEntry.
+
+        Fills have 'fill' as their action; other actions have no area
+        and color.
+
+        >>> for entry in decode_actions(
+        ...     '{"areas":[12],"colors":[3,5],'
+        ...     '"events":[[1200,0,0],[650,0,1],[2150,"resume"]]}'
+        ... ): print(entry)
+        TimelineEntry(time=1200, action=u'fill', area_id=12, color_id=3)
+        TimelineEntry(time=1850, action=u'fill', area_id=12, color_id=5)
+        TimelineEntry(time=4000, action=u'resume', area_id=None, color_id=None)
+    """
+    data = json.loads(packed)
+    areas, colors = data['areas'], data['colors']
+    timeline = []
+    time = 0
+    for event in data['events']:
+        time += event[0]
+        if len(event) == 3:
+            timeline.append(TimelineEntry(
+                time, u'fill', areas[event[1]], colors[event[2]],
+            ))
+        else:
+            timeline.append(TimelineEntry(time, event[1], None, None))
+    return timeline
+
+
+def log_actions(survey, page, subject, actions):
+    """ Return a new ActionLog with the packed `actions` of a page. """
+    return ActionLog(
+        survey=survey,
+        page=page,
+        subject=subject,
+        actions=encode_actions(actions),
+    )
+
+
+def get_timeline(survey, subject, page):
+    """
+        Return the actions of `subject` on `page` as a list of TimelineEntry.
+
+        Reads the ActionLog of the page if there is one. Pages stored
+        before action logs were introduced are reconstructed from the
+        Fill and Action rows instead, including archived ones.
+
+        >>> import coloringbook.testing as t
+        >>> from coloringbook.archive import archive_survey
+        >>> from coloringbook.utilities import get_survey_pages
+        >>> testapp = t.get_fixture_app()
+        >>> with testapp.app_context():
+        ...     survey = t.generate_survey_data(subjects=2, pages=2)
+        ...     subject, page = survey.subjects[0], get_survey_pages(survey)[0]
+        ...     before = get_timeline(survey, subject, page)
+        ...     moved = archive_survey(survey)
+        ...     after = get_timeline(survey, subject, page)
+        >>> len(before) > 0, after == before
+        (True, True)
+    """
+    log = ActionLog.query.get((survey.id, subject.id, page.id))
+    if log is not None:
+        return decode_actions(log.actions)
+    fills = (
+        db.session.query(
+            Fill.time,
+            db.literal(u'fill'),
+            Fill.area_id,
+            Fill.color_id )
+        .filter_by(survey_id=survey.id, subject_id=subject.id, page_id=page.id)
+    )
+    actions = (
+        db.session.query(
+            Action.time,
+            Action.action,
+            db.null(),
+            db.null() )
+        .filter_by(survey_id=survey.id, subject_id=subject.id, page_id=page.id)
+    )
+    rows = include_archive(fills.union_all(actions), db.session)
+    return sorted(
+        (TimelineEntry(*row) for row in rows),
+        key=lambda entry: entry.time,
+    )
@@ -55,4 +55,6 @@ def create_admin(app):
     admin.add_view(ButtonSetView(sess))
     admin.add_view(ColorView(sess, category='Utilities'))
     admin.add_view(LanguageView(sess, category='Utilities'))
+    admin.add_view(OutboxView(sess, category='Utilities'))
+    admin.add_view(MetricsView(category='Utilities'))
     return admin
@@ -8,12 +8,28 @@
     Helper functions for various purposes.
 """
 
-import StringIO, csv, datetime as dt
+import StringIO, csv, datetime as dt, tempfile, zlib, struct, os, os.path as op
+from itertools import islice
 
-from flask import make_response, request
+import pyarrow as pa, pyarrow.parquet as pq
+from sqlalchemy import types
+from flask import (
+    make_response, request, send_file, g, abort, current_app,
+    stream_with_context,
+)
+
+from ..models import db, Subject
+from ..archive import include_archive
+from ..replica import reads_from_replica
 
 
 COPY_PREFIX = 'Copy of '
+PARQUET_CHUNK_SIZE = 50000  # rows per Parquet row group
+STREAM_CHUNK_SIZE = 1000  # rows fetched at a time for streamed downloads
+EXPORT_WATERMARK_LAG = 300  # seconds that a subject may take to be stored
+STREAM_BUFFER_SIZE = 64 * 1024  # bytes of CSV passed to the compressor at once
+ZIP64_LIMIT = 0xffffffff  # sizes and offsets from which ZIP64 fields are written
+ZIP_COUNT_LIMIT = 0xffff  # number of members from which ZIP64 fields are written
 
 def maybe_utf8(value):
     """
@@ -65,30 +81,532 @@ def csvdownload(view):
         u'text/csv'
         >>> testresponse.headers['Content-Disposition']
         u'attachment; filename="..._doctest_.csv"'
+
+        If the request has a `compression=gzip` argument, the CSV is
+        streamed with gzip compression instead (see gzip_csv_response).
+        The undecorated view remains available as the `view` attribute.
     """
 
+    @reads_from_replica
     def wrap(self=None):
-        query, headers, filename_core = view(self)
-        if self:
-            filters = filters_from_request(self)
-            for f, v in filters:
-                query = f.apply(query, v)
-        buffer = StringIO.StringIO(b'')
-        writer = csv.writer(buffer, delimiter=';')
-        writer.writerow(headers)
-        writer.writerows(convert_utf8(query.all()))
-        filename = '{}_{}_{}.csv'.format(
+        query, headers, filename_core = query_from_view(view, self)
+        filename_suffix = request.query_string if self else ''
+        compression = request.args.get('compression') if self else None
+        if compression == 'gzip':
+            response = gzip_csv_response(
+                query,
+                headers,
+                filename_core,
+                filename_suffix )
+        elif compression:
+            abort(400)
+        else:
+            response = csv_response(
+                query,
+                headers,
+                filename_core,
+                filename_suffix )
+        add_watermark_header(response, self)
+        return response
+    wrap.view = view
+    return wrap
+
+
+def csv_response(query, headers, filename_core, filename_suffix=''):
+    """
+        Render the rows of `query` as a downloadable CSV response.
+
+        This is the workhorse of csvdownload. It can also be used
+        directly, for example by list actions that produce a download.
+        Instead of a query, `query` may also be a list of rows that
+        have already been computed.
+    """
+    rows = query if isinstance(query, list) else query.all()
+    buffer = StringIO.StringIO(b'')
+    writer = csv.writer(buffer, delimiter=';')
+    writer.writerow(headers)
+    writer.writerows(convert_utf8(rows))
+    filename = '{}_{}_{}.csv'.format(
+        dt.datetime.utcnow().strftime('%y%m%d%H%M'),
+        filename_core,
+        filename_suffix )
+    response = make_response(buffer.getvalue())
+    response.headers['Cache-Control'] = 'max-age=600'
+    response.headers['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+    response.headers['Content-Type'] = 'text/csv; charset=utf-8'
+    return response
+
+
+def gzip_csv_response(query, headers, filename_core, filename_suffix=''):
+    r"""
+        Like csv_response, but stream the CSV with gzip compression.
+
+        Rows are fetched, rendered and compressed in chunks while the
+        response is being sent, so neither the CSV nor the compressed
+        file is ever held in memory as a whole.
+
+        >>> import gzip, coloringbook.testing as t, coloringbook.models as m
+        >>> testapp = t.get_fixture_app()
+        >>> with testapp.test_request_context():
+        ...     m.db.session.add(m.Color(code='#888', name='grey'))
+        ...     query = m.db.session.query(m.Color.code, m.Color.name)
+        ...     testresponse = gzip_csv_response(query, ['code', 'name'], 'doctest')
+        >>> testresponse.mimetype
+        u'application/gzip'
+        >>> testresponse.headers['Content-Disposition']
+        u'attachment; filename="..._doctest_.csv.gz"'
+        >>> compressed = StringIO.StringIO(''.join(testresponse.response))
+        >>> gzip.GzipFile(fileobj=compressed).read()
+        'code;name\r\n#888;grey\r\n'
+    """
+    lines = csv_lines(query.yield_per(STREAM_CHUNK_SIZE), headers)
+    response = current_app.response_class(
+        stream_with_context(gzip_stream(lines)),
+        mimetype='application/gzip' )
+    filename = '{}_{}_{}.csv.gz'.format(
+        dt.datetime.utcnow().strftime('%y%m%d%H%M'),
+        filename_core,
+        filename_suffix )
+    response.headers['Cache-Control'] = 'max-age=600'
+    response.headers['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+    return response
+
+
+def zipdownload(view):
+    r"""
+        View decorator that serves several CSV exports as one ZIP archive.
+
+        The view must return a list of (query, headers, filename_core)
+        triples, like the ones returned by views decorated with
+        csvdownload, and a core for the file name of the archive. Each
+        export becomes a CSV member of the archive, which is compressed
+        while it is being streamed.
+
+        >>> import zipfile, coloringbook.testing as t, coloringbook.models as m
+        >>> site = t.get_fixture_app()
+        >>> @site.route('/doctest')
+        ... @zipdownload
+        ... def simpletest (self):
+        ...     m.db.session.add(m.Color(code='#888', name='grey'))
+        ...     m.db.session.commit()
+        ...     codes = m.db.session.query(m.Color.code)
+        ...     names = m.db.session.query(m.Color.name)
+        ...     return [
+        ...         (codes, ['code'], 'codes'),
+        ...         (names, ['name'], 'names'),
+        ...     ], 'doctest'
+        >>> with site.test_request_context():
+        ...     testresponse = simpletest(0)
+        >>> testresponse.headers['Content-Disposition']
+        u'attachment; filename="..._doctest_.zip"'
+        >>> archive = zipfile.ZipFile(StringIO.StringIO(''.join(testresponse.response)))
+        >>> archive.namelist()
+        ['codes.csv', 'names.csv']
+        >>> archive.read('names.csv')
+        'name\r\ngrey\r\n'
+    """
+
+    @reads_from_replica
+    def wrap(self=None):
+        exports, filename_core = view(self)
+        members = [
+            (
+                '{}.csv'.format(core),
+                csv_lines(query.yield_per(STREAM_CHUNK_SIZE), headers),
+            )
+            for query, headers, core in exports
+        ]
+        response = current_app.response_class(
+            stream_with_context(zip_stream(members)),
+            mimetype='application/zip' )
+        filename = '{}_{}_{}.zip'.format(
             dt.datetime.utcnow().strftime('%y%m%d%H%M'),
             filename_core,
             request.query_string if self else '' )
-        response = make_response(buffer.getvalue())
         response.headers['Cache-Control'] = 'max-age=600'
         response.headers['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
-        response.headers['Content-Type'] = 'text/csv; charset=utf-8'
+        add_watermark_header(response, self)
         return response
     return wrap
 
 
+def csv_lines(rows, headers):
+    r"""
+        Render `headers` and `rows` as CSV, yielding chunks of bytes.
+
+        >>> list(csv_lines([(1, u'\xe9')], ['id', 'name']))
+        ['id;name\r\n1;\xc3\xa9\r\n']
+    """
+    buffer = StringIO.StringIO(b'')
+    writer = csv.writer(buffer, delimiter=';')
+    writer.writerow(headers)
+    for row in convert_utf8(rows):
+        writer.writerow(row)
+        if buffer.tell() >= STREAM_BUFFER_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def gzip_stream(chunks):
+    """ Compress an iterable of byte strings into a gzip stream. """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def zip_stream(members):
+    r"""
+        Generate a ZIP archive from (filename, chunks) pairs.
+
+        Unlike the zipfile module, this does not need a seekable file:
+        sizes and checksums follow the compressed data of each member in
+        a data descriptor. Members of 4 GiB or more, offsets beyond 4 GiB
+        and more than 65534 members are stored with ZIP64 fields in the
+        data descriptors and the central directory, which is followed by
+        a ZIP64 end record if needed. Since the sizes are not known in
+        advance, the local headers never announce ZIP64; readers that
+        use the central directory, like zipfile, unzip and 7-Zip, open
+        such archives, but readers that only scan the local headers
+        cannot extract members of 4 GiB or more.
+
+        >>> import zipfile
+        >>> def check(archive):
+        ...     testzip = zipfile.ZipFile(StringIO.StringIO(archive))
+        ...     print(testzip.testzip())
+        ...     return [testzip.read(name) for name in testzip.namelist()]
+        >>> check(''.join(zip_stream([
+        ...     ('a.txt', ['hello ', 'world']),
+        ...     ('b.txt', []),
+        ... ])))
+        None
+        ['hello world', '']
+
+        With lower limits, the ZIP64 fields are also written for small
+        archives.
+
+        >>> import coloringbook.admin.utilities as utilities
+        >>> limits = utilities.ZIP64_LIMIT, utilities.ZIP_COUNT_LIMIT
+        >>> utilities.ZIP64_LIMIT, utilities.ZIP_COUNT_LIMIT = 16, 2
+        >>> archive = ''.join(zip_stream([
+        ...     ('a.txt', ['hello ' * 10]),
+        ...     ('b.txt', []),
+        ...     ('c.txt', ['!']),
+        ... ]))
+        >>> utilities.ZIP64_LIMIT, utilities.ZIP_COUNT_LIMIT = limits
+        >>> b'PK\x06\x06' in archive
+        True
+        >>> check(archive)
+        None
+        ['hello hello hello hello hello hello hello hello hello hello ', '', '!']
+    """
+    now = dt.datetime.now()
+    dos_time = now.hour << 11 | now.minute << 5 | now.second // 2
+    dos_date = (now.year - 1980) << 9 | now.month << 5 | now.day
+    flags = 0x08  # sizes and checksum in a data descriptor
+    directory = []
+    offset = 0
+    for name, chunks in members:
+        header = struct.pack(
+            '<4s5H3L2H', b'PK\x03\x04', 20, flags, zlib.DEFLATED,
+            dos_time, dos_date, 0, 0, 0, len(name), 0,
+        ) + name
+        yield header
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        crc = size = compressed_size = 0
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                compressed_size += len(data)
+                yield data
+        data = compressor.flush()
+        compressed_size += len(data)
+        yield data
+        crc &= 0xffffffff
+        if max(size, compressed_size) >= ZIP64_LIMIT:
+            descriptor = struct.pack(
+                '<4sL2Q', b'PK\x07\x08', crc, compressed_size, size,
+            )
+        else:
+            descriptor = struct.pack(
+                '<4s3L', b'PK\x07\x08', crc, compressed_size, size,
+            )
+        yield descriptor
+        # Values that do not fit are replaced by 0xffffffff and stored
+        # in a ZIP64 extra field instead, in this order.
+        wide = [
+            value for value in (size, compressed_size, offset)
+            if value >= ZIP64_LIMIT
+        ]
+        extra = struct.pack(
+            '<2H{}Q'.format(len(wide)), 1, 8 * len(wide), *wide
+        ) if wide else b''
+        narrow = [
+            value if value < ZIP64_LIMIT else 0xffffffff
+            for value in (compressed_size, size, offset)
+        ]
+        version = 45 if wide else 20
+        directory.append(struct.pack(
+            '<4s6H3L5H2L', b'PK\x01\x02', version, version, flags,
+            zlib.DEFLATED, dos_time, dos_date, crc, narrow[0], narrow[1],
+            len(name), len(extra), 0, 0, 0, 0, narrow[2],
+        ) + name + extra)
+        offset += len(header) + compressed_size + len(descriptor)
+    central_directory = b''.join(directory)
+    yield central_directory
+    count, directory_size = len(directory), len(central_directory)
+    if (count >= ZIP_COUNT_LIMIT or
+            max(offset, directory_size) >= ZIP64_LIMIT):
+        yield struct.pack(
+            '<4sQ2H2L4Q', b'PK\x06\x06', 44, 45, 45, 0, 0,
+            count, count, directory_size, offset,
+        )
+        yield struct.pack(
+            '<4sLQL', b'PK\x06\x07', 0, offset + directory_size, 1,
+        )
+        count = 0xffff
+        offset = directory_size = 0xffffffff
+    yield struct.pack(
+        '<4s4H2LH', b'PK\x05\x06', 0, 0, count, count,
+        directory_size, offset, 0,
+    )
+
+
+def parquetdownload(view):
+    """
+        View decorator that serves the query as a columnar Parquet file.
+
+        Works like csvdownload, i.e., the view must return a query, a
+        list of column headers and a core for the file name. The file is
+        written to a temporary file in row groups of PARQUET_CHUNK_SIZE
+        rows, so memory use stays bounded regardless of the export size.
+
+        >>> import coloringbook.testing as t, coloringbook.models as m
+        >>> site = t.get_fixture_app()
+        >>> @site.route('/doctest')
+        ... @parquetdownload
+        ... def simpletest (self):
+        ...     m.db.session.add(m.Color(code='#888', name='grey'))
+        ...     m.db.session.commit()
+        ...     query = m.db.session.query(m.Color.code, m.Color.name)
+        ...     return query, ['code', 'name'], 'doctest'
+        >>> with site.test_request_context():
+        ...     testresponse = simpletest(0)
+        >>> testresponse.mimetype
+        u'application/octet-stream'
+        >>> testresponse.headers['Content-Disposition']
+        u'attachment; filename=..._doctest_.parquet'
+        >>> next(iter(testresponse.response))[:4]
+        'PAR1'
+    """
+
+    @reads_from_replica
+    def wrap(self=None):
+        query, headers, filename_core = query_from_view(view, self)
+        buffer = tempfile.TemporaryFile()
+        write_parquet(query, headers, buffer)
+        size = buffer.tell()
+        buffer.seek(0)
+        filename = '{}_{}_{}.parquet'.format(
+            dt.datetime.utcnow().strftime('%y%m%d%H%M'),
+            filename_core,
+            request.query_string if self else '' )
+        response = send_file(
+            buffer,
+            mimetype='application/octet-stream',
+            as_attachment=True,
+            attachment_filename=filename,
+            add_etags=False )
+        response.headers['Cache-Control'] = 'max-age=600'
+        response.headers['Content-Length'] = size
+        add_watermark_header(response, self)
+        return response
+    return wrap
+
+
+def query_from_view(view, self):
+    """
+        Call an export view and apply the filters from the request.
+
+        The resulting query also reads the fills of archived surveys.
+    """
+    query, headers, filename_core = view(self)
+    if self:
+        filters = filters_from_request(self)
+        for f, v in filters:
+            query = f.apply(query, v)
+    return include_archive(query, db.session), headers, filename_core
+
+
+def export_watermark(session):
+    """
+        Return the (since, until) subject ID range of an incremental export.
+
+        Incremental exports are requested by passing `since`, the highest
+        subject ID that the client has already seen, as a request
+        argument. Returns None if the request is not incremental.
+
+        The upper bound is determined once per request, so that all
+        queries of an export agree on it. IDs are assigned when a subject
+        is inserted, but its data only become visible when the storing
+        transaction commits, which may be after a subject with a higher
+        ID has committed. Therefore, the upper bound is the highest ID of
+        the subjects that were inserted at least EXPORT_WATERMARK_LAG
+        seconds ago. Every subject with a lower ID was inserted earlier,
+        so it is complete if storing takes less time than the lag.
+        Subjects stored more recently are part of the next increment.
+
+        >>> import coloringbook.testing as t, coloringbook.models as m
+        >>> testapp = t.get_fixture_app()
+        >>> with testapp.test_request_context('?since=0'):
+        ...     m.db.session.add_all([
+        ...         m.Subject(name='a', birth=dt.datetime(2000, 1, 1),
+        ...                   created=dt.datetime(2020, 1, 1)),
+        ...         m.Subject(name='b', birth=dt.datetime(2000, 1, 1)),
+        ...     ])
+        ...     m.db.session.commit()
+        ...     export_watermark(m.db.session)
+        (0, 1)
+        >>> with testapp.test_request_context('?since=2'):
+        ...     export_watermark(m.db.session)
+        (2, 2)
+        >>> with testapp.test_request_context('?since=x'):
+        ...     export_watermark(m.db.session)
+        Traceback (most recent call last):
+        ...
+        BadRequest: 400: Bad Request
+        >>> with testapp.test_request_context():
+        ...     print(export_watermark(m.db.session))
+        None
+    """
+    if 'since' not in request.args:
+        return None
+    watermark = getattr(g, 'export_watermark', None)
+    if watermark is None:
+        since = request.args.get('since', type=int)
+        if since is None:
+            abort(400)
+        cutoff = dt.datetime.utcnow() - dt.timedelta(seconds=current_app.config.get(
+            'EXPORT_WATERMARK_LAG', EXPORT_WATERMARK_LAG))
+        until = session.query(Subject.id).filter(db.or_(
+            Subject.created == None,
+            Subject.created <= cutoff,
+        )).order_by(Subject.id.desc()).limit(1).scalar() or 0
+        # Never move the client back to subjects it has already seen.
+        watermark = g.export_watermark = (since, max(since, until))
+    return watermark
+
+
+def restrict_to_watermark(query, column, session):
+    """
+        Limit `query` to the subject IDs of an incremental export, if any.
+
+        `column` must be the subject ID column of the query.
+    """
+    watermark = export_watermark(session)
+    if watermark is None:
+        return query
+    since, until = watermark
+    return query.filter(column > since, column <= until)
+
+
+def add_watermark_header(response, self):
+    """ Tell the client where to continue the next incremental export. """
+    if self:
+        watermark = export_watermark(self.session)
+        if watermark is not None:
+            response.headers['X-Next-Since'] = str(watermark[1])
+
+
+def arrow_schema(query, headers):
+    """
+        Derive a pyarrow schema from the column types of a query.
+
+        Textual columns are dictionary-encoded, since survey, page, area
+        and color names are repeated on nearly every row.
+
+        >>> import coloringbook.models as m
+        >>> from sqlalchemy.orm import Query
+        >>> query = Query([m.Fill.time, m.Color.name])
+        >>> print(arrow_schema(query, ['time', 'color']))
+        time: int64
+        color: dictionary<values=string, indices=int32, ordered=0>
+    """
+    fields = []
+    for header, column in zip(headers, query.column_descriptions):
+        sqltype = column['type']
+        if isinstance(sqltype, type):
+            sqltype = sqltype()
+        if isinstance(sqltype, types.TypeDecorator):
+            sqltype = sqltype.impl  # e.g. the compact key types of Fill
+        if isinstance(sqltype, types.Boolean):
+            arrowtype = pa.bool_()
+        elif isinstance(sqltype, types.Integer):
+            arrowtype = pa.int64()
+        elif isinstance(sqltype, (types.DateTime, types.Date)):
+            arrowtype = pa.timestamp('us')
+        else:
+            arrowtype = pa.dictionary(pa.int32(), pa.string())
+        fields.append(pa.field(header, arrowtype))
+    return pa.schema(fields)
+
+
+def write_parquet(query, headers, sink, chunk_size=PARQUET_CHUNK_SIZE):
+    """
+        Write the rows of `query` to `sink` as a Parquet file.
+
+        Rows are fetched and written in chunks of `chunk_size`, each of
+        which becomes a row group. Returns the number of rows written.
+
+        >>> import coloringbook.testing as t, coloringbook.models as m
+        >>> testapp = t.get_fixture_app()
+        >>> buffer = StringIO.StringIO()
+        >>> with testapp.app_context():
+        ...     m.db.session.add_all([
+        ...         m.Color(code='#000', name='black'),
+        ...         m.Color(code='#fff', name='white'),
+        ...         m.Color(code='#f00', name='red'),
+        ...     ])
+        ...     query = m.db.session.query(m.Color.id, m.Color.name)
+        ...     write_parquet(query, ['id', 'name'], buffer, chunk_size=2)
+        3
+        >>> parquet = pq.ParquetFile(pa.BufferReader(buffer.getvalue()))
+        >>> parquet.num_row_groups
+        2
+        >>> parquet.read().column('name').to_pylist()
+        [u'black', u'white', u'red']
+    """
+    schema = arrow_schema(query, headers)
+    writer = pq.ParquetWriter(sink, schema, use_dictionary=True)
+    rows = iter(query.yield_per(chunk_size))
+    total = 0
+    try:
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            arrays = []
+            for index, field in enumerate(schema):
+                values = [row[index] for row in chunk]
+                if isinstance(field.type, pa.DictionaryType):
+                    arrays.append(
+                        pa.array(values, type=pa.string()).dictionary_encode()
+                    )
+                else:
+                    arrays.append(pa.array(values, type=field.type))
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            total += len(chunk)
+    finally:
+        writer.close()
+    return total
+
+
 def filters_from_request(self):
     """
         Parse the request arguments and return flask-admin Filter objects.
@@ -116,6 +634,51 @@ def filters_from_request(self):
     return applicables
 
 
+class StagedFile(object):
+    """
+        New contents for a file, to be moved into place later.
+
+        The contents are written to a temporary file in the same
+        directory as `path`. commit() then replaces the file at `path`
+        by an atomic rename, so readers see either the old or the new
+        file, never a partial one. discard() removes the temporary file
+        and leaves `path` untouched.
+
+        >>> directory = tempfile.mkdtemp()
+        >>> path = op.join(directory, 'example.svg')
+        >>> open(path, 'w').write('old')
+        >>> staged = StagedFile(path, u'new')
+        >>> open(path).read()
+        'old'
+        >>> staged.commit()
+        >>> open(path).read(), os.listdir(directory)
+        ('new', ['example.svg'])
+        >>> StagedFile(path, 'newer').discard()
+        >>> open(path).read(), os.listdir(directory)
+        ('new', ['example.svg'])
+    """
+
+    def __init__(self, path, contents):
+        self.path = path
+        directory, name = op.split(path)
+        descriptor, self.temporary_path = tempfile.mkstemp(
+            prefix='.{}.'.format(name),
+            dir=directory )
+        if isinstance(contents, unicode):
+            contents = contents.encode('utf-8')
+        with os.fdopen(descriptor, 'wb') as temporary:
+            temporary.write(contents)
+            temporary.flush()
+            os.fsync(temporary.fileno())
+        os.chmod(self.temporary_path, 0o644)  # mkstemp creates it private
+
+    def commit(self):
+        os.rename(self.temporary_path, self.path)
+
+    def discard(self):
+        os.remove(self.temporary_path)
+
+
 def get_copied_name(old_name, limit):
     """
     Returns the name for a duplicated page or survey, with a suffix appended to
@@ -12,23 +12,92 @@
 
 import os, os.path as op
 
-from sqlalchemy.event import listens_for
+from sqlalchemy.event import listens_for, listen, remove
 from wtforms import fields, validators
-from flask import flash, json, current_app
-from flask.ext.admin import expose, form
+from flask import flash, json, jsonify, request, current_app, g
+from flask.ext.admin import BaseView, expose, form
 from flask.ext.admin.contrib.sqla import ModelView
 import flask.ext.admin.contrib.sqla.filters as filters
 from flask.ext.admin.form import rules
 from flask.ext.admin.actions import action
 
 from ..models import *
-
-from .utilities import csvdownload, get_copied_name
+from ..utilities import get_page_scores_query
+from ..scoring import score_survey
+from ..archive import include_archive
+from ..replica import reads_from_replica, RoutingSession
+from ..reference import get_color
+from ..duplicate import (
+    duplicate_surveys, duplicate_pages,
+    duplicate_surveys_task, duplicate_pages_task, DUPLICATE_ASYNC_THRESHOLD,
+)
+from ..mail.utilities import is_broker_available
+from ..mail.outbox import retry_messages, deliver_outbox
+from ..broker import broker_health
+from ..task_metrics import task_metrics
+
+from .utilities import (
+    csvdownload,
+    csv_response,
+    parquetdownload,
+    zipdownload,
+    query_from_view,
+    export_watermark,
+    restrict_to_watermark,
+    StagedFile,
+)
 from .forms import Select2MultipleField, FileNameLength
 
 
+def in_background(ids):
+    """ Whether an action on `ids` should be left to a Celery worker. """
+    threshold = current_app.config.get(
+        'DUPLICATE_ASYNC_THRESHOLD', DUPLICATE_ASYNC_THRESHOLD)
+    return len(ids) > threshold and is_broker_available()
+
+
 class FillView(ModelView):
-    """ Custom admin table view of Fill objects. """
+    """
+        Custom admin table view of Fill objects.
+
+        When the exports are filtered by subject ID or restricted to the
+        subjects of an incremental export, the database looks the fills
+        up through the secondary indexes on Fill instead of scanning it.
+        The fills of a subject are read from ix_fill_survey_subject_page
+        alone, without visiting the table rows.
+
+        >>> import coloringbook.testing as t
+        >>> from .utilities import query_from_view
+        >>> testapp = t.get_fixture_app()
+        >>> def export_indexes(query_string):
+        ...     with testapp.test_request_context(query_string):
+        ...         view = FillView(db.session)
+        ...         return [
+        ...             'ix_fill_subject' in t.used_indexes(
+        ...                 query_from_view(export.view, view)[0]
+        ...             )
+        ...             for export in (
+        ...                 FillView.export_raw,
+        ...                 FillView.export_final,
+        ...                 FillView.export_comparison,
+        ...             )
+        ...         ]
+        >>> with testapp.app_context():
+        ...     survey = t.generate_survey_data(subjects=3, pages=2)
+        ...     subject = survey.subjects[0]
+        ...     t.used_indexes(subject.fills.filter_by(survey=survey), covering=True)
+        ...     t.used_indexes(subject.actions.filter_by(survey=survey))
+        ...     subject_filter = [
+        ...         index for index, f in enumerate(FillView(db.session)._filters)
+        ...         if f.name == 'Subject / ID'
+        ...     ][0]
+        set([u'ix_fill_survey_subject_page'])
+        set([u'ix_action_survey_subject_page'])
+        >>> export_indexes('?flt1_{}=2'.format(subject_filter))
+        [True, True, True]
+        >>> export_indexes('?since=1')
+        [True, True, True]
+    """
 
     list_template = 'admin/fill_list.html'
     can_create = False
@@ -58,23 +127,22 @@ class FillView(ModelView):
     def __init__(self, session, **kwargs):
         super(FillView, self).__init__(Fill, session, name='Data', **kwargs)
 
+    @expose('/')
+    @reads_from_replica
+    def index_view(self):
+        return super(FillView, self).index_view()
+
     @expose('/csv/raw')
     @csvdownload
     def export_raw(self):
         """ Render a CSV, similar in operation to BaseModelView.index_view. """
+        return self.get_raw_query(), self.column_list, 'filldata_raw'
 
-        query = (
-            self.session.query(
-                Survey.name,
-                Page.name,
-                Area.name,
-                Subject.id,
-                Fill.time,
-                Color.name )
-            .select_from(Fill)
-            .join(Fill.survey, Fill.page, Fill.area, Fill.subject, Fill.color)
-        )
-        return query, self.column_list, 'filldata_raw'
+    @expose('/parquet/raw')
+    @parquetdownload
+    def export_raw_parquet(self):
+        """ Render the raw export as a columnar Parquet file. """
+        return self.get_raw_query(), self.column_list, 'filldata_raw'
 
     @expose('/csv/final')
     @csvdownload
@@ -174,13 +242,52 @@ class FillView(ModelView):
                 Fill.subject,
                 Fill.color )
         )
+        if export_watermark(self.session) is not None:
+            # Uncolored expectations carry no subject, so they are not
+            # part of any increment.
+            query = query.filter(subquery.c.subject_id != None)
         headers = [ 'survey', 'page', 'area', 'subject', 'time', 'clicks',
                     'expected', 'here', 'color', 'category',
                     ]
         return query, headers, 'filldata_comparison'
 
+    @expose('/zip')
+    @zipdownload
+    def export_bundle(self):
+        """ Render all fill and subject exports as a single ZIP archive. """
+        subjects = SubjectView(self.session)
+        exports = [
+            query_from_view(export.view, self)
+            for export in (
+                FillView.export_raw,
+                FillView.export_final,
+                FillView.export_comparison,
+            )
+        ] + [
+            export.view(subjects)
+            for export in (
+                SubjectView.export_subjects,
+                SubjectView.export_languages,
+            )
+        ]
+        return exports, 'filldata'
+
+    def get_raw_query(self):
+        query = (
+            self.session.query(
+                Survey.name,
+                Page.name,
+                Area.name,
+                Subject.id,
+                Fill.time,
+                Color.name )
+            .select_from(Fill)
+            .join(Fill.survey, Fill.page, Fill.area, Fill.subject, Fill.color)
+        )
+        return restrict_to_watermark(query, Fill.subject_id, self.session)
+
     def get_core_query(self):
-        return (
+        query = (
             self.session.query(
                 Fill.survey_id.label('survey_id'),
                 Fill.page_id.label('page_id'),
@@ -193,8 +300,9 @@ class FillView(ModelView):
                 Fill.page_id,
                 Fill.area_id,
                 Fill.subject_id )
-            .subquery('sub')
         )
+        query = restrict_to_watermark(query, Fill.subject_id, self.session)
+        return query.subquery('sub')
 
 
 class SubjectView(ModelView):
@@ -217,6 +325,11 @@ class SubjectView(ModelView):
     def __init__(self, session, **kwargs):
         super(SubjectView, self).__init__(Subject, session, name='Subjects', **kwargs)
 
+    @expose('/')
+    @reads_from_replica
+    def index_view(self):
+        return super(SubjectView, self).index_view()
+
     @expose('/csv/subjects')
     @csvdownload
     def export_subjects(self):
@@ -258,6 +371,7 @@ class SubjectView(ModelView):
             .join(language_primary.language)
             .group_by(Subject.id, Survey.id)
         )
+        query = restrict_to_watermark(query, Subject.id, self.session)
         headers = (
             'id', 'name', 'numeral', 'birth', 'eyesight',
             '#lang', 'nativelang', 'survey', 'difficulty', 'topic', 'comments',
@@ -276,6 +390,11 @@ class SubjectView(ModelView):
             .select_from(SubjectLanguage)
             .join(SubjectLanguage.language)
         )
+        query = restrict_to_watermark(
+            query,
+            SubjectLanguage.subject_id,
+            self.session,
+        )
         headers = 'id language level'.split()
         return query, headers, 'subject-languagedata'
 
@@ -305,13 +424,17 @@ class SurveyView(ModelView):
     column_display_all_relations = True
     form_columns = (
         'name', 'title', 'language', 'begin', 'end', 'duration',
-        'simultaneous', 'email_address', 'information', 'page_list',
+        'simultaneous', 'email_address', 'email_digest', 'email_attachments',
+        'information', 'page_list',
         'welcome_text', 'starting_form', 'privacy_text', 'instruction_text',
         'ending_form', 'success_text', 'button_set',
     )
     form_extra_fields = {
         'page_list': Select2MultipleField('Pages', coerce=int),
     }
+    form_choices = {
+        'email_attachments': EMAIL_ATTACHMENT_FORMATS,
+    }
     form_args = {
         'email_address': {
             'validators': [validators.Email()],
@@ -324,54 +447,17 @@ class SurveyView(ModelView):
         'name': 'Used for your reference and for generating the survey URL.',
         'title': 'Shown on the first page of the survey and in the window title.',
         'email_address': 'Used to send a notification when a survey is completed and uploaded. Add multiple addresses separated by semicolons.',
+        'email_digest': 'Collect the results and send them in a single email at regular intervals, instead of one email per upload.',
+        'email_attachments': 'How the results are attached to notification emails. A single file or a ZIP archive keeps large or digest emails small.',
     }
 
     @action('duplicate', 'Duplicate')
     def duplicate_surveys(self, survey_ids):
-        successful = []
-        failed = []
-        for survey_id in survey_ids:
-            survey = Survey.query.get(survey_id)
-
-            new_survey_name = get_copied_name(
-                old_name=survey.name,
-                limit=SURVEY_NAME_CHAR_LIMIT
-            )
-            existing = Survey.query.filter_by(name=new_survey_name).first()
-            if existing:
-                failed.append(new_survey_name)
-                continue
-
-            new_survey = Survey(
-                name=new_survey_name,
-                language_id=survey.language_id,
-                begin=survey.begin,
-                end=survey.end,
-                simultaneous=survey.simultaneous,
-                information=survey.information,
-                duration=survey.duration,
-                email_address=survey.email_address,
-                instruction_text_id=survey.instruction_text_id,
-                privacy_text_id=survey.privacy_text_id,
-                success_text_id=survey.success_text_id,
-                title=survey.title,
-                welcome_text_id=survey.welcome_text_id,
-                ending_form_id=survey.ending_form_id,
-                starting_form_id=survey.starting_form_id,
-                button_set_id=survey.button_set_id,
-            )
-            db.session.add(new_survey)
-            db.session.commit()
-            for old_survey_page in survey.survey_pages:
-                new_survey_page = SurveyPage(
-                    survey_id=new_survey.id,
-                    page_id=old_survey_page.page_id,
-                    ordering=old_survey_page.ordering
-                )
-                db.session.add(new_survey_page)
-            db.session.commit()
-
-            successful.append(new_survey_name)
+        if in_background(survey_ids):
+            duplicate_surveys_task.delay(survey_ids)
+            flash('The {} selected surveys are being duplicated in the background.'.format(len(survey_ids)), 'success')
+            return
+        successful, failed = duplicate_surveys(survey_ids)
 
         if len(failed) > 0:
             flash('Could not create the following duplicated survey(s) because their names are already in use: ' + ', '.join(failed), 'error')
@@ -380,6 +466,38 @@ class SurveyView(ModelView):
             flash('Successfully created the following duplicated survey(s): ' + ', '.join(successful), 'success')
 
 
+    @action('export_scores', 'Export scores')
+    @reads_from_replica
+    def export_scores(self, survey_ids):
+        """ Download the per-page scores of all subjects of the surveys. """
+        query = include_archive(
+            get_page_scores_query(map(int, survey_ids)),
+            self.session,
+        )
+        headers = 'survey subject page correct'.split()
+        return csv_response(query, headers, 'scores')
+
+    @action('export_totals', 'Export score totals')
+    @reads_from_replica
+    def export_totals(self, survey_ids):
+        """ Download the total score of each subject of the surveys. """
+        surveys = Survey.query.filter(Survey.id.in_(map(int, survey_ids)))
+        rows = []
+        for survey in surveys.order_by(Survey.name):
+            scores = score_survey(survey)
+            for subject, total, percentage in zip(
+                    scores.subjects,
+                    scores.totals,
+                    scores.percentages ):
+                rows.append(subject + (
+                    survey.name,
+                    len(scores.pages),
+                    int(total),
+                    int(percentage),
+                ))
+        headers = 'subject name birth survey pages correct percentage'.split()
+        return csv_response(rows, headers, 'totals')
+
     def create_form(self, obj=None):
         form = super(SurveyView, self).create_form(obj)
         form.page_list.choices = db.session.query(Page.id, Page.name).order_by(Page.name).all()
@@ -447,24 +565,11 @@ class PageView(ModelView):
 
     @action('duplicate', 'Duplicate')
     def duplicate_pages(self, page_ids):
-        for page_id in page_ids:
-            page = Page.query.get(page_id)
-            new_page = Page(
-                name=get_copied_name(page.name, PAGE_NAME_CHAR_LIMIT),
-                drawing=page.drawing,
-                language=page.language,
-                text=page.text,
-                sound=page.sound,
-            )
-            for expectation in page.expectations:
-                new_page.expectations.append(Expectation(
-                    area=expectation.area,
-                    color=expectation.color,
-                    here=expectation.here,
-                ))
-            db.session.add(new_page)
-            db.session.commit()
-
+        if in_background(page_ids):
+            duplicate_pages_task.delay(page_ids)
+            flash('The {} selected pages are being duplicated in the background.'.format(len(page_ids)), 'success')
+            return
+        duplicate_pages(page_ids)
         flash('Page duplication successful.', 'success')
 
 
@@ -473,7 +578,7 @@ class PageView(ModelView):
             Expectation.query.filter_by(page=model).delete()
             new_expectations = json.loads(form.expect_list.data)
             for area_name, settings in new_expectations.iteritems():
-                color = Color.query.filter_by(code=settings['color']).one()
+                color = get_color(settings['color'])
                 area = (
                     Area.query
                     .filter_by(name=area_name, drawing=model.drawing)
@@ -542,13 +647,71 @@ class DrawingView(ModelView):
                 .all()
             )
             removed_areas = old_area_set - new_area_set
-            for area in removed_areas:
-                Area.query.filter_by(drawing=model, name=area).delete()
+            if removed_areas:
+                self.session.execute(Area.__table__.delete().where(db.and_(
+                    Area.drawing_id == model.id,
+                    Area.name.in_(removed_areas),
+                )))
             added_areas = new_area_set - old_area_set
-            for area in added_areas:
-                model.areas.append(Area(name=area))
-            current_app.open_instance_resource(model.name + '.svg', 'w').write(
-                form.svg_source.data )
+            if added_areas:
+                self.session.execute(Area.__table__.insert(), [
+                    {'drawing_id': model.id, 'name': area}
+                    for area in sorted(added_areas)
+                ])
+            self.session.expire(model, ['areas'])
+            g.staged_files.append(StagedFile(
+                op.join(current_app.instance_path, model.name + '.svg'),
+                form.svg_source.data,
+            ))
+
+    def update_model(self, form, model):
+        """
+            Update a drawing, its areas and its SVG file as one unit.
+
+            on_model_change stages the new SVG in a temporary file, which
+            only replaces the old one after the transaction has been
+            committed. If anything fails, the transaction is rolled back
+            and the staged file is discarded.
+
+            >>> import coloringbook.testing as t, tempfile
+            >>> testapp = t.get_fixture_app()
+            >>> testapp.instance_path = tempfile.mkdtemp()
+            >>> client = testapp.test_client()
+            >>> with testapp.app_context():
+            ...     drawing = Drawing(name='house')
+            ...     drawing.areas = [Area(name='door'), Area(name='roof')]
+            ...     db.session.add(drawing)
+            ...     db.session.commit()
+            ...     drawing_id = drawing.id
+            >>> open(op.join(testapp.instance_path, 'house.svg'), 'w').write('old')
+            >>> def edit(areas, svg):
+            ...     client.post(
+            ...         '/admin/drawing/edit/?id={}'.format(drawing_id),
+            ...         data={'area_list': areas, 'svg_source': svg},
+            ...     )
+            ...     with testapp.app_context():
+            ...         return (
+            ...             sorted(a.name for a in Drawing.query.get(drawing_id).areas),
+            ...             open(op.join(testapp.instance_path, 'house.svg')).read(),
+            ...             len(os.listdir(testapp.instance_path)),
+            ...         )
+            >>> edit('door,window,chimney', 'new')
+            ([u'chimney', u'door', u'window'], 'new', 1)
+            >>> def fail(session):
+            ...     raise RuntimeError('commit failed')
+            >>> listen(RoutingSession, 'before_commit', fail)
+            >>> edit('door', 'newer')
+            ([u'chimney', u'door', u'window'], 'new', 1)
+            >>> remove(RoutingSession, 'before_commit', fail)
+        """
+        g.staged_files = []
+        success = super(DrawingView, self).update_model(form, model)
+        for staged in g.staged_files:
+            if success:
+                staged.commit()
+            else:
+                staged.discard()
+        return success
 
     def on_form_prefill(self, form, id):
         form.svg_source.process_data(
@@ -734,3 +897,92 @@ class LanguageView(ModelView):
     can_delete = False  # necessary because this may cause information loss
     def __init__ (self, session, **kwargs):
         super(LanguageView, self).__init__(Language, session, name='Languages', **kwargs)
+
+
+class OutboxView(ModelView):
+    """
+        Notification emails and their delivery state.
+
+        Failed messages have given up after too many attempts. They can
+        be retried, as can pending messages that are due. Pending
+        messages that are waiting for a later attempt, or that are being
+        delivered, are skipped.
+
+        >>> import coloringbook.testing as t
+        >>> testapp = t.get_fixture_app()
+        >>> with testapp.app_context():
+        ...     message = OutboxMessage(
+        ...         recipient='a@example.com', subject='Results', html_key='x',
+        ...         attachment_keys='[]', state='failed', attempts=8)
+        ...     db.session.add(message)
+        ...     db.session.commit()
+        ...     with testapp.test_request_context():
+        ...         OutboxView(db.session).retry_messages([message.id])
+        ...     db.session.refresh(message)
+        ...     message.state, message.attempts
+        (u'pending', 0)
+    """
+    can_create = False
+    can_edit = False
+    column_list = (
+        'created', 'survey', 'recipient', 'subject', 'state', 'attempts',
+        'next_attempt', 'sent', 'last_error',
+    )
+    column_filters = ('state', 'recipient', 'created')
+    column_searchable_list = ('recipient',)
+    column_default_sort = ('created', True)
+    column_descriptions = {
+        'state': 'pending: will be sent or retried; sent: delivered; failed: gave up after too many attempts.',
+        'next_attempt': 'Time (UTC) of the next delivery attempt of a pending message.',
+    }
+
+    def __init__(self, session, **kwargs):
+        super(OutboxView, self).__init__(OutboxMessage, session, name='Mail outbox', **kwargs)
+
+    @action('retry', 'Retry', 'Send the selected messages again?')
+    def retry_messages(self, message_ids):
+        count = retry_messages(message_ids)
+        if count and is_broker_available():
+            deliver_outbox.delay(message_ids)
+        flash('{} of the {} selected messages will be sent again.'.format(
+            count, len(message_ids)), 'success')
+
+
+class MetricsView(BaseView):
+    """
+        Runtime statistics of the serving process.
+
+        Append ?format=json to the address to get the same figures as a
+        JSON object, e.g., for a monitoring system.
+
+        >>> import coloringbook.testing as t
+        >>> testapp = t.get_fixture_app()
+        >>> client = testapp.test_client()
+        >>> page = client.get('/admin/metrics/').data
+        >>> 'Connection pool' in page, 'Celery broker' in page, 'Celery tasks' in page
+        (True, True, True)
+        >>> sorted(json.loads(
+        ...     client.get('/admin/metrics/?format=json').data)['pool']['primary'])
+        ...     # doctest: +NORMALIZE_WHITESPACE
+        [u'checkedin', u'checkedout', u'checkins', u'checkouts', u'connects',
+         u'forks', u'invalidations', u'overflow', u'pid', u'pings', u'pool',
+         u'reconnects', u'size']
+    """
+
+    def __init__(self, **kwargs):
+        super(MetricsView, self).__init__(name='Metrics', endpoint='metrics', **kwargs)
+
+    @expose('/')
+    def index(self):
+        metrics = {
+            'pool': dict(
+                (name, monitor.statistics())
+                for name, monitor in current_app.extensions['pool_monitors'].items()
+            ),
+            'broker': broker_health().statistics(),
+            # Skip the task figures when Redis is down, so the page stays fast.
+            'tasks': task_metrics().summary() if broker_health().available() else [],
+        }
+        if request.args.get('format') == 'json':
+            return jsonify(metrics)
+        return self.render('admin/metrics.html', metrics=metrics)
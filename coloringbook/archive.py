@@ -0,0 +1,271 @@
+# (c) 2014-2023 Research Software Lab, Centre for Digital Humanities, Utrecht University
+# Licensed under the EUPL-1.2 or later. You may obtain a copy of the license at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12.
+
+"""
+    Archiving of the fills and actions of closed surveys.
+
+    Once a survey has ended, its fills and actions are only read by
+    exports. They are moved to the fill_archive and action_archive
+    tables, which MySQL stores compressed, so that the fill and action
+    tables and their indexes only hold the data of running surveys.
+    Exports, scores, notification emails and page timelines read from
+    both tables with include_archive.
+
+    >>> import coloringbook.testing as t
+    >>> testapp = t.get_fixture_app()
+    >>> def count_rows(model):
+    ...     return db.session.query(db.func.count()).select_from(model).scalar()
+    >>> with testapp.app_context():
+    ...     survey = t.generate_survey_data(subjects=3, pages=2)
+    ...     fills, actions = count_rows(Fill), count_rows(Action)
+    ...     query = db.session.query(Fill.subject_id, Fill.time).order_by(
+    ...         Fill.subject_id, Fill.time)
+    ...     before = query.all()
+    ...     moved = archive_survey(survey, batch_size=2)
+    ...     remaining = count_rows(Fill), count_rows(Action)
+    ...     after = include_archive(query, db.session).all()
+    >>> moved == (fills, actions)
+    True
+    >>> remaining
+    (0, 0)
+    >>> after == before
+    True
+"""
+
+import datetime as dt
+import time
+from functools import partial
+
+from celery import shared_task
+from flask import current_app, has_app_context
+from sqlalchemy.event import listens_for
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Alias
+
+from .models import (
+    db, Survey, SurveySubject, Fill, Action, FillArchive, ActionArchive,
+)
+
+
+ARCHIVE_BATCH_SIZE = 100
+ARCHIVE_AFTER_DAYS = 30
+CHECK_INTERVAL = 10  # seconds between checks of an empty archive table
+
+# Pairs of a live model and the archive model with the same columns.
+ARCHIVED_MODELS = ((Fill, FillArchive), (Action, ActionArchive))
+
+
+def move_rows(model, archive, condition):
+    """ Copy the rows of `model` that meet `condition` to `archive`, then delete them. """
+    columns = [column.name for column in model.__table__.c]
+    db.session.execute(archive.__table__.insert().from_select(
+        columns,
+        db.select([model.__table__.c[name] for name in columns]).where(condition),
+    ))
+    return db.session.execute(
+        model.__table__.delete().where(condition)
+    ).rowcount
+
+
+def archive_survey(survey, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+        Move the fills and actions of `survey` to the archive tables.
+
+        The rows are moved for `batch_size` subjects at a time, each
+        batch in a transaction of its own, so that the locks on the fill
+        and action tables are short-lived. Since all rows of a subject
+        are moved together, every subject is complete in either the live
+        or the archive tables, also if archiving is interrupted.
+        Returns the number of fills and actions that were moved.
+    """
+    subject_ids = [
+        id for (id,) in
+        db.session.query(SurveySubject.subject_id)
+        .filter(SurveySubject.survey_id == survey.id)
+        .order_by(SurveySubject.subject_id)
+    ]
+    survey_id = survey.id
+    moved = [0, 0]
+    for start in range(0, len(subject_ids), batch_size):
+        batch = subject_ids[start:start + batch_size]
+        for index, (model, archive) in enumerate(ARCHIVED_MODELS):
+            moved[index] += move_rows(model, archive, db.and_(
+                model.__table__.c.survey_id == survey_id,
+                model.__table__.c.subject_id.in_(batch),
+            ))
+        db.session.commit()
+    for (model, archive), count in zip(ARCHIVED_MODELS, moved):
+        if count:
+            mark_filled(archive)
+    return tuple(moved)
+
+
+def closed_surveys(days=ARCHIVE_AFTER_DAYS):
+    """ Query the surveys that ended more than `days` ago and still have live fills or actions. """
+    threshold = dt.datetime.utcnow() - dt.timedelta(days=days)
+    return Survey.query.filter(
+        Survey.end < threshold,
+        db.or_(Survey.fills.any(), Survey.actions.any()),
+    ).order_by(Survey.end)
+
+
+@shared_task(ignore_result=True)
+def archive_closed_surveys():
+    """ Archive every survey that is returned by closed_surveys. """
+    config = current_app.config
+    days = config.get('ARCHIVE_AFTER_DAYS', ARCHIVE_AFTER_DAYS)
+    batch_size = config.get('ARCHIVE_BATCH_SIZE', ARCHIVE_BATCH_SIZE)
+    for survey in closed_surveys(days).all():
+        fills, actions = archive_survey(survey, batch_size)
+        current_app.logger.info(
+            'Archived %d fills and %d actions of survey %s.',
+            fills, actions, survey.name,
+        )
+
+
+class ArchiveTable(object):
+    """
+        Remembers whether an archive table holds any rows.
+
+        Archive tables are only added to, so once a table has rows it
+        is not checked again. An empty table is checked at most every
+        CHECK_INTERVAL seconds, which is how rows that were archived by
+        other processes are noticed.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.filled = False
+        self.checked = None
+
+    def has_rows(self, session):
+        now = time.time()
+        if not self.filled and (
+                self.checked is None or now - self.checked > CHECK_INTERVAL):
+            self.filled = session.query(db.literal(1)).select_from(
+                self.model).first() is not None
+            self.checked = now
+        return self.filled
+
+
+def archive_tables(app=None):
+    """ Return the ArchiveTable of each archive model of `app`. """
+    app = app or current_app
+    return app.extensions.setdefault('archive_tables', dict(
+        (archive, ArchiveTable(archive)) for model, archive in ARCHIVED_MODELS
+    ))
+
+
+def mark_filled(archive):
+    """ Record that rows were added to the table of `archive`. """
+    if has_app_context():
+        archive_tables()[archive].filled = True
+
+
+@listens_for(FillArchive, 'after_insert')
+@listens_for(ActionArchive, 'after_insert')
+def mark_inserted(mapper, connection, target):
+    mark_filled(mapper.class_)
+
+
+class ArchiveAlias(Alias):
+    """
+        Alias of a statement that reads the archive tables as well.
+
+        `replacements` maps live tables to the selects that replace
+        them while the statement is compiled. See include_archive.
+    """
+
+    def __init__(self, selectable, name, replacements):
+        super(ArchiveAlias, self).__init__(selectable, name)
+        self.replacements = replacements
+
+
+@compiles(ArchiveAlias)
+def compile_archive_alias(element, compiler, **kw):
+    """
+        Render `element`, with the live tables in its replacements and
+        their aliases rendered as the replacing selects.
+
+        Only the compiler of the statement that contains `element` is
+        affected, and only while `element` is rendered.
+    """
+    visit_table, visit_alias = compiler.visit_table, compiler.visit_alias
+
+    def replace(table, name, default, **kw):
+        combined = element.replacements.get(table)
+        if combined is None or not kw.get('asfrom'):
+            return default(**kw)
+        return compiler.process(combined.alias(name), **kw)
+
+    compiler.visit_table = lambda table, **kw: replace(
+        table, table.name, partial(visit_table, table), **kw)
+    compiler.visit_alias = lambda alias, **kw: replace(
+        alias.original, alias.name, partial(visit_alias, alias), **kw)
+    try:
+        return visit_alias(element, **kw)
+    finally:
+        del compiler.visit_table, compiler.visit_alias
+
+
+def archive_union(model, archive):
+    """ Return the UNION ALL of the tables of `model` and `archive`. """
+    def plain(table):
+        # A lightweight copy, which is not replaced while compiling.
+        return db.table(table.name, *[db.column(c.name) for c in table.c])
+    return db.union_all(
+        db.select([plain(model.__table__)]),
+        db.select([plain(archive.__table__)]),
+    )
+
+
+def include_archive(query, session):
+    """
+        Make `query` read the archive tables in addition to the live ones.
+
+        Every reference to the fill or action table in the statement of
+        `query`, including its filters, joins, subqueries and aliases,
+        is replaced by the UNION ALL of the live and the archive table.
+        The ORM marks the statements of queries as off limits to
+        expression rewriting, so the replacement is made while the
+        statement is compiled (see ArchiveAlias), under the name of the
+        table. The result is a new query over the columns of the
+        rewritten statement, with the same column types. Tables whose
+        archive is empty are left alone, so the query is unchanged as
+        long as nothing has been archived. See ArchiveTable for how
+        that is determined.
+
+        >>> import coloringbook.testing as t
+        >>> testapp = t.get_fixture_app()
+        >>> with testapp.app_context():
+        ...     query = db.session.query(Fill.time).filter(Fill.time > 10)
+        ...     unchanged = include_archive(query, db.session) is query
+        ...     with t.QueryCounter(db.engine) as counter:
+        ...         include_archive(query, db.session) is query
+        ...     db.session.add(FillArchive(
+        ...         id=1, survey_id=1, page_id=1, area_id=1, subject_id=1,
+        ...         time=20, color_id=1))
+        ...     db.session.commit()
+        ...     archived = include_archive(query, db.session).all()
+        True
+        >>> unchanged, counter.count, archived
+        (True, 0, [(20,)])
+    """
+    tables = archive_tables()
+    replacements = dict(
+        (model.__table__, archive_union(model, archive))
+        for model, archive in ARCHIVED_MODELS
+        if tables[archive].has_rows(session)
+    )
+    if not replacements:
+        return query
+    # Columns are labeled by position, because several may have the
+    # same name.
+    statement = query.with_labels().statement
+    statement = statement.with_only_columns([
+        column.label('column_{}'.format(index))
+        for index, column in enumerate(statement.inner_columns)
+    ])
+    statement = ArchiveAlias(statement, 'archived', replacements)
+    return session.query(*statement.c)
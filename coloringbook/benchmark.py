@@ -0,0 +1,162 @@
+# (c) 2014-2023 Research Software Lab, Centre for Digital Humanities, Utrecht University
+# Licensed under the EUPL-1.2 or later. You may obtain a copy of the license at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12.
+
+"""
+    Benchmark of the storage layout of the fill table.
+
+    Compares the layout that the fill table had before migration
+    e1b7a0c93d52, with the composite primary key, to the current compact
+    layout with a surrogate key and narrow area and color keys. Both are
+    created as scratch tables next to the real ones, filled with the same
+    synthetic fills and dropped again. Foreign keys are left out, but the
+    indexes that MySQL creates for them are included.
+
+    Only the MySQL figures are representative of production; SQLite does
+    not cluster tables by their primary key.
+
+    >>> import coloringbook.testing as t
+    >>> testapp = t.get_fixture_app()
+    >>> with testapp.app_context():
+    ...     results = benchmark_fill_storage(m.db.engine, subjects=5)
+    >>> [(name, rows) for name, rows, seconds, size in results]
+    [('legacy', 500), ('compact', 500)]
+    >>> all(size > 0 for name, rows, seconds, size in results)
+    True
+"""
+
+import random
+import time as timer
+
+import sqlalchemy as sa
+
+import coloringbook.models as m
+
+
+def legacy_fill_table(metadata, name='benchmark_fill_legacy'):
+    """ The fill table with its composite primary key of five integers. """
+    return sa.Table(
+        name,
+        metadata,
+        sa.Column('survey_id', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('page_id', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('area_id', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('subject_id', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('time', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('color_id', sa.Integer, nullable=False),
+        sa.Index(name + '_ssp', 'survey_id', 'subject_id', 'page_id', 'time', 'color_id'),
+        sa.Index(name + '_subject', 'subject_id'),
+        sa.Index(name + '_page', 'page_id'),
+        sa.Index(name + '_area', 'area_id'),
+        sa.Index(name + '_color', 'color_id'),
+        mysql_engine='InnoDB',
+    )
+
+
+def compact_fill_table(metadata, name='benchmark_fill_compact'):
+    """ The fill table as currently defined by models.Fill. """
+    return sa.Table(
+        name,
+        metadata,
+        sa.Column('id', m.FillId, primary_key=True),
+        sa.Column('survey_id', sa.Integer, nullable=False),
+        sa.Column('page_id', sa.Integer, nullable=False),
+        sa.Column('area_id', m.AreaId, nullable=False),
+        sa.Column('subject_id', sa.Integer, nullable=False),
+        sa.Column('time', sa.Integer, nullable=False),
+        sa.Column('color_id', m.ColorId, nullable=False),
+        sa.Index(
+            name + '_click',
+            'survey_id', 'subject_id', 'page_id', 'time', 'area_id',
+            unique=True,
+        ),
+        sa.Index(
+            name + '_ssp',
+            'survey_id', 'subject_id', 'page_id', 'time', 'color_id', 'area_id',
+        ),
+        sa.Index(name + '_subject', 'subject_id'),
+        sa.Index(name + '_page', 'page_id'),
+        sa.Index(name + '_area', 'area_id'),
+        sa.Index(name + '_color', 'color_id'),
+        mysql_engine='InnoDB',
+    )
+
+
+def generate_fills(subjects, pages=20, clicks=5, seed=0):
+    """
+        Generate synthetic fills, as a list of rows for each subject.
+
+        >>> [len(rows) for rows in generate_fills(3, pages=2, clicks=4)]
+        [8, 8, 8]
+    """
+    rng = random.Random(seed)
+    result = []
+    for subject in range(1, subjects + 1):
+        rows = []
+        for page in range(1, pages + 1):
+            time = 0
+            for click in range(clicks):
+                time += rng.randint(200, 5000)
+                rows.append({
+                    'survey_id': 1 + subject % 3,
+                    'page_id': page,
+                    'area_id': rng.randint(1, 2000),
+                    'subject_id': subject,
+                    'time': time,
+                    'color_id': rng.randint(1, 8),
+                })
+        result.append(rows)
+    return result
+
+
+def table_size(connection, table):
+    """ Return the number of bytes taken by the data and indexes of `table`. """
+    if connection.dialect.name == 'mysql':
+        connection.execute('ANALYZE TABLE {}'.format(table.name))
+        return connection.execute(sa.text(
+            'SELECT data_length + index_length FROM information_schema.tables '
+            'WHERE table_schema = DATABASE() AND table_name = :name'
+        ), name=table.name).scalar()
+    if connection.dialect.name == 'sqlite':
+        names = [table.name] + [index.name for index in table.indexes]
+        return connection.execute(
+            sa.select([sa.func.sum(sa.column('pgsize'))])
+            .select_from(sa.table('dbstat'))
+            .where(sa.column('name').in_(names))
+        ).scalar()
+    return None
+
+
+def benchmark_fill_storage(engine, subjects=1000, pages=20, clicks=5):
+    """
+        Insert the same fills in both layouts and measure them.
+
+        Each subject is inserted in a transaction of its own, like
+        views.store_subject_data does. Returns a list with a tuple
+        (name, rows, seconds, bytes) for each layout.
+    """
+    fills = generate_fills(subjects, pages, clicks)
+    metadata = sa.MetaData()
+    tables = [
+        ('legacy', legacy_fill_table(metadata)),
+        ('compact', compact_fill_table(metadata)),
+    ]
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    results = []
+    try:
+        for name, table in tables:
+            start = timer.time()
+            for rows in fills:
+                with engine.begin() as connection:
+                    connection.execute(table.insert(), rows)
+            seconds = timer.time() - start
+            with engine.connect() as connection:
+                count = connection.execute(
+                    sa.select([sa.func.count()]).select_from(table)
+                ).scalar()
+                size = table_size(connection, table)
+            results.append((name, count, seconds, size))
+    finally:
+        metadata.drop_all(engine)
+    return results
@@ -0,0 +1,158 @@
+# (c) 2014-2023 Research Software Lab, Centre for Digital Humanities, Utrecht University
+# Licensed under the EUPL-1.2 or later. You may obtain a copy of the license at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12.
+
+"""
+    Cheap health check of the Celery broker.
+
+    Before work is handed to Celery, the request path checks whether
+    the Redis broker is reachable. The check has to be cheap, also when
+    Redis is down, so BrokerHealth
+
+     - pings through a connection pool that is shared by all requests
+       of the process, with short socket timeouts;
+     - remembers the outcome of a ping for HEALTH_TTL seconds;
+     - stops pinging altogether for BREAKER_COOLDOWN seconds after
+       BREAKER_THRESHOLD consecutive failures (the circuit is "open").
+       After the cooldown, a single ping decides whether the circuit
+       closes again.
+
+    The following configuration settings apply.
+
+    CELERY_BROKER_URL          address of the broker (environment variable
+                               of the same name, or redis://redis:6379/0)
+    BROKER_HEALTH_TTL          seconds to trust the last ping (5)
+    BROKER_BREAKER_THRESHOLD   failures that open the circuit (3)
+    BROKER_BREAKER_COOLDOWN    seconds the circuit stays open (30)
+
+    In the following example, nothing listens on the broker address.
+
+    >>> health = BrokerHealth('redis://127.0.0.1:1/0', ttl=0, threshold=2)
+    >>> health.available(), health.available(), health.circuit_open()
+    (False, False, True)
+    >>> health.available()
+    False
+    >>> statistics = health.statistics()
+    >>> statistics['pings'], statistics['failures'], statistics['rejections']
+    (2, 2, 1)
+
+    The statistics are shown in the admin interface, so the password is
+    masked.
+
+    >>> BrokerHealth('redis://:secret@127.0.0.1:1/0').statistics()['url']
+    u'redis://:**@127.0.0.1:1/0'
+"""
+
+import time
+from os import environ
+from threading import Lock
+
+import redis
+from flask import current_app
+from kombu.utils.url import maybe_sanitize_url
+
+
+DEFAULT_BROKER_URL = 'redis://redis:6379/0'
+HEALTH_TTL = 5
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 30
+SOCKET_TIMEOUT = 0.5  # seconds, for connecting as well as for the ping
+
+
+def get_broker_url(config):
+    """ Return the broker URL from `config`, the environment or the default. """
+    return config.get('CELERY_BROKER_URL') or environ.get(
+        'CELERY_BROKER_URL', DEFAULT_BROKER_URL)
+
+
+class BrokerHealth(object):
+    """ Cached, circuit-breaking health state of a Redis broker. """
+
+    def __init__(
+            self, url,
+            ttl=HEALTH_TTL,
+            threshold=BREAKER_THRESHOLD,
+            cooldown=BREAKER_COOLDOWN ):
+        self.url = url
+        self.ttl = ttl
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.pool = redis.ConnectionPool.from_url(
+            url,
+            socket_connect_timeout=SOCKET_TIMEOUT,
+            socket_timeout=SOCKET_TIMEOUT,
+        )
+        self.client = redis.StrictRedis(connection_pool=self.pool)
+        self.lock = Lock()
+        self.healthy = False
+        self.checked = None
+        self.failures = 0
+        self.opened = None
+        self.counts = dict.fromkeys(('pings', 'failures', 'rejections'), 0)
+
+    def circuit_open(self, now=None):
+        """ Whether pings are currently suspended. """
+        now = time.time() if now is None else now
+        return self.opened is not None and now - self.opened < self.cooldown
+
+    def available(self):
+        """ Return whether the broker is available, pinging only if needed. """
+        now = time.time()
+        if self.circuit_open(now):
+            self.counts['rejections'] += 1
+            return False
+        if self.checked is not None and now - self.checked < self.ttl:
+            return self.healthy
+        with self.lock:
+            # Another thread may have pinged while we were waiting.
+            if self.checked is None or time.time() - self.checked >= self.ttl:
+                self.ping()
+        return self.healthy
+
+    def ping(self):
+        """ Ping the broker and update the health state. """
+        self.counts['pings'] += 1
+        try:
+            self.client.ping()
+        except redis.exceptions.RedisError:
+            self.counts['failures'] += 1
+            self.healthy = False
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time.time()
+        else:
+            self.healthy = True
+            self.failures = 0
+            self.opened = None
+        self.checked = time.time()
+
+    def statistics(self):
+        """ Return a dictionary with the health state and event counts. """
+        result = dict(self.counts)
+        result.update(
+            url=maybe_sanitize_url(self.url),
+            healthy=self.healthy,
+            circuit_open=self.circuit_open(),
+            consecutive_failures=self.failures,
+        )
+        return result
+
+
+def broker_client(app=None):
+    """ Return a Redis client that shares the connection pool of broker_health. """
+    return broker_health(app).client
+
+
+def broker_health(app=None):
+    """ Return the BrokerHealth of `app`, creating it on first use. """
+    app = app or current_app
+    health = app.extensions.get('broker_health')
+    if health is None:
+        config = app.config
+        health = app.extensions['broker_health'] = BrokerHealth(
+            get_broker_url(config),
+            ttl=config.get('BROKER_HEALTH_TTL', HEALTH_TTL),
+            threshold=config.get('BROKER_BREAKER_THRESHOLD', BREAKER_THRESHOLD),
+            cooldown=config.get('BROKER_BREAKER_COOLDOWN', BREAKER_COOLDOWN),
+        )
+    return health
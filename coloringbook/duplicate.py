@@ -0,0 +1,166 @@
+# (c) 2014-2023 Research Software Lab, Centre for Digital Humanities, Utrecht University
+# Licensed under the EUPL-1.2 or later. You may obtain a copy of the license at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12.
+
+"""
+    Set-based duplication of surveys and pages.
+
+    The copies are made with INSERT ... SELECT statements, so the number
+    of queries does not grow with the number of pages per survey or the
+    number of expectations per page, and everything is committed at
+    once. Selections of more than DUPLICATE_ASYNC_THRESHOLD items are
+    handed to a Celery worker by the admin views, if one is available.
+
+    >>> import coloringbook.testing as t
+    >>> testapp = t.get_fixture_app()
+    >>> with testapp.app_context():
+    ...     survey = t.generate_survey_data(subjects=1, pages=4)
+    ...     created, failed = duplicate_surveys([survey.id])
+    ...     copy = Survey.query.filter_by(name=created[0]).one()
+    ...     same_pages = [p.id for p in copy.pages] == [p.id for p in survey.pages]
+    ...     created, failed = duplicate_surveys([survey.id])
+    >>> copy.name == 'Copy of ' + survey.name, same_pages
+    (True, True)
+    >>> created, failed == [copy.name]
+    ([], True)
+"""
+
+from celery import shared_task
+from flask import current_app
+
+from .models import (
+    db, Survey, SurveyPage, Page, Expectation,
+    SURVEY_NAME_CHAR_LIMIT, PAGE_NAME_CHAR_LIMIT,
+)
+from .admin.utilities import get_copied_name
+
+
+DUPLICATE_ASYNC_THRESHOLD = 50  # selections larger than this go to Celery
+
+
+def duplicate_surveys(survey_ids):
+    """
+        Create a copy of each survey in `survey_ids` with the same pages.
+
+        Surveys whose copy would get a name that is already in use are
+        skipped. Returns the names of the created copies and the names
+        that were in use.
+    """
+    table = Survey.__table__
+    originals = (
+        db.session.query(Survey.id, Survey.name)
+        .filter(Survey.id.in_(survey_ids))
+        .order_by(Survey.id)
+        .all()
+    )
+    new_names = dict(
+        (id, get_copied_name(name, SURVEY_NAME_CHAR_LIMIT))
+        for id, name in originals
+    )
+    in_use = set(
+        name for (name,) in
+        db.session.query(Survey.name)
+        .filter(Survey.name.in_(new_names.values() or ['']))
+    )
+    created, failed = [], []
+    for id, name in originals:
+        new_name = new_names[id]
+        if new_name in in_use:
+            failed.append(new_name)
+            del new_names[id]
+        else:
+            in_use.add(new_name)
+            created.append(new_name)
+    if not new_names:
+        return created, failed
+
+    columns = [c for c in table.c if c.name not in ('id', 'name')]
+    db.session.execute(table.insert().from_select(
+        ['name'] + [c.name for c in columns],
+        db.select(
+            [db.case(new_names, value=table.c.id)] + columns
+        ).where(table.c.id.in_(new_names.keys())),
+    ))
+    new_ids = dict(
+        db.session.query(Survey.name, Survey.id)
+        .filter(Survey.name.in_(new_names.values()))
+    )
+    id_map = dict((id, new_ids[name]) for id, name in new_names.items())
+
+    survey_page = SurveyPage.__table__
+    db.session.execute(survey_page.insert().from_select(
+        ['survey_id', 'page_id', 'ordering'],
+        db.select([
+            db.case(id_map, value=survey_page.c.survey_id),
+            survey_page.c.page_id,
+            survey_page.c.ordering,
+        ]).where(survey_page.c.survey_id.in_(id_map.keys())),
+    ))
+    db.session.commit()
+    return created, failed
+
+
+def duplicate_pages(page_ids):
+    """
+        Create a copy of each page in `page_ids` with the same expectations.
+
+        Returns the number of pages that were created.
+
+        >>> import coloringbook.testing as t
+        >>> testapp = t.get_fixture_app()
+        >>> with testapp.app_context():
+        ...     survey = t.generate_survey_data(subjects=1, pages=3)
+        ...     pages = sorted(survey.pages, key=lambda page: page.id)
+        ...     duplicate_pages([page.id for page in pages])
+        ...     copies = Page.query.filter(Page.name.like('Copy of %'))
+        ...     copies = copies.order_by(Page.id).all()
+        ...     [
+        ...         sorted((e.area_id, e.color_id, e.here) for e in copy.expectations) ==
+        ...         sorted((e.area_id, e.color_id, e.here) for e in page.expectations)
+        ...         for page, copy in zip(pages, copies)
+        ...     ]
+        3
+        [True, True, True]
+    """
+    table = Page.__table__
+    columns = [c for c in table.c if c.name not in ('id', 'name')]
+    originals = db.session.execute(
+        db.select([table]).where(table.c.id.in_(page_ids)).order_by(table.c.id)
+    ).fetchall()
+    if not originals:
+        return 0
+    # Page names are not unique, so the new IDs cannot be looked up by
+    # name afterwards. Insert the pages one by one to learn their IDs.
+    id_map = {}
+    for row in originals:
+        values = dict((c.name, row[c.name]) for c in columns)
+        values['name'] = get_copied_name(row['name'], PAGE_NAME_CHAR_LIMIT)
+        result = db.session.execute(table.insert().values(**values))
+        id_map[row['id']] = result.inserted_primary_key[0]
+
+    expectation = Expectation.__table__
+    copied = [c for c in expectation.c if c.name != 'page_id']
+    db.session.execute(expectation.insert().from_select(
+        ['page_id'] + [c.name for c in copied],
+        db.select(
+            [db.case(id_map, value=expectation.c.page_id)] + copied
+        ).where(expectation.c.page_id.in_(id_map.keys())),
+    ))
+    db.session.commit()
+    return len(id_map)
+
+
+@shared_task(ignore_result=True)
+def duplicate_surveys_task(survey_ids):
+    """ Run duplicate_surveys in a worker and log the outcome. """
+    created, failed = duplicate_surveys(survey_ids)
+    current_app.logger.info(
+        'Duplicated %d surveys; names already in use: %s',
+        len(created), ', '.join(failed) or 'none',
+    )
+
+
+@shared_task(ignore_result=True)
+def duplicate_pages_task(page_ids):
+    """ Run duplicate_pages in a worker and log the outcome. """
+    current_app.logger.info('Duplicated %d pages.', duplicate_pages(page_ids))
@@ -0,0 +1,170 @@
+# (c) 2014-2023 Research Software Lab, Centre for Digital Humanities, Utrecht University
+# Licensed under the EUPL-1.2 or later. You may obtain a copy of the license at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12.
+
+"""
+    Storage of email bodies and attachments outside of the broker.
+
+    The CSV attachments of a notification email can be large. Instead of
+    passing them through Redis as task arguments, they are stored once
+    and the mail task only receives their keys. The task deletes the
+    files after successful delivery; clean_attachments removes what is
+    left behind otherwise, except for files that the outbox still needs.
+
+    By default, the files are stored in the mail_attachments directory
+    of the instance folder, which must be shared by the application and
+    the Celery workers. The directory is created writable for everyone
+    and the files readable for everyone, because the workers run as a
+    different user than the application. Set MAIL_ATTACHMENT_DIR to use another directory,
+    or MAIL_ATTACHMENT_STORE to the import path of a class with the same
+    interface as FileAttachmentStore to use another backend. Its
+    constructor receives the application.
+
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> store = FileAttachmentStore(directory)
+    >>> key = store.put('a;b\\n1;2\\n')
+    >>> store.get(key)
+    'a;b\\n1;2\\n'
+    >>> store.get(store.put(iter(['a;b', '\\n'])))
+    'a;b\\n'
+    >>> store.delete(key)
+    >>> len(os.listdir(directory))
+    1
+    >>> store.clean(0)
+    1
+    >>> os.listdir(directory)
+    []
+    >>> shutil.rmtree(directory)
+"""
+
+import os
+import os.path as op
+import tempfile
+import time
+
+from celery import shared_task
+from flask import current_app
+from werkzeug.utils import import_string
+
+
+ATTACHMENT_PREFIX = 'mail-'
+ATTACHMENT_MAX_AGE = 7 * 24 * 3600  # seconds after which leftovers are removed
+# The application and the workers may run as different users, and either
+# of them writes, reads and deletes the files.
+DIRECTORY_MODE = 0o777
+FILE_MODE = 0o644
+
+
+class FileAttachmentStore(object):
+    """ Stores each attachment in a file of its own in `directory`. """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def put(self, data):
+        """
+            Store `data` and return its key.
+
+            `data` is a byte or unicode string, or an iterable of byte
+            strings, which is written chunk by chunk.
+
+            >>> import tempfile, shutil, stat
+            >>> directory = op.join(tempfile.mkdtemp(), 'store')
+            >>> store = FileAttachmentStore(directory)
+            >>> key = store.put('data')
+            >>> oct(stat.S_IMODE(os.stat(directory).st_mode))
+            '0777'
+            >>> oct(stat.S_IMODE(os.stat(store.path(key)).st_mode))
+            '0644'
+            >>> shutil.rmtree(op.dirname(directory))
+        """
+        if not op.isdir(self.directory):
+            os.makedirs(self.directory)
+            # makedirs applies the umask of the process.
+            os.chmod(self.directory, DIRECTORY_MODE)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if isinstance(data, str):
+            data = [data]
+        handle, path = tempfile.mkstemp(prefix=ATTACHMENT_PREFIX, dir=self.directory)
+        with os.fdopen(handle, 'wb') as file:
+            for chunk in data:
+                file.write(chunk)
+        os.chmod(path, FILE_MODE)  # mkstemp creates it private
+        return op.basename(path)
+
+    def path(self, key):
+        # Keys are plain file names; never follow a key out of the directory.
+        return op.join(self.directory, op.basename(key))
+
+    def get(self, key):
+        """ Return the data stored under `key`. """
+        with open(self.path(key), 'rb') as file:
+            return file.read()
+
+    def delete(self, key):
+        """ Remove the data stored under `key`, if any. """
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def clean(self, max_age, keep=()):
+        """
+            Remove data that were stored more than `max_age` seconds ago.
+
+            Keys in `keep` are left alone, regardless of their age.
+
+            >>> import tempfile, shutil
+            >>> directory = tempfile.mkdtemp()
+            >>> store = FileAttachmentStore(directory)
+            >>> old, new = store.put('old'), store.put('new')
+            >>> os.utime(store.path(old), (0, 0))
+            >>> store.clean(3600)
+            1
+            >>> os.listdir(directory) == [new]
+            True
+            >>> shutil.rmtree(directory)
+        """
+        if not op.isdir(self.directory):
+            return 0
+        threshold = time.time() - max_age
+        removed = 0
+        for name in os.listdir(self.directory):
+            if not name.startswith(ATTACHMENT_PREFIX) or name in keep:
+                continue
+            path = op.join(self.directory, name)
+            if op.getmtime(path) < threshold:
+                self.delete(name)
+                removed += 1
+        return removed
+
+
+def attachment_store(app=None):
+    """ Return the attachment store of `app`, creating it on first use. """
+    app = app or current_app
+    store = app.extensions.get('mail_attachments')
+    if store is None:
+        backend = app.config.get('MAIL_ATTACHMENT_STORE')
+        if backend:
+            if isinstance(backend, basestring):
+                backend = import_string(backend)
+            store = backend(app)
+        else:
+            store = FileAttachmentStore(app.config.get(
+                'MAIL_ATTACHMENT_DIR',
+                op.join(app.instance_path, 'mail_attachments'),
+            ))
+        app.extensions['mail_attachments'] = store
+    return store
+
+
+@shared_task(ignore_result=True)
+def clean_attachments():
+    """ Remove attachments that were never delivered and are not in the outbox. """
+    from .outbox import unsent_keys
+    max_age = current_app.config.get('MAIL_ATTACHMENT_MAX_AGE', ATTACHMENT_MAX_AGE)
+    removed = attachment_store().clean(max_age, keep=unsent_keys())
+    if removed:
+        current_app.logger.info('Removed %d undelivered mail attachments.', removed)
@@ -0,0 +1,377 @@
+# (c) 2014-2023 Research Software Lab, Centre for Digital Humanities, Utrecht University
+# Licensed under the EUPL-1.2 or later. You may obtain a copy of the license at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12.
+
+"""
+    Persistent outbox of notification emails.
+
+    Every notification is recorded as one OutboxMessage per recipient
+    before anything is sent, so that no email is lost when the broker
+    or the SMTP server is down. A message is pending until it has been
+    delivered, after which it is sent. A failed delivery is retried
+    after an exponentially growing delay with random jitter, so that a
+    long SMTP outage does not cause a hot retry loop. After
+    OUTBOX_MAX_ATTEMPTS failures, the message is failed and waits for
+    an administrator, who can retry it from Utilities > Mail outbox.
+
+    New messages are delivered right away by deliver_outbox. The
+    sweep_outbox task, which Celery beat runs every minute, delivers
+    the messages that are due for another attempt, including those that
+    could not be handed to Celery at all.
+
+    Before a message is sent, it is claimed with a single conditional
+    UPDATE that moves its next attempt OUTBOX_LEASE seconds ahead. Only
+    the task whose UPDATE changed the row sends the message, so a sweep
+    that overlaps with another sweep or with deliver_outbox never sends
+    the same message twice.
+
+    >>> import coloringbook.testing as t, tempfile
+    >>> app = t.get_fixture_app()
+    >>> app.config.update(
+    ...     MAIL_SUPPRESS_SEND=True,
+    ...     MAIL_DEFAULT_SENDER='coloringbook@example.com',
+    ...     MAIL_ATTACHMENT_DIR=tempfile.mkdtemp(),
+    ... )
+    >>> _ = mail_client.init_app(app)
+    >>> with app.app_context(), mail_client.record_messages() as outbox:
+    ...     survey = t.generate_survey_data(subjects=1, pages=1)
+    ...     ids = enqueue(survey, ['a@example.com', 'b@example.com'],
+    ...                   'Results', u'<p>Hallo</p>',
+    ...                   [('results.csv', 'text/csv', iter(['a;b\\n']))])
+    ...     deliver_pending(ids)
+    ...     deliver_pending(ids)
+    ...     states = [message.state for message in OutboxMessage.query]
+    ...     files = os.listdir(app.config['MAIL_ATTACHMENT_DIR'])
+    (2, 0)
+    (0, 0)
+    >>> len(outbox), states, files
+    (2, [u'sent', u'sent'], [])
+    >>> outbox[0].attachments[0].filename, outbox[0].attachments[0].data
+    (u'results.csv', 'a;b\\n')
+
+    A message that another task is still delivering is left alone.
+
+    >>> with app.app_context(), mail_client.record_messages() as outbox:
+    ...     survey = db.session.merge(survey)
+    ...     ids = enqueue(survey, ['c@example.com'], 'Results', u'<p>Hallo</p>', [])
+    ...     claim(ids, dt.datetime.utcnow()) == ids
+    ...     deliver_pending(ids), deliver_pending()
+    True
+    ((0, 0), (0, 0))
+    >>> len(outbox)
+    0
+"""
+
+import datetime as dt
+import json
+import os
+import random
+
+from celery import shared_task
+from flask import current_app
+from flask_mail import Message
+
+from coloringbook.models import db, OutboxMessage
+from coloringbook.mail import mail_client
+from coloringbook.mail.attachments import attachment_store
+
+
+PENDING, SENT, FAILED = 'pending', 'sent', 'failed'
+OUTBOX_MAX_ATTEMPTS = 8
+BACKOFF_BASE = 60  # seconds before the second attempt, on average
+BACKOFF_MAX = 6 * 3600  # upper limit of the average delay
+OUTBOX_LEASE = 600  # seconds a message is reserved for a delivery attempt
+SWEEP_BATCH_SIZE = 100
+SWEEP_INTERVAL = 60  # seconds between runs of sweep_outbox
+
+
+def build_message(subject, recipient, html, attachments):
+    """
+    Compose the message for a single recipient, with the given attachments.
+
+    `attachments` are (filename, content type, data) triples. Plain
+    strings, as passed by earlier versions, are attached as CSV files.
+    """
+    message = Message(subject=subject, recipients=[recipient], html=html)
+    timestamp = dt.datetime.now().strftime("%y%m%d%H%M")
+
+    for index, attachment in enumerate(attachments):
+        if isinstance(attachment, basestring):
+            attachment = (
+                "{}_{}_{}.csv".format(timestamp, 'survey_results', index),
+                "text/csv",
+                attachment,
+            )
+        filename, content_type, data = attachment
+        message.attach(
+            filename=filename,
+            content_type=content_type,
+            data=data,
+            disposition="attachment"
+        )
+    return message
+
+
+def backoff(attempts, rng=random):
+    """
+    Return the number of seconds to wait after `attempts` failed attempts.
+
+    The average delay doubles with every attempt, up to BACKOFF_MAX; the
+    actual delay is drawn uniformly from half to one and a half times
+    the average, so that messages that failed together are spread out.
+
+    >>> [30 <= backoff(1) <= 90, 60 <= backoff(2) <= 180, 120 <= backoff(3) <= 360]
+    [True, True, True]
+    >>> backoff(20) <= 1.5 * BACKOFF_MAX
+    True
+    """
+    average = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+    return average * rng.uniform(0.5, 1.5)
+
+
+def enqueue(survey, recipients, subject, html, attachments):
+    """
+    Record an email to each of `recipients` in the outbox and return the IDs.
+
+    `attachments` are (filename, content type, data) triples, where the
+    data may also be an iterable of chunks, which is written to the
+    attachment store without holding the whole file in memory. The body
+    and the attachments are stored once and shared by the messages. The
+    messages are due right away; deliver_outbox or sweep_outbox,
+    whichever claims a message first, sends it.
+    """
+    store = attachment_store()
+    html_key = store.put(html)
+    attachment_keys = json.dumps([
+        [store.put(data), filename, content_type]
+        for filename, content_type, data in attachments
+    ])
+    messages = [
+        OutboxMessage(
+            survey_id=survey.id,
+            recipient=recipient,
+            subject=subject,
+            html_key=html_key,
+            attachment_keys=attachment_keys,
+            next_attempt=dt.datetime.utcnow(),
+        )
+        for recipient in recipients
+    ]
+    db.session.add_all(messages)
+    db.session.commit()
+    return [message.id for message in messages]
+
+
+def deliver_pending(message_ids=None):
+    """
+    Attempt to deliver pending messages over a single SMTP connection.
+
+    If `message_ids` is None, the messages whose next attempt is due
+    are delivered, at most SWEEP_BATCH_SIZE at a time. Otherwise, only
+    the due messages among `message_ids` are delivered. Messages that
+    another task has claimed are skipped. Returns the number of messages
+    that were sent and the number that failed.
+    """
+    now = dt.datetime.utcnow()
+    if message_ids is None:
+        message_ids = [message_id for message_id, in db.session.query(
+            OutboxMessage.id,
+        ).filter(
+            OutboxMessage.state == PENDING,
+            OutboxMessage.next_attempt <= now,
+        ).order_by(OutboxMessage.next_attempt).limit(SWEEP_BATCH_SIZE)]
+    claimed = claim(message_ids, now)
+    if not claimed:
+        return 0, 0
+    messages = OutboxMessage.query.filter(OutboxMessage.id.in_(claimed)).all()
+
+    store = attachment_store()
+    files = {}
+    def load(key):
+        if key not in files:
+            files[key] = store.get(key)
+        return files[key]
+
+    done = set()
+    error = None
+    try:
+        with mail_client.connect() as connection:
+            for message in messages:
+                try:
+                    connection.send(build_message(
+                        message.subject,
+                        message.recipient,
+                        load(message.html_key).decode('utf-8'),
+                        [
+                            load(entry) if isinstance(entry, basestring)
+                            else (entry[1], entry[2], load(entry[0]))
+                            for entry in json.loads(message.attachment_keys)
+                        ],
+                    ))
+                except Exception as exception:
+                    record_failure(message, exception, now)
+                else:
+                    message.state = SENT
+                    message.sent = now
+                    message.attempts += 1
+                done.add(message.id)
+    except Exception as exception:
+        # Connecting or closing failed.
+        error = exception
+    for message in messages:
+        if message.id not in done:
+            record_failure(message, error, now)
+    db.session.commit()
+
+    sent = [message for message in messages if message.state == SENT]
+    release_files(set(message.html_key for message in sent))
+    return len(sent), len(messages) - len(sent)
+
+
+def claim(message_ids, now):
+    """
+    Reserve the due messages among `message_ids` and return the IDs of those reserved.
+
+    Every message is claimed by an UPDATE that only matches a pending
+    message whose next attempt is due, and that moves the next attempt
+    OUTBOX_LEASE seconds ahead. When two tasks claim the same message,
+    the database lets only one of the updates change the row.
+
+    >>> import coloringbook.testing as t
+    >>> app = t.get_fixture_app()
+    >>> with app.app_context():
+    ...     message = OutboxMessage(
+    ...         recipient='a@example.com', subject='Results', html_key='x',
+    ...         attachment_keys='[]')
+    ...     db.session.add(message)
+    ...     db.session.commit()
+    ...     now = dt.datetime.utcnow()
+    ...     claim([message.id], now) == [message.id], claim([message.id], now)
+    (True, [])
+    """
+    table = OutboxMessage.__table__
+    lease = now + dt.timedelta(seconds=OUTBOX_LEASE)
+    claimed = []
+    for message_id in message_ids:
+        result = db.session.execute(table.update().where(db.and_(
+            table.c.id == message_id,
+            table.c.state == PENDING,
+            table.c.next_attempt <= now,
+        )).values(next_attempt=lease))
+        if result.rowcount == 1:
+            claimed.append(message_id)
+    db.session.commit()
+    return claimed
+
+
+def record_failure(message, error, now):
+    """ Schedule the next attempt for `message`, or give up on it. """
+    message.attempts += 1
+    message.last_error = u'{}: {}'.format(type(error).__name__, error)
+    if message.attempts >= current_app.config.get(
+            'OUTBOX_MAX_ATTEMPTS', OUTBOX_MAX_ATTEMPTS):
+        message.state = FAILED
+    else:
+        message.next_attempt = now + dt.timedelta(
+            seconds=backoff(message.attempts))
+
+
+def release_files(html_keys):
+    """ Delete the stored files of emails that have reached all recipients. """
+    store = attachment_store()
+    for html_key in html_keys:
+        unsent = OutboxMessage.query.filter(
+            OutboxMessage.html_key == html_key,
+            OutboxMessage.state != SENT,
+        ).first()
+        if unsent is not None:
+            continue
+        message = OutboxMessage.query.filter_by(html_key=html_key).first()
+        for key in [html_key] + stored_keys(message.attachment_keys):
+            store.delete(key)
+
+
+def retry_messages(message_ids):
+    """
+    Make failed or pending messages due for delivery right away.
+
+    Pending messages whose next attempt lies in the future may be in
+    the middle of a delivery, so they are left alone. Returns the number
+    of messages that will be retried.
+
+    >>> import coloringbook.testing as t
+    >>> app = t.get_fixture_app()
+    >>> with app.app_context():
+    ...     messages = [
+    ...         OutboxMessage(recipient=recipient, subject='Results', html_key='x',
+    ...                       attachment_keys='[]', state=FAILED, attempts=8)
+    ...         for recipient in ('a@example.com', 'b@example.com')
+    ...     ]
+    ...     db.session.add_all(messages)
+    ...     db.session.commit()
+    ...     ids = [message.id for message in messages]
+    ...     retry_messages(ids)
+    ...     claimed = claim(ids[1:], dt.datetime.utcnow())
+    ...     retry_messages(ids)
+    2
+    1
+    """
+    now = dt.datetime.utcnow()
+    count = OutboxMessage.query.filter(
+        OutboxMessage.id.in_(message_ids),
+        db.or_(
+            OutboxMessage.state == FAILED,
+            db.and_(
+                OutboxMessage.state == PENDING,
+                OutboxMessage.next_attempt <= now,
+            ),
+        ),
+    ).update({
+        'state': PENDING,
+        'attempts': 0,
+        'next_attempt': now,
+    }, synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def unsent_keys():
+    """ Return the keys of all stored files that are still needed by the outbox. """
+    keys = set()
+    query = db.session.query(
+        OutboxMessage.html_key, OutboxMessage.attachment_keys,
+    ).filter(OutboxMessage.state != SENT).distinct()
+    for html_key, attachment_keys in query:
+        keys.add(html_key)
+        keys.update(stored_keys(attachment_keys))
+    return keys
+
+
+def stored_keys(attachment_keys):
+    """
+    Return the store keys from the attachment_keys column of a message.
+
+    Messages recorded by earlier versions only contain the keys.
+
+    >>> stored_keys('[["mail-a", "results.zip", "application/zip"], "mail-b"]')
+    [u'mail-a', u'mail-b']
+    """
+    return [
+        entry if isinstance(entry, basestring) else entry[0]
+        for entry in json.loads(attachment_keys)
+    ]
+
+
+@shared_task(ignore_result=True)
+def deliver_outbox(message_ids):
+    """ Deliver the newly enqueued messages with `message_ids`. """
+    deliver_pending(message_ids)
+
+
+@shared_task(ignore_result=True)
+def sweep_outbox():
+    """ Deliver all messages that are due for another attempt. """
+    sent, failed = deliver_pending()
+    if sent or failed:
+        current_app.logger.info(
+            'Outbox sweep: %d emails sent, %d failed.', sent, failed)
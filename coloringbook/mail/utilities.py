@@ -2,22 +2,91 @@ import csv
 import StringIO
 from celery import shared_task
 from flask import render_template, current_app
-import redis
 from coloringbook.mail import mail_client
-from flask_mail import Message
+from coloringbook.mail.outbox import build_message, enqueue, deliver_outbox
+from coloringbook.broker import broker_health, broker_client
 import datetime as dt
+from itertools import chain
 
-from coloringbook.utilities import (
-    actions_from_json,
-    subject_from_json,
-    get_survey_pages,
-    evaluate_page_actions
-)
+from coloringbook.models import Survey
+from coloringbook.scoring import score_survey
 
-def create_survey_results_csv(survey_results):
+from coloringbook.utilities import get_survey_pages
+from coloringbook.admin.utilities import csv_lines, zip_stream
+
+DIGEST_KEY = 'coloringbook:digest:{}'  # list of buffered subject IDs per survey
+DIGEST_SURVEYS_KEY = 'coloringbook:digest:surveys'  # surveys with buffered subjects
+EMAIL_DIGEST_WINDOW = 3600  # seconds between digest emails
+RESULT_HEADERS = ["Survey", "Subject", "Birthdate", "Page", "Target", "Color", "Correct"]
+
+def result_rows(survey_result):
+    """
+    Generate the CSV rows for the evaluation summary of one subject, ending with a total row.
+    """
+    subject = [
+        survey_result["survey_name"],
+        survey_result["subject_name"],
+        survey_result["subject_dob"],
+    ]
+    for evaluation in survey_result["evaluations"]:
+        yield subject + [
+            evaluation["page"],
+            evaluation["target"],
+            evaluation["color"],
+            evaluation["correct"],
+        ]
+    yield subject + [
+        survey_result["total_pages"],
+        "Total",
+        "",
+        "{} ({}%)".format(survey_result["total_correct"], survey_result["percentage_correct"]),
+    ]
+
+def result_attachments(survey_results, attachment_format='separate'):
+    """
+    Return the email attachments with survey results as (filename, content type, chunks) triples.
+
+    The chunks are generated while the attachments are written, so only a small buffer is held in memory, regardless of the number of subjects. `attachment_format` is one of the keys of EMAIL_ATTACHMENT_FORMATS: one CSV file per subject ('separate'), a single CSV file for all subjects ('combined') or a single ZIP archive with one CSV file per subject ('zip').
+
+    >>> import zipfile
+    >>> results = [
+    ...     {"survey_name": "s", "subject_name": name, "subject_dob": "2000-01-01",
+    ...      "evaluations": [{"page": "p", "target": "t", "color": "red", "correct": 1}],
+    ...      "total_pages": 1, "total_correct": 1, "percentage_correct": 100}
+    ...     for name in ("Bob", u"Zo\xeb")
+    ... ]
+    >>> [(name[-20:], content_type) for name, content_type, _ in result_attachments(results)]
+    [('survey_results_0.csv', 'text/csv'), ('survey_results_1.csv', 'text/csv')]
+    >>> [(name, data)] = [(name, ''.join(chunks)) for name, _, chunks in result_attachments(results, 'combined')]
+    >>> name[-18:], data.count('Total'), data.count('Survey')
+    ('survey_results.csv', 2, 1)
+    >>> [(name, content_type, chunks)] = result_attachments(results, 'zip')
+    >>> name[-18:], content_type
+    ('survey_results.zip', 'application/zip')
+    >>> archive = zipfile.ZipFile(StringIO.StringIO(''.join(chunks)))
+    >>> archive.namelist()
+    ['survey_results_0.csv', 'survey_results_1.csv']
+    >>> archive.read('survey_results_1.csv').splitlines()[1]
+    's;Zo\\xc3\\xab;2000-01-01;p;t;red;1'
+    """
+    timestamp = dt.datetime.now().strftime("%y%m%d%H%M")
+    if attachment_format == 'combined':
+        rows = chain.from_iterable(result_rows(result) for result in survey_results)
+        return [(timestamp + "_survey_results.csv", "text/csv", csv_lines(rows, RESULT_HEADERS))]
+    members = (
+        ("survey_results_{}.csv".format(index), csv_lines(result_rows(result), RESULT_HEADERS))
+        for index, result in enumerate(survey_results)
+    )
+    if attachment_format == 'zip':
+        return [(timestamp + "_survey_results.zip", "application/zip", zip_stream(members))]
+    return [(timestamp + "_" + name, "text/csv", chunks) for name, chunks in members]
+
+def create_survey_results_csv(survey_results, merged=False):
     """
     Compose a list of CSV files with survey results, one for each session, to be sent as email attachments.
 
+    If `merged` is True, the list contains a single CSV file with the results of all sessions, as in digest emails.
+
     >>> import coloringbook as cb, coloringbook.testing as t
     >>> from coloringbook.admin.views import FillView
     >>> testapp = t.get_fixture_app()
@@ -77,227 +146,163 @@ def create_survey_results_csv(survey_results):
     >>> rows[2]
     ['Test Survey 1', 'Alice', '2000-01-01', '2', 'Total', '', '2 (100%)']
 
+    >>> with testapp.test_request_context():
+    ...     merged_files = create_survey_results_csv(survey_results, merged=True)
+    >>> len(merged_files)
+    1
+    >>> rows = list(csv.reader(StringIO.StringIO(merged_files[0]), delimiter=";"))
+    >>> len(rows), rows[0][0], rows[3][1], rows[4][1]
+    (7, 'Survey', 'Bob', 'Alice')
+
     """
-    headers = ["Survey", "Subject", "Birthdate", "Page", "Target", "Color", "Correct"]
-    csv_files = []
-
-    for survey_result in survey_results:
-        buffer = StringIO.StringIO(b"")
-        writer = csv.writer(buffer, delimiter=";")
-        writer.writerow(headers)
-        for evaluation in survey_result["evaluations"]:
-            writer.writerow(
-                [
-                    survey_result["survey_name"],
-                    survey_result["subject_name"],
-                    survey_result["subject_dob"],
-                    evaluation["page"],
-                    evaluation["target"],
-                    evaluation["color"],
-                    evaluation["correct"],
-                ]
-            )
-        writer.writerow([
-            survey_result["survey_name"],
-            survey_result["subject_name"],
-            survey_result["subject_dob"],
-            survey_result["total_pages"],
-            "Total",
-            "",
-            "{} ({}%)".format(survey_result["total_correct"], survey_result["percentage_correct"])
-        ])
-        csv_files.append(buffer.getvalue())
-        buffer.close()
-
-    return csv_files
-
-def collect_csv_data(survey, survey_data):
+    attachments = result_attachments(survey_results, 'combined' if merged else 'separate')
+    return [''.join(chunks) for _, _, chunks in attachments]
+
+def stored_survey_results(survey, subject_ids):
     """
-    Reads the survey session results and extracts/aggregates the data needed for the CSV files that are to be sent by email. There should be exactly one line in the CSV file for every page in the survey.
+    Return the evaluation summaries of stored subjects, for the CSV files that are sent by email. There is exactly one line in the CSV file for every page in the survey.
 
-    >>> import coloringbook as cb, flask, datetime, coloringbook.testing
-    >>> import coloringbook.models as m
-    >>> from flask_mail import Mail
-    >>> from HTMLParser import HTMLParser
+    The subjects are scored at once by coloringbook.scoring, which also reads the data of archived surveys, so the emails agree with the score exports.
 
-    >>> app = coloringbook.testing.get_fixture_app()
-    >>> mail = Mail(app)
+    >>> import coloringbook.testing as t
+    >>> from coloringbook.utilities import summarize_subject
+    >>> app = t.get_fixture_app()
+    >>> with app.app_context():
+    ...     survey = t.generate_survey_data(subjects=3, pages=4)
+    ...     subjects = sorted(survey.subjects, key=lambda subject: subject.id)
+    ...     pages = get_survey_pages(survey)
+    ...     expected = [
+    ...         summarize_subject(
+    ...             survey,
+    ...             {"name": subject.name, "birth": subject.birth.strftime('%Y-%m-%d')},
+    ...             pages,
+    ...             [sorted(
+    ...                 subject.fills.filter_by(survey=survey, page=page).all() +
+    ...                 subject.actions.filter_by(survey=survey, page=page).all(),
+    ...                 key=lambda action: action.time,
+    ...             ) for page in pages],
+    ...         )
+    ...         for subject in subjects
+    ...     ]
+    ...     results = stored_survey_results(survey, [subject.id for subject in subjects])
+    >>> results == expected
+    True
+    >>> results[0]['subject_dob'], results[0]['total_pages']
+    ('2000-01-01', 4)
+    """
+    return score_survey(survey, subject_ids).results()
 
-    >>> testwelcome = m.WelcomeText(name='a', content='a')
-    >>> testprivacy = m.PrivacyText(name='a', content='a')
-    >>> testsuccess = m.SuccessText(name='a', content='a')
-    >>> testinstruction = m.InstructionText(name='a', content='a')
-    >>> teststartform = m.StartingForm(name='a', name_label='a', birth_label='a', eyesight_label='a', language_label='a')
-    >>> testendform = m.EndingForm(name='a', introduction='a', difficulty_label='a', topic_label='a', comments_label='a')
-    >>> testbuttonset = m.ButtonSet(name='a', post_instruction_button='a', post_page_button='a', post_survey_button='a', page_back_button='a')
-    >>> testsurvey = cb.models.Survey(name='test', simultaneous=False, welcome_text=testwelcome, privacy_text=testprivacy, success_text=testsuccess, instruction_text=testinstruction, starting_form=teststartform, ending_form=testendform, button_set=testbuttonset)
-
-    >>> testdrawing = cb.models.Drawing(name='picture')
-    >>> testarealeft = cb.models.Area(name='left door')
-    >>> testarearight = cb.models.Area(name='right door')
-    >>> testdrawing.areas.append(testarealeft)
-    >>> testdrawing.areas.append(testarearight)
-    >>> testpage = cb.models.Page(name='testpage', language_id=1, text='test', drawing=testdrawing)
-    >>> testsurveypage = cb.models.SurveyPage(survey=testsurvey, page=testpage, ordering=1)
-
-    >>> survey_data = [
-    ...     {
-    ...         "subject": {
-    ...             "name": "Bob",
-    ...             "birth": "2000-01-01",
-    ...             "languages": [["German", 10], ["Swahili", 1]],
-    ...             "numeral": "",
-    ...             "eyesight": ""
-    ...         },
-    ...         "results": [[
-    ...             {
-    ...                 "action": "fill",
-    ...                 "color": "#000",
-    ...                 "target": "left door",
-    ...                 "time": 1000
-    ...             },
-    ...             {
-    ...                 "action": "fill",
-    ...                 "color": "#fff",
-    ...                 "target": "right door",
-    ...                 "time": 2000
-    ...             }
-    ...         ]]
-    ...     }
-    ... ]
+def notify_subjects_stored(survey, subject_ids):
+    """
+    Schedule the notification email about newly stored subjects.
 
-    >>> with app.app_context():
-    ...     s = cb.models.db.session
-    ...     s.add(testsurveypage)
-    ...     s.add(cb.models.Color(code='#000', name='black'))
-    ...     s.add(cb.models.Color(code='#fff', name='white'))
-    ...     s.flush()
-    ...     csv_data = collect_csv_data(testsurvey, survey_data)
-
-    >>> csv_data[0]['survey_name']
-    'test'
-
-    >>> csv_data[0]['evaluations'][0]['correct']
-    0
-    >>> csv_data[0]['evaluations'][0]['page']
-    'testpage'
-    >>> csv_data[0]['evaluations'][0]['target']
-    'left door, right door'
-    >>> csv_data[0]['evaluations'][0]['color']
-    u'black, white'
+    Only the IDs are passed to the worker, which composes and sends the email, so the response to the submitting client does not have to wait for it. If the survey is in digest mode, the IDs are added to the digest buffer instead, see send_email_digests. If the broker is not available, the email is composed right away and left in the outbox, see coloringbook.mail.outbox.
+    """
+    if not is_broker_available():
+        # Compose the email here, so that it waits in the outbox.
+        current_app.logger.warning('Broker not available. Composing the email in the request...')
+        compose_email(survey.id, subject_ids)
+    elif survey.email_digest:
+        buffer_digest(survey.id, subject_ids)
+    else:
+        compose_email.delay(survey.id, subject_ids)
+
+@shared_task(ignore_result=True)
+def compose_email(survey_id, subject_ids, merged=False):
     """
-    batch_results = []
-    # Every datum corresponds to a subject.
-    for datum in survey_data:
-        subject = subject_from_json(datum["subject"])
-        pages = get_survey_pages(survey)
-
-        # Every subject has a list of results, one for each page.
-        results = datum["results"]
-        evaluations = []
-        for page, result in zip(pages, results):
-            actions = actions_from_json(survey, page, subject, result)
-            evaluations.append(evaluate_page_actions(actions, page))
-
-        # The amount of evaluations is equal to the amount of pages in the survey.
-        total_pages = len(pages)
-        total_correct_evaluations = sum([evaluation["correct"] for evaluation in evaluations])
-        # In Python 2, division of integers returns an integer, so we need to cast the total_pages to a float.
-        percentage_correct_unrounded = (total_correct_evaluations / float(total_pages) * 100) if total_pages > 0 else 0
-        percentage_correct_rounded = int(round(percentage_correct_unrounded))
-
-        batch_results.append(
-            {
-                "survey_name": survey.name,
-                "subject_name": datum["subject"]["name"],
-                "subject_dob": datum["subject"]["birth"],
-                "evaluations": evaluations,
-                "total_pages": total_pages,
-                "total_correct": total_correct_evaluations,
-                "percentage_correct": percentage_correct_rounded,
-            }
-        )
-    return batch_results
+    Compose and send the email about the subjects with `subject_ids`.
+    """
+    survey = Survey.query.get(survey_id)
+    if survey is None or not survey.email_address:
+        return
+    send_email(stored_survey_results(survey, subject_ids), survey, merged=merged)
+
+def buffer_digest(survey_id, subject_ids):
+    """
+    Add the subjects with `subject_ids` to the digest buffer of a survey.
+
+    The buffer is a Redis list per survey, next to a set of the surveys with a non-empty buffer. Both are updated in a single transaction.
+    """
+    if not subject_ids:
+        return
+    pipeline = broker_client().pipeline()
+    pipeline.rpush(DIGEST_KEY.format(survey_id), *subject_ids)
+    pipeline.sadd(DIGEST_SURVEYS_KEY, survey_id)
+    pipeline.execute()
+
+def read_digest(survey_id):
+    """
+    Return the subject IDs in the digest buffer of a survey, without removing them.
+    """
+    subject_ids = broker_client().lrange(DIGEST_KEY.format(survey_id), 0, -1)
+    return [int(subject_id) for subject_id in subject_ids]
+
+def trim_digest(survey_id, count):
+    """
+    Remove the first `count` subject IDs from the digest buffer of a survey.
+
+    Subjects that were buffered after read_digest stay in the buffer. The survey is only removed from the set of surveys with buffered subjects if its buffer is empty; if buffer_digest adds subjects meanwhile, the transaction is repeated.
+    """
+    key = DIGEST_KEY.format(survey_id)
+
+    def trim(pipeline):
+        remaining = pipeline.llen(key) - count
+        pipeline.multi()
+        pipeline.ltrim(key, count, -1)
+        if remaining <= 0:
+            pipeline.srem(DIGEST_SURVEYS_KEY, survey_id)
+
+    broker_client().transaction(trim, key)
+
+@shared_task(ignore_result=True)
+def send_email_digests():
+    """
+    Send one email with a single, merged CSV file for every survey with buffered subjects.
+
+    Celery beat runs this task every EMAIL_DIGEST_WINDOW seconds. The subjects are only removed from the buffer after their email has been recorded in the outbox, so if composing the email fails, they are included in the next digest.
+    """
+    for survey_id in broker_client().smembers(DIGEST_SURVEYS_KEY):
+        survey_id = int(survey_id)
+        subject_ids = read_digest(survey_id)
+        if subject_ids:
+            try:
+                compose_email(survey_id, subject_ids, merged=True)
+            except Exception:
+                current_app.logger.exception(
+                    'Could not compose the digest of survey %d; trying again later.', survey_id)
+                continue
+        trim_digest(survey_id, len(subject_ids))
 
 def is_broker_available():
     """
     Checks whether the Redis broker is available.
+
+    The outcome is cached and protected by a circuit breaker, see coloringbook.broker, so this is cheap also when the broker is down.
     """
-    try:
-        redis_client = redis.StrictRedis.from_url('redis://redis:6379/0')
-        redis_client.ping()
-        return True
-    except redis.exceptions.ConnectionError:
-        return False
+    return broker_health().available()
 
-def send_email(survey_data, survey, immediate=False):
+def send_email(survey_results, survey, immediate=False, merged=False):
     """
     Send an email with a summary of the survey data to the email address(es) attached to a survey.
 
-    :param survey_data: The survey data to send.
+    :param survey_results: The evaluation summaries of the subjects, as returned by stored_survey_results.
     :param survey: The survey that the data belongs to.
     :param immediate: If False (default), send the asynchronously via Celery. If True, send the email immediately (for testing purposes).
+    :param merged: If True, attach a single CSV file with the results of all subjects instead of one per subject, unless the survey is set to attach a ZIP archive.
 
-    >>> import coloringbook as cb, flask, datetime, coloringbook.testing
-    >>> import coloringbook.models as m
+    >>> import coloringbook.testing as t
     >>> from flask_mail import Mail
     >>> from HTMLParser import HTMLParser
 
-    >>> app = coloringbook.testing.get_fixture_app()
+    >>> app = t.get_fixture_app()
     >>> mail = Mail(app)
 
-    >>> testwelcome = m.WelcomeText(name='a', content='a')
-    >>> testprivacy = m.PrivacyText(name='a', content='a')
-    >>> testsuccess = m.SuccessText(name='a', content='a')
-    >>> testinstruction = m.InstructionText(name='a', content='a')
-    >>> teststartform = m.StartingForm(name='a', name_label='a', birth_label='a', eyesight_label='a', language_label='a')
-    >>> testendform = m.EndingForm(name='a', introduction='a', difficulty_label='a', topic_label='a', comments_label='a')
-    >>> testbuttonset = m.ButtonSet(name='a', post_instruction_button='a', post_page_button='a', post_survey_button='a', page_back_button='a')
-    >>> testsurvey = cb.models.Survey(name='test', simultaneous=False, welcome_text=testwelcome, privacy_text=testprivacy, success_text=testsuccess, instruction_text=testinstruction, starting_form=teststartform, ending_form=testendform, button_set=testbuttonset, email_address='test.recipient@colbook.com; test.recipient2@colbook.com')
-
-    >>> testdrawing = cb.models.Drawing(name='picture')
-    >>> testarealeft = cb.models.Area(name='left door')
-    >>> testarearight = cb.models.Area(name='right door')
-    >>> testdrawing.areas.append(testarealeft)
-    >>> testdrawing.areas.append(testarearight)
-    >>> testpage = cb.models.Page(name='testpage', language_id=1, text='test', drawing=testdrawing)
-    >>> testsurveypage = cb.models.SurveyPage(survey=testsurvey, page=testpage, ordering=1)
-
-    >>> survey_data = [
-    ...     {
-    ...         "subject": {
-    ...             "name": "Bob",
-    ...             "birth": "2000-01-01",
-    ...             "languages": [["German", 10], ["Swahili", 1]],
-    ...             "numeral": "",
-    ...             "eyesight": ""
-    ...         },
-    ...         "results": [[
-    ...             {
-    ...                 "action": "fill",
-    ...                 "color": "#000",
-    ...                 "target": "left door",
-    ...                 "time": 1000
-    ...             },
-    ...             {
-    ...                 "action": "fill",
-    ...                 "color": "#fff",
-    ...                 "target": "left door",
-    ...                 "time": 2000
-    ...             }
-    ...         ]]
-    ...     }
-    ... ]
-
     >>> with app.app_context(), mail.record_messages() as outbox:
-    ...     s = cb.models.db.session
-    ...     s.add(testsurveypage)
-    ...     s.add(cb.models.Color(code='#000', name='black'))
-    ...     s.add(cb.models.Color(code='#fff', name='white'))
-    ...     s.flush()
+    ...     survey = t.generate_survey_data(subjects=1, pages=2)
+    ...     survey.email_address = 'test.recipient@colbook.com; test.recipient2@colbook.com'
     ...     send_email(
-    ...         survey_data=survey_data,
-    ...         survey=testsurvey,
+    ...         survey_results=stored_survey_results(survey, [survey.subjects[0].id]),
+    ...         survey=survey,
     ...         immediate=True,
     ...     )
     ...     outbox_length = len(outbox)
@@ -323,7 +328,7 @@ def send_email(survey_data, survey, immediate=False):
     u'Hallo,'
 
     >>> parser.data[4]
-    u'De vragenlijst test is ingevuld door 1 deelnemer(s).'
+    u'De vragenlijst survey0 is ingevuld door 1 deelnemer(s).'
     """
 
     recipients = [address.strip() for address in survey.email_address.split(";")]
@@ -332,42 +337,60 @@ def send_email(survey_data, survey, immediate=False):
 
     message_subject = "ColoringBook - nieuwe resultaten opgeslagen"
 
-    csv_data = collect_csv_data(survey, survey_data)
-
-    template_context = {"survey_name": survey.name, "number_of_participants": len(survey_data)}
+    template_context = {"survey_name": survey.name, "number_of_participants": len(survey_results)}
     html_body = render_template("email/email.html", context=template_context)
 
-    csv_files = create_survey_results_csv(csv_data)
-
-    for recipient in recipients:
-        # Only for testing purposes.
-        if immediate is True:
-            send_async_email(message_subject, recipient, html_body, csv_files)
+    attachment_format = survey.email_attachments or 'separate'
+    if merged and attachment_format == 'separate':
+        attachment_format = 'combined'
+    attachments = result_attachments(survey_results, attachment_format)
+
+    # Only for testing purposes.
+    if immediate is True:
+        attachments = [
+            (filename, content_type, ''.join(chunks))
+            for filename, content_type, chunks in attachments
+        ]
+        deliver(message_subject, recipients, html_body, attachments)
+        return
 
-        if is_broker_available():
-            send_async_email.delay(message_subject, recipient, html_body, csv_files)
-        else:
-            current_app.logger.warning('Broker not available. Skipping sending emails...')
-            return
+    # Record the emails first, so that they are sent eventually, also if
+    # the broker or the mail server is down now. The attachments are
+    # written to the attachment store while they are generated.
+    message_ids = enqueue(survey, recipients, message_subject, html_body, attachments)
+    if is_broker_available():
+        deliver_outbox.delay(message_ids)
+    else:
+        current_app.logger.warning('Broker not available. The outbox sweeper will send the emails later.')
 
 
-@shared_task(bind=True, max_retries=3)
-def send_async_email(self, subject, recipient, html, attachments):
-    message = Message(subject=subject, recipients=[recipient], html=html)
+def deliver(subject, recipients, html, attachments):
+    """
+    Send the same email to all `recipients` over a single SMTP connection.
 
-    for index, attachment in enumerate(attachments):
-        attachment_file_name = "{}_{}_{}.csv".format(
-            dt.datetime.now().strftime("%y%m%d%H%M"), 'survey_results', index
-        )
+    Returns the recipients for which sending failed, and the last error.
+    """
+    sent = []
+    error = None
+    try:
+        with mail_client.connect() as connection:
+            for recipient in recipients:
+                try:
+                    connection.send(build_message(subject, recipient, html, attachments))
+                    sent.append(recipient)
+                except Exception as exception:
+                    error = exception
+    except Exception as exception:
+        # Connecting or closing failed.
+        error = exception
+    failed = [recipient for recipient in recipients if recipient not in sent]
+    return failed, error
 
-        message.attach(
-            filename=attachment_file_name,
-            content_type="text/csv",
-            data=attachment,
-            disposition="attachment"
-        )
 
+# Kept for tasks that were queued by earlier versions.
+@shared_task(bind=True, max_retries=3)
+def send_async_email(self, subject, recipient, html, attachments):
     try:
-        mail_client.send(message)
+        mail_client.send(build_message(subject, recipient, html, attachments))
     except Exception as exception:
         raise self.retry(exc=exception)
@@ -9,13 +9,24 @@
     database structure.
 """
 
+import datetime as dt
+
 import flask.ext.sqlalchemy as fsqla
+from sqlalchemy.dialects import mysql
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.declarative import declared_attr
 
+from .replica import RoutingSession
+
 
 PAGE_NAME_CHAR_LIMIT = 100  # maximum length of a Page name
 SURVEY_NAME_CHAR_LIMIT = 100 # maximum length of a Survey name
+# How the results are attached to notification emails.
+EMAIL_ATTACHMENT_FORMATS = [
+    ('separate', 'One CSV file per subject'),
+    ('combined', 'One CSV file for all subjects'),
+    ('zip', 'One ZIP archive with a CSV file per subject'),
+]
 
 def TableArgsMeta(parent_class, table_args):
     """
@@ -56,7 +67,7 @@ def TableArgsMeta(parent_class, table_args):
 
 
 class InnoDBSQLAlchemy(fsqla.SQLAlchemy):
-    """ Subclass in order to enable TableArgsMeta. """
+    """ Subclass in order to enable TableArgsMeta and RoutingSession. """
     def make_declarative_base(self, metadata=None):
         """Creates the declarative base."""
         base = fsqla.declarative_base(
@@ -69,8 +80,18 @@ class InnoDBSQLAlchemy(fsqla.SQLAlchemy):
         base.query = fsqla._QueryProperty(self)
         return base
 
+    def create_session(self, options):
+        """Creates a session that can read from a replica."""
+        return RoutingSession(self, **options)
+
 db = InnoDBSQLAlchemy()  # actual database connection is done in __init__.py
 
+# Compact key types on MySQL for the columns that every Fill row repeats.
+# Foreign keys must have exactly the same type as the key they refer to.
+FillId = db.Integer().with_variant(mysql.INTEGER(unsigned=True), 'mysql')
+AreaId = db.Integer().with_variant(mysql.MEDIUMINT(unsigned=True), 'mysql')
+ColorId = db.Integer().with_variant(mysql.SMALLINT(unsigned=True), 'mysql')
+
 
 class Subject(db.Model):
     """ Personal information of a test person. """
@@ -80,6 +101,9 @@ class Subject(db.Model):
     numeral = db.Column(db.Integer)  # such as student ID
     birth = db.Column(db.DateTime, nullable=False)
     eyesight = db.Column(db.String(100))  # medical conditions
+    # Time (UTC) at which the subject was inserted; NULL for subjects
+    # stored before this column existed.
+    created = db.Column(db.DateTime, default=dt.datetime.utcnow)
 
     languages = association_proxy('subject_languages', 'language')  # many-many
     surveys = association_proxy('subject_surveys', 'survey')  # many-many
@@ -152,7 +176,7 @@ class Area(db.Model):
         db.UniqueConstraint('name', 'drawing_id'),
     )
 
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(AreaId, primary_key=True)
     name = db.Column(db.String(40), nullable=False)
                                         # id of the <path> element in the SVG
     drawing_id = db.Column(
@@ -211,7 +235,7 @@ class Page(db.Model):
 class Color(db.Model):
     """ Color that may be associated with a Fill or Expectation. """
 
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(ColorId, primary_key=True)
     code = db.Column(db.String(25), nullable=False)
                                         # RGB code as used at the client side
     name = db.Column(db.String(20), nullable=False)  # mnemonic
@@ -229,12 +253,12 @@ class Expectation(db.Model):
         primary_key=True,
         nullable=False )
     area_id = db.Column(
-        db.Integer,
+        AreaId,
         db.ForeignKey('area.id'),
         primary_key=True,
         nullable=False )
     color_id = db.Column(
-        db.Integer,
+        ColorId,
         db.ForeignKey('color.id'),
         nullable=False )
     here = db.Column(db.Boolean, nullable=False)
@@ -343,6 +367,8 @@ class Survey(db.Model):
     simultaneous = db.Column(db.Boolean, nullable=False)
     information = db.Column(db.Text)
     email_address = db.Column(db.String(60))
+    email_digest = db.Column(db.Boolean, nullable=False, default=False)
+    email_attachments = db.Column(db.String(10), nullable=False, default='separate')
     language = db.relationship('Language', backref='surveys')  # many-one
     pages = association_proxy('survey_pages', 'page')  # many-many
     subjects = association_proxy('survey_subjects', 'subject')  # many-many
@@ -440,6 +466,20 @@ class SurveyPage(db.Model):
 class Action(db.Model):
     """ General container for actions without additional data. """
 
+    __table_args__ = (
+        # Actions of one subject in a survey, by page, in chronological
+        # order; the primary key groups by page first.
+        db.Index(
+            'ix_action_survey_subject_page',
+            'survey_id',
+            'subject_id',
+            'page_id',
+            'time',
+        ),
+        # Filtering by subject and incremental exports.
+        db.Index('ix_action_subject', 'subject_id'),
+    )
+
     survey_id = db.Column(
         db.Integer,
         db.ForeignKey('survey.id'),
@@ -483,33 +523,59 @@ class Action(db.Model):
 class Fill(db.Model):
     """ The Color a Subject filled an Area of a Page in a Survey with at #ms."""
 
+    __table_args__ = (
+        # The old primary key, in a different column order. It still
+        # guarantees that the same click is never stored twice.
+        db.Index(
+            'uq_fill_click',
+            'survey_id',
+            'subject_id',
+            'page_id',
+            'time',
+            'area_id',
+            unique=True,
+        ),
+        # Fills of one subject in a survey, by page, in chronological
+        # order. It covers the per-subject reads of the scores, the
+        # timelines and the exports, so they do not have to visit the
+        # rows through the primary key.
+        db.Index(
+            'ix_fill_survey_subject_page',
+            'survey_id',
+            'subject_id',
+            'page_id',
+            'time',
+            'color_id',
+            'area_id',
+        ),
+        # Filtering by subject and incremental exports.
+        db.Index('ix_fill_subject', 'subject_id'),
+    )
+
+    # Surrogate key. InnoDB appends the primary key to every secondary
+    # index entry, so a single narrow column keeps those indexes small.
+    id = db.Column(FillId, primary_key=True)
     survey_id = db.Column(
         db.Integer,
         db.ForeignKey('survey.id'),
-        primary_key=True,
         nullable=False )
     page_id = db.Column(
         db.Integer,
         db.ForeignKey('page.id'),
-        primary_key=True,
         nullable=False )
     area_id = db.Column(
-        db.Integer,
+        AreaId,
         db.ForeignKey('area.id'),
-        primary_key=True,
         nullable=False )
     subject_id = db.Column(
         db.Integer,
         db.ForeignKey('subject.id'),
-        primary_key=True,
         nullable=False )
     time = db.Column(  # msecs from page start
         db.Integer,
-        primary_key=True,
-        autoincrement=False,
         nullable=False )
     color_id = db.Column(
-        db.Integer,
+        ColorId,
         db.ForeignKey('color.id'),
         nullable=False )
 
@@ -535,3 +601,115 @@ class Fill(db.Model):
             self.page,
             self.survey,
             self.time)
+
+
+class ActionLog(db.Model):
+    """
+        All actions of a Subject on a Page in a Survey, packed in one row.
+
+        This duplicates the Fill and Action rows of the page in a form
+        that can be read back without sorting; see the actionlog module
+        for the encoding.
+    """
+
+    survey_id = db.Column(
+        db.Integer,
+        db.ForeignKey('survey.id'),
+        primary_key=True,
+        nullable=False )
+    subject_id = db.Column(
+        db.Integer,
+        db.ForeignKey('subject.id'),
+        primary_key=True,
+        nullable=False )
+    page_id = db.Column(
+        db.Integer,
+        db.ForeignKey('page.id'),
+        primary_key=True,
+        nullable=False )
+    actions = db.Column(
+        db.Text().with_variant(mysql.MEDIUMTEXT(), 'mysql'),
+        nullable=False )
+
+    survey = db.relationship(  # many-one
+        'Survey',
+        backref=db.backref('action_logs', lazy='dynamic') )
+    page = db.relationship(  # many-one
+        'Page',
+        backref=db.backref('action_logs', lazy='dynamic') )
+    subject = db.relationship(  # many-one
+        'Subject',
+        backref=db.backref('action_logs', lazy='dynamic') )
+
+
+class FillArchive(db.Model):
+    """
+        Fill of a closed Survey, moved out of the fill table.
+
+        The columns are the same as those of Fill, in the same order, so
+        that the two tables can be combined with UNION. There are no
+        foreign keys, to keep the indexes of the archive to a minimum.
+    """
+
+    __tablename__ = 'fill_archive'
+    __table_args__ = (
+        db.Index('ix_fill_archive_survey_subject', 'survey_id', 'subject_id'),
+        {'mysql_row_format': 'COMPRESSED'},
+    )
+
+    id = db.Column(FillId, primary_key=True, autoincrement=False)
+    survey_id = db.Column(db.Integer, nullable=False)
+    page_id = db.Column(db.Integer, nullable=False)
+    area_id = db.Column(AreaId, nullable=False)
+    subject_id = db.Column(db.Integer, nullable=False)
+    time = db.Column(db.Integer, nullable=False)
+    color_id = db.Column(ColorId, nullable=False)
+
+
+class ActionArchive(db.Model):
+    """ Action of a closed Survey, moved out of the action table. """
+
+    __tablename__ = 'action_archive'
+    __table_args__ = (
+        db.Index('ix_action_archive_survey_subject', 'survey_id', 'subject_id'),
+        {'mysql_row_format': 'COMPRESSED'},
+    )
+
+    survey_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    page_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    subject_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    time = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    action = db.Column(db.String(30), nullable=False)
+
+
+class OutboxMessage(db.Model):
+    """
+        Notification email to a single recipient, with its delivery state.
+
+        The body and attachments are kept in the attachment store; see
+        the mail.outbox module for the life cycle of a message.
+    """
+
+    __table_args__ = (
+        db.Index('ix_outbox_message_state_next_attempt', 'state', 'next_attempt'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    survey_id = db.Column(db.Integer, db.ForeignKey('survey.id'))
+    recipient = db.Column(db.String(254), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    html_key = db.Column(db.String(100), nullable=False)
+    attachment_keys = db.Column(db.Text, nullable=False)  # JSON list
+    state = db.Column(db.String(10), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created = db.Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    next_attempt = db.Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    sent = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+    survey = db.relationship(  # many-one
+        'Survey',
+        backref=db.backref('outbox_messages', lazy='dynamic') )
+
+    def __str__(self):
+        return '{} to {}'.format(self.subject, self.recipient)
@@ -0,0 +1,166 @@
+# (c) 2014-2023 Research Software Lab, Centre for Digital Humanities, Utrecht University
+# Licensed under the EUPL-1.2 or later. You may obtain a copy of the license at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12.
+
+"""
+    Configuration and monitoring of the database connection pool.
+
+    MySQL closes connections that have been idle for longer than its
+    wait_timeout. A pooled connection that was closed on the server side
+    causes a "MySQL server has gone away" error on its next use. This
+    module prevents that in three ways:
+
+     - connections are recycled before the server would time them out;
+     - every connection is tested with a cheap SELECT 1 when it is
+       taken from the pool (pre-ping), and silently replaced if the test
+       fails;
+     - connections that were inherited from a parent process, e.g.,
+       when gunicorn forks its workers, are never reused.
+
+    The pool can be tuned with the following configuration settings.
+    They do not apply to the in-memory SQLite test database.
+
+    SQLALCHEMY_POOL_SIZE       number of connections kept open (10)
+    SQLALCHEMY_MAX_OVERFLOW    additional connections under load (10)
+    SQLALCHEMY_POOL_RECYCLE    maximum age of a connection in seconds (1800)
+    SQLALCHEMY_POOL_TIMEOUT    seconds to wait for a free connection (10)
+    SQLALCHEMY_POOL_PRE_PING   whether to test connections on checkout (True)
+
+    The PoolMonitors of the application count pool events, which are
+    shown together with the current pool status on the metrics page of
+    the admin interface.
+
+    >>> import coloringbook.testing as t
+    >>> testapp = t.get_fixture_app()
+    >>> monitor = testapp.extensions['pool_monitors']['primary']
+    >>> with testapp.app_context():
+    ...     db.session.execute('SELECT 1').scalar()
+    ...     db.session.remove()
+    1
+    >>> statistics = monitor.statistics()
+    >>> statistics['checkouts'] >= 1, statistics['pings'] >= 1
+    (True, True)
+"""
+
+import os
+from collections import Counter
+
+from sqlalchemy import event, exc, select
+
+from .models import db
+
+
+POOL_DEFAULTS = {
+    'SQLALCHEMY_POOL_SIZE': 10,
+    'SQLALCHEMY_MAX_OVERFLOW': 10,
+    'SQLALCHEMY_POOL_RECYCLE': 1800,
+    'SQLALCHEMY_POOL_TIMEOUT': 10,
+}
+
+
+def configure_pool(config):
+    """
+        Fill in the pool settings that the configuration leaves out.
+
+        >>> config = {'SQLALCHEMY_POOL_SIZE': 4}
+        >>> configure_pool(config)
+        >>> sorted(config.items())  # doctest: +NORMALIZE_WHITESPACE
+        [('SQLALCHEMY_MAX_OVERFLOW', 10), ('SQLALCHEMY_POOL_RECYCLE', 1800),
+         ('SQLALCHEMY_POOL_SIZE', 4), ('SQLALCHEMY_POOL_TIMEOUT', 10)]
+    """
+    for key, value in POOL_DEFAULTS.items():
+        config.setdefault(key, value)
+
+
+class PoolMonitor(object):
+    """
+        Listens to the pool events of an engine.
+
+        Besides counting the events, the monitor implements the pre-ping
+        and the guard against connections from another process.
+    """
+
+    def __init__(self, engine, pre_ping=True):
+        self.engine = engine
+        self.pre_ping = pre_ping
+        self.counts = Counter()
+        event.listen(engine, 'connect', self.on_connect)
+        event.listen(engine, 'checkout', self.on_checkout)
+        event.listen(engine, 'checkin', self.on_checkin)
+        event.listen(engine, 'invalidate', self.on_invalidate)
+        if pre_ping:
+            event.listen(engine, 'engine_connect', self.on_engine_connect)
+
+    def on_connect(self, dbapi_connection, connection_record):
+        self.counts['connects'] += 1
+        connection_record.info['pid'] = os.getpid()
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.counts['checkouts'] += 1
+        if connection_record.info['pid'] != os.getpid():
+            # Inherited from the parent process. Drop it without closing,
+            # because the parent may still be using the socket.
+            self.counts['forks'] += 1
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                'Connection belongs to process {}, not {}.'.format(
+                    connection_record.info['pid'], os.getpid() ))
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        self.counts['checkins'] += 1
+
+    def on_invalidate(self, dbapi_connection, connection_record, exception):
+        self.counts['invalidations'] += 1
+
+    def on_engine_connect(self, connection, branch):
+        """ Test the connection and reconnect once if it was lost. """
+        if branch:
+            return
+        self.counts['pings'] += 1
+        # The ping must not close a connection that was created for
+        # a single statement.
+        should_close = connection.should_close_with_result
+        connection.should_close_with_result = False
+        try:
+            connection.scalar(select([1]))
+        except exc.DBAPIError as error:
+            if not error.connection_invalidated:
+                raise
+            self.counts['reconnects'] += 1
+            connection.scalar(select([1]))
+        finally:
+            connection.should_close_with_result = should_close
+
+    def statistics(self):
+        """
+            Return a dictionary with the event counts and the pool status.
+
+            Pool status values are None if the pool does not support
+            them. All numbers apply to the current process only.
+        """
+        pool = self.engine.pool
+        result = dict.fromkeys((
+            'connects', 'checkouts', 'checkins', 'invalidations',
+            'pings', 'reconnects', 'forks',
+        ), 0)
+        result.update(self.counts)
+        for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+            method = getattr(pool, name, None)
+            result[name] = method() if method else None
+        result['pool'] = type(pool).__name__
+        result['pid'] = os.getpid()
+        return result
+
+
+def monitor_pool(app, bind=None):
+    """
+        Create the PoolMonitor for a database engine of `app`.
+
+        The monitors are kept in app.extensions['pool_monitors'], by the
+        name of the bind or 'primary' for the main database.
+    """
+    engine = db.get_engine(app, bind)
+    pre_ping = app.config.get('SQLALCHEMY_POOL_PRE_PING', True)
+    monitor = PoolMonitor(engine, pre_ping)
+    app.extensions.setdefault('pool_monitors', {})[bind or 'primary'] = monitor
+    return monitor
@@ -0,0 +1,194 @@
+# (c) 2014-2023 Research Software Lab, Centre for Digital Humanities, Utrecht University
+# Licensed under the EUPL-1.2 or later. You may obtain a copy of the license at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12.
+
+"""
+    In-process cache of the Color and Language reference tables.
+
+    Colors never change through the admin interface and languages rarely
+    do, yet they are looked up for every fill and every subject that is
+    stored. This module keeps a copy of both tables in the memory of
+    each process, so that they can be resolved without a query.
+
+    Cached rows are handed out as instances in the current session
+    (merged without loading), so they can be assigned to relationships
+    like any other instance. A lookup that misses the cache falls back
+    to a query in the current session, so that rows which were added in
+    the current transaction are still found.
+
+    The cache notices changes in three ways:
+
+     - changes made through the ORM in the same process mark it stale,
+       and so does a rollback, which may undo rows that were cached;
+     - at most every CHECK_INTERVAL seconds, the number of rows and the
+       highest ID are compared to those of the cached copy, which
+       reveals rows that other processes have added or removed;
+     - after MAX_AGE seconds the cache is reloaded regardless, which
+       also picks up rows that other processes have renamed.
+
+    Call reload_reference_data to reload the cache explicitly.
+
+    >>> import coloringbook.testing as t
+    >>> testapp = t.get_fixture_app()
+    >>> with testapp.app_context():
+    ...     db.session.add(Color(code='#f00', name='red'))
+    ...     db.session.commit()
+    ...     reload_reference_data()
+    ...     with t.QueryCounter(db.engine) as counter:
+    ...         red = get_color('#f00')
+    ...         get_color('#f00') is red, red in db.session, red.name
+    ...     counter.count
+    (True, True, u'red')
+    0
+"""
+
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.exc import NoResultFound
+
+from .models import db, Color, Language
+from .replica import RoutingSession
+
+
+CHECK_INTERVAL = 10  # seconds between version checks
+MAX_AGE = 600  # seconds after which the cache is reloaded regardless
+
+
+class ReferenceTable(object):
+    """ Cached copy of a reference table, keyed by one of its columns. """
+
+    def __init__(self, model, key):
+        self.model = model
+        self.key = key
+        self.rows = None
+        self.instances = []
+        self.version = None
+        self.loaded = self.checked = 0
+        self.stale = True
+
+    def current_version(self, connection):
+        """ Return the number of rows and the highest ID in the database. """
+        table = self.model.__table__
+        return tuple(connection.execute(db.select([
+            db.func.count(), db.func.max(table.c.id),
+        ])).first())
+
+    def reload(self):
+        """ Replace the cached copy by the current contents of the table. """
+        table = self.model.__table__
+        connection = db.session.connection()
+        version = self.current_version(connection)
+        rows = connection.execute(db.select([table])).fetchall()
+        self.instances = []
+        self.rows = {}
+        for row in rows:
+            instance = self.model(**dict(row))
+            make_transient_to_detached(instance)
+            self.instances.append(instance)
+            self.rows.setdefault(row[self.key], instance)
+        self.version = version
+        self.loaded = self.checked = time.time()
+        self.stale = False
+
+    def refresh(self):
+        """ Reload the copy if it may be out of date. """
+        now = time.time()
+        if self.stale or now - self.loaded > MAX_AGE:
+            self.reload()
+        elif now - self.checked > CHECK_INTERVAL:
+            version = self.current_version(db.session.connection())
+            if version != self.version:
+                self.reload()
+            else:
+                self.checked = now
+
+    def cached(self):
+        """ Return the cached (detached) instances, keyed by self.key. """
+        self.refresh()
+        return self.rows
+
+    def all(self):
+        """ Return all cached (detached) instances. """
+        self.refresh()
+        return self.instances
+
+    def get(self, value):
+        """ Return the row with `value` in the current session, or None. """
+        instance = self.cached().get(value)
+        if instance is None:
+            return self.model.query.filter_by(**{self.key: value}).first()
+        return db.session.merge(instance, load=False)
+
+    def one(self, value):
+        """ Like get, but raise NoResultFound if there is no such row. """
+        instance = self.get(value)
+        if instance is None:
+            raise NoResultFound('No {} with {} {!r}'.format(
+                self.model.__name__, self.key, value ))
+        return instance
+
+
+def reference_tables(app=None):
+    """ Return the reference tables of `app`, by model name. """
+    app = app or current_app
+    return app.extensions.setdefault('reference_data', {
+        'Color': ReferenceTable(Color, 'code'),
+        'Language': ReferenceTable(Language, 'name'),
+    })
+
+
+def reload_reference_data(app=None):
+    """ Reload all reference tables of `app` from the database. """
+    for table in reference_tables(app).values():
+        table.reload()
+
+
+def get_color(code):
+    """ Return the Color with `code`, raise NoResultFound if there is none. """
+    return reference_tables()['Color'].one(code)
+
+
+def get_language(name):
+    """ Return the Language with `name`, or None if there is none. """
+    return reference_tables()['Language'].get(name)
+
+
+def color_names():
+    """
+        Return a dictionary with the name of each color by its ID.
+
+        >>> import coloringbook.testing as t
+        >>> testapp = t.get_fixture_app()
+        >>> with testapp.app_context():
+        ...     db.session.add(Color(id=3, code='#00f', name='blue'))
+        ...     db.session.commit()
+        ...     color_names()
+        {3: u'blue'}
+    """
+    return dict(
+        (color.id, color.name)
+        for color in reference_tables()['Color'].all()
+    )
+
+
+@listens_for(Color, 'after_insert')
+@listens_for(Color, 'after_update')
+@listens_for(Color, 'after_delete')
+@listens_for(Language, 'after_insert')
+@listens_for(Language, 'after_update')
+@listens_for(Language, 'after_delete')
+def mark_stale(mapper, connection, target):
+    """ Make the cache reload a table after it was changed through the ORM. """
+    if has_app_context():
+        reference_tables()[mapper.class_.__name__].stale = True
+
+
+@listens_for(RoutingSession, 'after_rollback')
+def mark_all_stale(session):
+    """ Make the cache reload all tables, since they may contain undone rows. """
+    if has_app_context():
+        for table in reference_tables().values():
+            table.stale = True
@@ -0,0 +1,82 @@
+# (c) 2014-2023 Research Software Lab, Centre for Digital Humanities, Utrecht University
+# Licensed under the EUPL-1.2 or later. You may obtain a copy of the license at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12.
+
+"""
+    Routing of read-only admin queries to a database replica.
+
+    If SQLALCHEMY_BINDS contains a 'replica' entry, views that are
+    decorated with reads_from_replica read from that database instead of
+    the primary one, so that heavy exports do not compete with the
+    storage of survey data. Flushes, commits and bulk updates always go
+    to the primary database. Without a replica, all queries go to the
+    primary database.
+
+    The replica may lag behind the primary a little, so data that were
+    submitted a moment ago may be missing from an export.
+
+    In the following example, the replica is a second in-memory SQLite
+    database which only contains a color named 'replica'.
+
+    >>> import coloringbook
+    >>> from coloringbook.models import db, Color
+    >>> class config:
+    ...     SECRET_KEY = 'abcdefghijklmnopqrstuvwxyz'
+    ...     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    ...     SQLALCHEMY_BINDS = {REPLICA: 'sqlite://'}
+    >>> app = coloringbook.create_app(config, create_db=True, use_test_db=True)
+    >>> with app.app_context():
+    ...     replica = db.get_engine(app, REPLICA)
+    ...     db.Model.metadata.create_all(replica)
+    ...     _ = replica.execute(Color.__table__.insert(), code='#000', name='replica')
+    ...     db.session.add(Color(code='#fff', name='primary'))
+    ...     db.session.commit()
+    >>> @reads_from_replica
+    ... def list_colors():
+    ...     return [color.name for color in Color.query]
+    >>> with app.test_request_context():
+    ...     Color.query.count()
+    ...     list_colors()
+    1
+    [u'replica']
+    >>> with app.test_request_context():
+    ...     [color.name for color in Color.query]
+    [u'primary']
+"""
+
+from functools import wraps
+
+import flask.ext.sqlalchemy as fsqla
+from flask import g, has_app_context
+from sqlalchemy.sql.expression import UpdateBase
+
+
+REPLICA = 'replica'  # key of the replica in SQLALCHEMY_BINDS
+
+
+class RoutingSession(fsqla.SignallingSession):
+    """ Session that sends the queries of reads_from_replica views to the replica. """
+
+    def get_bind(self, mapper=None, clause=None):
+        if (
+                has_app_context() and
+                g.get('read_from_replica') and
+                not self._flushing and
+                not isinstance(clause, UpdateBase) and
+                REPLICA in (self.app.config.get('SQLALCHEMY_BINDS') or {}) ):
+            return fsqla.get_state(self.app).db.get_engine(self.app, REPLICA)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+def reads_from_replica(view):
+    """
+        Decorator that makes the current request read from the replica.
+
+        The setting lasts until the end of the request, so that streamed
+        responses also read from the replica.
+    """
+    @wraps(view)
+    def wrap(*args, **kwargs):
+        g.read_from_replica = True
+        return view(*args, **kwargs)
+    return wrap
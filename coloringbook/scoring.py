@@ -0,0 +1,291 @@
+# (c) 2014-2023 Research Software Lab, Centre for Digital Humanities, Utrecht University
+# Licensed under the EUPL-1.2 or later. You may obtain a copy of the license at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12.
+
+"""
+    Vectorized scoring of survey results.
+
+    The scores are the same as those of utilities.evaluate_page_actions,
+    but instead of walking the ORM objects of every subject, all fills
+    of a survey are loaded as a single integer array and the
+    expectations as a boolean lookup mask, so that the scores of all
+    subjects are computed at once with NumPy operations.
+
+    The engine scores the stored subjects for the notification emails
+    (mail.utilities.stored_survey_results) and for the score totals
+    export. The per-page score export is computed inside the database
+    by utilities.get_page_scores_query, so that it can be streamed;
+    score_survey agrees with it.
+
+    Typical usage:
+
+    >>> import coloringbook.testing as t
+    >>> app = t.get_fixture_app()
+    >>> with app.app_context():
+    ...     survey = t.generate_survey_data(seed=2, subjects=4)
+    ...     scores = score_survey(survey)
+    >>> scores.correct.shape
+    (4, 5)
+    >>> list(scores.totals) == list(scores.correct.sum(axis=1))
+    True
+
+    >>> from coloringbook.utilities import get_page_scores_query
+    >>> with app.app_context():
+    ...     survey = t.generate_survey_data(seed=5)
+    ...     scores = score_survey(survey)
+    ...     sql = get_page_scores_query([survey.id]).all()
+    >>> sql == [
+    ...     (survey.name, subject[0], page.name, int(scores.correct[row, column]))
+    ...     for row, subject in enumerate(scores.subjects)
+    ...     for column, page in enumerate(scores.pages)
+    ... ]
+    True
+"""
+
+import numpy as np
+
+from .models import db, Subject, SurveySubject, Fill, Action, Expectation, Area
+from .utilities import get_survey_pages
+from .archive import include_archive
+from .reference import color_names
+
+
+# Columns of the fill array.
+SUBJECT, PAGE, AREA, COLOR, TIME = range(5)
+
+
+def _lookup(keys, values):
+    """
+        Find the positions of `values` in the array `keys`.
+
+        Returns an array of positions and a boolean array that tells
+        which values occur in `keys` at all.
+
+        >>> _lookup(np.array([30, 10, 20]), np.array([20, 40, 30]))
+        (array([2, 0, 0]), array([ True, False,  True]))
+    """
+    if len(keys) == 0:
+        return (
+            np.zeros(len(values), dtype=np.intp),
+            np.zeros(len(values), dtype=bool),
+        )
+    order = np.argsort(keys, kind='mergesort')
+    positions = np.searchsorted(keys[order], values)
+    positions = np.minimum(positions, len(keys) - 1)
+    indices = order[positions]
+    return indices, keys[indices] == values
+
+
+class SurveyScores(object):
+    """
+        Scores of the subjects of a survey, as computed by score_survey.
+
+        `subjects` is a list of (id, name, birth) tuples and `pages` is
+        the list of pages in survey order. `correct` is a boolean array
+        with a row for each subject and a column for each page.
+    """
+
+    def __init__(self, survey, subjects, pages, correct, touched, fills, hits, names):
+        self.survey = survey
+        self.subjects = subjects
+        self.pages = pages
+        self.correct = correct
+        self._touched = touched
+        self._fills = fills
+        self._hits = hits
+        self._area_names, self._color_names = names
+        # Fills are sorted by subject, page and time; this key allows us
+        # to find the fills of a subject on a page by binary search.
+        self._keys = fills[:, SUBJECT] * len(pages) + fills[:, PAGE]
+
+    @property
+    def totals(self):
+        """ Number of correct pages per subject. """
+        return self.correct.sum(axis=1)
+
+    @property
+    def percentages(self):
+        """ Rounded percentage of correct pages per subject. """
+        if not self.pages:
+            return np.zeros(len(self.subjects), dtype=int)
+        # Round half up, like the round builtin does for positive numbers.
+        fractions = self.totals * 100.0 / len(self.pages)
+        return np.floor(fractions + 0.5).astype(int)
+
+    def evaluations(self, row):
+        """
+            Evaluate the pages of the subject in `row`.
+
+            Returns a list of dictionaries in the same format as
+            utilities.evaluate_page_actions, one for each page.
+        """
+        result = []
+        for column, page in enumerate(self.pages):
+            evaluation = {
+                'page': page.name,
+                'target': '-',
+                'color': '-',
+                'correct': int(self.correct[row, column]),
+            }
+            result.append(evaluation)
+            if not self._touched[row, column]:
+                continue
+            key = row * len(self.pages) + column
+            start = np.searchsorted(self._keys, key, 'left')
+            end = np.searchsorted(self._keys, key, 'right')
+            if evaluation['correct']:
+                # The first fill in an expected area is reported.
+                start += np.argmax(self._hits[start:end])
+                end = start + 1
+            fills = self._fills[start:end]
+            evaluation['target'] = ', '.join(
+                self._area_names[a] for a in fills[:, AREA]
+            )
+            evaluation['color'] = ', '.join(
+                self._color_names[c] for c in fills[:, COLOR]
+            )
+        return result
+
+    def results(self):
+        """
+            Summarize the scores per subject.
+
+            The result is a list of dictionaries in the format of
+            utilities.summarize_subject, as used by the notification
+            emails.
+        """
+        totals = self.totals
+        percentages = self.percentages
+        return [
+            {
+                'survey_name': self.survey.name,
+                'subject_name': name,
+                'subject_dob': birth.strftime('%Y-%m-%d'),
+                'evaluations': self.evaluations(row),
+                'total_pages': len(self.pages),
+                'total_correct': int(totals[row]),
+                'percentage_correct': int(percentages[row]),
+            }
+            for row, (id, name, birth) in enumerate(self.subjects)
+        ]
+
+
+def score_survey(survey, subject_ids=None):
+    """
+        Compute the scores of the subjects of `survey`.
+
+        If `subject_ids` is given, only those subjects are scored.
+        Fills and actions of archived surveys are included. Returns a
+        SurveyScores object. The outcome agrees with
+        evaluate_page_actions, as the following test with random data
+        illustrates.
+
+        >>> import coloringbook.testing as t
+        >>> from coloringbook.utilities import evaluate_page_actions
+        >>> app = t.get_fixture_app()
+        >>> def reference_evaluations(survey, subject):
+        ...     evaluations = []
+        ...     for page in get_survey_pages(survey):
+        ...         actions = sorted(
+        ...             subject.fills.filter_by(survey=survey, page=page).all() +
+        ...             subject.actions.filter_by(survey=survey, page=page).all(),
+        ...             key=lambda action: action.time,
+        ...         )
+        ...         evaluations.append(evaluate_page_actions(actions, page))
+        ...     return evaluations
+        >>> with app.app_context():
+        ...     survey = t.generate_survey_data(seed=3)
+        ...     other = t.generate_survey_data(seed=4)
+        ...     subjects = sorted(survey.subjects, key=lambda s: s.id)
+        ...     expected = [reference_evaluations(survey, s) for s in subjects]
+        ...     scores = score_survey(survey)
+        ...     actual = [scores.evaluations(row) for row in range(len(subjects))]
+        ...     partial = score_survey(survey, [subjects[1].id, subjects[4].id])
+        ...     partial_totals = list(partial.totals)
+        >>> actual == expected
+        True
+        >>> partial_totals == [
+        ...     sum(e['correct'] for e in expected[1]),
+        ...     sum(e['correct'] for e in expected[4]),
+        ... ]
+        True
+    """
+    pages = get_survey_pages(survey)
+    page_ids = np.array([page.id for page in pages], dtype=np.int64)
+
+    subject_query = (
+        db.session.query(Subject.id, Subject.name, Subject.birth)
+        .join(Subject.subject_surveys)
+        .filter(SurveySubject.survey_id == survey.id)
+    )
+    fill_query = (
+        db.session.query(
+            Fill.subject_id,
+            Fill.page_id,
+            Fill.area_id,
+            Fill.color_id,
+            Fill.time )
+        .filter(Fill.survey_id == survey.id)
+    )
+    action_query = (
+        db.session.query(Action.subject_id, Action.page_id)
+        .filter(Action.survey_id == survey.id)
+    )
+    if subject_ids is not None:
+        subject_query = subject_query.filter(Subject.id.in_(subject_ids))
+        fill_query = fill_query.filter(Fill.subject_id.in_(subject_ids))
+        action_query = action_query.filter(Action.subject_id.in_(subject_ids))
+    subjects = subject_query.order_by(Subject.id).all()
+    subject_ids = np.array([s[0] for s in subjects], dtype=np.int64)
+    shape = (len(subjects), len(pages))
+
+    # Replace subject and page IDs by row and column numbers.
+    fill_query = include_archive(fill_query, db.session)
+    action_query = include_archive(action_query, db.session)
+    fills = np.array(fill_query.all(), dtype=np.int64).reshape(-1, 5)
+    fills[:, SUBJECT], known_subject = _lookup(subject_ids, fills[:, SUBJECT])
+    fills[:, PAGE], known_page = _lookup(page_ids, fills[:, PAGE])
+    fills = fills[known_subject & known_page]
+    fills = fills[np.lexsort((fills[:, TIME], fills[:, PAGE], fills[:, SUBJECT]))]
+
+    actions = np.array(action_query.all(), dtype=np.int64).reshape(-1, 2)
+    action_rows, known_subject = _lookup(subject_ids, actions[:, 0])
+    action_columns, known_page = _lookup(page_ids, actions[:, 1])
+    known = known_subject & known_page
+
+    # Lookup mask with a row for each page and a column for each area.
+    expectations = np.array(
+        db.session.query(Expectation.page_id, Expectation.area_id)
+        .filter(Expectation.page_id.in_(page_ids.tolist() or [-1]))
+        .all(),
+        dtype=np.int64,
+    ).reshape(-1, 2)
+    area_ids = np.unique(np.concatenate([fills[:, AREA], expectations[:, 1]]))
+    expected = np.zeros((len(pages), len(area_ids)), dtype=bool)
+    expected[
+        _lookup(page_ids, expectations[:, 0])[0],
+        np.searchsorted(area_ids, expectations[:, 1]),
+    ] = True
+    hits = expected[fills[:, PAGE], np.searchsorted(area_ids, fills[:, AREA])]
+
+    correct = np.zeros(shape, dtype=bool)
+    correct[fills[hits, SUBJECT], fills[hits, PAGE]] = True
+    touched = np.zeros(shape, dtype=bool)
+    touched[fills[:, SUBJECT], fills[:, PAGE]] = True
+    touched[action_rows[known], action_columns[known]] = True
+
+    area_names = dict(
+        db.session.query(Area.id, Area.name)
+        .filter(Area.id.in_(area_ids.tolist() or [-1]))
+        .all()
+    )
+    return SurveyScores(
+        survey,
+        subjects,
+        pages,
+        correct,
+        touched,
+        fills,
+        hits,
+        (area_names, color_names()),
+    )
@@ -0,0 +1,222 @@
+# (c) 2014-2023 Research Software Lab, Centre for Digital Humanities, Utrecht University
+# Licensed under the EUPL-1.2 or later. You may obtain a copy of the license at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12.
+
+"""
+    Queue latency, duration and outcome of Celery tasks.
+
+    Celery signal handlers measure, for every task, how long it waited
+    in the queue, how long it ran and how it ended. The tasks run in
+    separate worker processes and their results are not kept, so the
+    figures are accumulated per task name in Redis, next to the broker
+    queues:
+
+    coloringbook:task-metrics                set of the task names seen
+    coloringbook:task-metrics:NAME           counts and totals of a task
+    coloringbook:task-metrics:NAME:MINUTE    tasks finished in a minute,
+                                             kept for THROUGHPUT_RETENTION
+
+    The queue wait runs from the moment the task is published, which is
+    added to the message headers, to the moment a worker starts it. It
+    includes time spent prefetched by a busy worker, and it assumes that
+    the clocks of the application and the workers are synchronized.
+
+    The figures are shown on the metrics page of the admin interface
+    and by the task-metrics command of manage.py. Recording never stops
+    a task: if Redis cannot be reached, the figures are dropped.
+
+    In the following example, nothing listens on the Redis address.
+
+    >>> import redis
+    >>> metrics = TaskMetrics(redis.StrictRedis.from_url(
+    ...     'redis://127.0.0.1:1/0', socket_connect_timeout=0.5))
+    >>> metrics.record('coloringbook.mail.outbox.deliver_outbox', 'SUCCESS', 0.2, 3.5)
+    >>> metrics.summary()
+    []
+"""
+
+import time
+
+from celery import signals
+from celery.utils.log import get_logger
+from flask import current_app
+from redis.exceptions import RedisError
+
+from .broker import broker_client
+
+
+TASK_NAMES_KEY = 'coloringbook:task-metrics'
+TASK_METRICS_KEY = 'coloringbook:task-metrics:{}'
+THROUGHPUT_KEY = 'coloringbook:task-metrics:{}:{}'
+THROUGHPUT_RETENTION = 24 * 3600  # seconds to keep the counts per minute
+THROUGHPUT_WINDOW = 15  # minutes over which the throughput is averaged
+PUBLISHED_HEADER = 'published_at'
+OUTCOMES = {'SUCCESS': 'succeeded', 'FAILURE': 'failed', 'RETRY': 'retried'}
+
+logger = get_logger(__name__)
+
+# Start time and queue wait of the tasks running in this process.
+started = {}
+
+
+class TaskMetrics(object):
+    """ Records and summarizes task metrics in Redis through `client`. """
+
+    def __init__(self, client):
+        self.client = client
+
+    def execute(self, pipeline):
+        try:
+            return pipeline.execute()
+        except RedisError as error:
+            logger.warning('Could not update the task metrics: %s', error)
+
+    def record(self, name, state, runtime, wait=None):
+        """ Add a finished task, with its final `state`, to the figures. """
+        now = time.time()
+        key = TASK_METRICS_KEY.format(name)
+        throughput_key = THROUGHPUT_KEY.format(name, int(now // 60))
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.sadd(TASK_NAMES_KEY, name)
+        pipeline.hincrby(key, OUTCOMES.get(state, 'other'))
+        pipeline.hincrbyfloat(key, 'runtime', runtime)
+        if wait is not None:
+            pipeline.hincrby(key, 'waited')
+            pipeline.hincrbyfloat(key, 'wait', max(wait, 0))
+        pipeline.hset(key, 'last', now)
+        pipeline.incr(throughput_key)
+        pipeline.expire(throughput_key, THROUGHPUT_RETENTION)
+        self.execute(pipeline)
+
+    def note(self, name, field, text):
+        """ Store `text`, e.g., the last error, in `field` of a task. """
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.hset(TASK_METRICS_KEY.format(name), field, text[:500])
+        self.execute(pipeline)
+
+    def summary(self, window=THROUGHPUT_WINDOW):
+        """ Return the summaries of all tasks, see summarize_task. """
+        try:
+            names = sorted(self.client.smembers(TASK_NAMES_KEY))
+            minute = int(time.time() // 60)
+            pipeline = self.client.pipeline(transaction=False)
+            for name in names:
+                pipeline.hgetall(TASK_METRICS_KEY.format(name))
+                pipeline.mget([
+                    THROUGHPUT_KEY.format(name, minute - offset)
+                    for offset in range(window)
+                ])
+            replies = pipeline.execute()
+        except RedisError as error:
+            logger.warning('Could not read the task metrics: %s', error)
+            return []
+        return [
+            summarize_task(name, fields, sum(int(count or 0) for count in recent), window)
+            for name, fields, recent in zip(names, replies[::2], replies[1::2])
+        ]
+
+    def reset(self):
+        """ Remove all figures. """
+        try:
+            keys = list(self.client.scan_iter(TASK_NAMES_KEY + '*'))
+            if keys:
+                self.client.delete(*keys)
+        except RedisError as error:
+            logger.warning('Could not reset the task metrics: %s', error)
+
+
+def summarize_task(name, fields, recent, window):
+    """
+        Compute averages from the raw `fields` of a task.
+
+        `recent` is the number of tasks that finished in the last
+        `window` minutes.
+
+        >>> summary = summarize_task('send', {
+        ...     'succeeded': '8', 'retried': '2', 'runtime': '5.0',
+        ...     'waited': '10', 'wait': '25.0', 'last_error': 'SMTPError: 421',
+        ... }, 30, 15)
+        >>> [summary[key] for key in (
+        ...     'finished', 'failed', 'mean_wait', 'mean_runtime', 'per_minute')]
+        [10, 0, 2.5, 0.5, 2.0]
+        >>> summary['last_error']
+        'SMTPError: 421'
+        >>> summarize_task('idle', {}, 0, 15)['mean_runtime'] is None
+        True
+    """
+    counts = dict(
+        (outcome, int(fields.get(outcome, 0)))
+        for outcome in ('succeeded', 'failed', 'retried', 'other')
+    )
+    finished = sum(counts.values())
+    waited = int(fields.get('waited', 0))
+    return dict(
+        counts,
+        name=name,
+        finished=finished,
+        mean_runtime=float(fields.get('runtime', 0)) / finished if finished else None,
+        mean_wait=float(fields.get('wait', 0)) / waited if waited else None,
+        per_minute=recent / float(window),
+        last_error=fields.get('last_error'),
+        last_retry=fields.get('last_retry'),
+    )
+
+
+def task_metrics(app=None):
+    """ Return the TaskMetrics of `app`, sharing the broker connection pool. """
+    app = app or current_app
+    metrics = app.extensions.get('task_metrics')
+    if metrics is None:
+        metrics = app.extensions['task_metrics'] = TaskMetrics(broker_client(app))
+    return metrics
+
+
+def published_time(request):
+    """ Return the time at which the task of `request` was published, if known. """
+    value = getattr(request, PUBLISHED_HEADER, None)
+    if value is None:
+        value = (getattr(request, 'headers', None) or {}).get(PUBLISHED_HEADER)
+    return float(value) if value is not None else None
+
+
+def task_recorder(task):
+    # Only the tasks of the application know their Flask application,
+    # see coloringbook.task_worker.
+    app = getattr(task, 'flask_app', None)
+    return app and task_metrics(app)
+
+
+@signals.before_task_publish.connect
+def stamp_published(headers=None, **kwargs):
+    if headers is not None:
+        headers.setdefault(PUBLISHED_HEADER, time.time())
+
+
+@signals.task_prerun.connect
+def start_timer(task_id=None, task=None, **kwargs):
+    now = time.time()
+    published = published_time(task.request)
+    started[task_id] = (now, now - published if published else None)
+
+
+@signals.task_postrun.connect
+def record_task(task_id=None, task=None, state=None, **kwargs):
+    start, wait = started.pop(task_id, (None, None))
+    recorder = task_recorder(task)
+    if start is not None and recorder:
+        recorder.record(task.name, state, time.time() - start, wait)
+
+
+@signals.task_failure.connect
+def note_failure(sender=None, exception=None, **kwargs):
+    recorder = task_recorder(sender)
+    if recorder:
+        recorder.note(sender.name, 'last_error', u'{}: {}'.format(
+            type(exception).__name__, exception))
+
+
+@signals.task_retry.connect
+def note_retry(sender=None, reason=None, **kwargs):
+    recorder = task_recorder(sender)
+    if recorder:
+        recorder.note(sender.name, 'last_retry', u'{}'.format(reason))
@@ -1,18 +1,87 @@
 from celery import Celery, Task
+from datetime import timedelta
+
+from celery.schedules import crontab
+from kombu import Queue
+
+from ..broker import get_broker_url
+from ..mail.utilities import EMAIL_DIGEST_WINDOW
+from ..mail.outbox import SWEEP_INTERVAL
+from .. import task_metrics  # connects the signal handlers
+
+# Named queues, so that each kind of work can get workers of its own
+# (see the worker services in docker-compose.yml). Tasks that are not
+# routed below go to the default queue.
+DEFAULT_QUEUE = "celery"
+MAIL_QUEUE = "mail"  # notification emails; time-sensitive, short tasks
+INGEST_QUEUE = "ingest"  # processing of submitted survey data
+EXPORTS_QUEUE = "exports"  # long-running bulk work on survey data
+MEDIA_QUEUE = "media"  # processing of drawings and sounds
+
+TASK_ROUTES = {
+    "coloringbook.mail.*": {"queue": MAIL_QUEUE},
+    "coloringbook.archive.*": {"queue": EXPORTS_QUEUE},
+    "coloringbook.duplicate.*": {"queue": EXPORTS_QUEUE},
+}
 
 
 def celery_init_app(app):
     class FlaskTask(Task):
+        # Used by the signal handlers of coloringbook.task_metrics.
+        flask_app = app
+
         def __call__(self, *args, **kwargs):
             with app.app_context():
                 return self.run(*args, **kwargs)
 
-    celery_app = Celery(app.name, task_cls=FlaskTask)
+    celery_app = Celery(
+        app.name,
+        task_cls=FlaskTask,
+        include=[
+            "coloringbook.archive",
+            "coloringbook.duplicate",
+            "coloringbook.mail.attachments",
+            "coloringbook.mail.outbox",
+        ],
+    )
+    broker_url = get_broker_url(app.config)
     celery_app.config_from_object(
         {
-            "broker_url": "redis://redis:6379/0",
-            "result_backend": "redis://redis:6379/0",
+            "broker_url": broker_url,
+            "result_backend": broker_url,
             "task_ignore_result": True,
+            "task_queues": [
+                Queue(name) for name in (
+                    DEFAULT_QUEUE, MAIL_QUEUE, INGEST_QUEUE,
+                    EXPORTS_QUEUE, MEDIA_QUEUE,
+                )
+            ],
+            "task_default_queue": DEFAULT_QUEUE,
+            "task_routes": TASK_ROUTES,
+            # Long tasks must not hold back the tasks that were prefetched
+            # behind them. Workers for short tasks raise this with
+            # --prefetch-multiplier.
+            "worker_prefetch_multiplier": app.config.get(
+                "CELERY_PREFETCH_MULTIPLIER", 1),
+            "beat_schedule": {
+                "archive-closed-surveys": {
+                    "task": "coloringbook.archive.archive_closed_surveys",
+                    "schedule": crontab(hour=3, minute=30),
+                },
+                "clean-mail-attachments": {
+                    "task": "coloringbook.mail.attachments.clean_attachments",
+                    "schedule": crontab(hour=4, minute=0),
+                },
+                "sweep-outbox": {
+                    "task": "coloringbook.mail.outbox.sweep_outbox",
+                    "schedule": timedelta(seconds=SWEEP_INTERVAL),
+                },
+                "send-email-digests": {
+                    "task": "coloringbook.mail.utilities.send_email_digests",
+                    "schedule": timedelta(seconds=app.config.get(
+                        "EMAIL_DIGEST_WINDOW", EMAIL_DIGEST_WINDOW)),
+                },
+            },
         }
     )
     celery_app.set_default()
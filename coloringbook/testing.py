@@ -13,7 +13,13 @@
 
 """
 
+import random, re
+from datetime import datetime
+
+from sqlalchemy import event
+
 import coloringbook
+import coloringbook.models as m
 
 
 def get_fixture_app():
@@ -30,3 +36,152 @@ def get_fixture_app():
         # Ensures Flask Mail does not send any real emails.
         TESTING = True
     return coloringbook.create_app(config, create_db=True, use_test_db=True)
+
+
+def generate_survey_data(seed=0, subjects=20, pages=5, areas=4):
+    """
+        Add a survey with random coloring data to the database.
+
+        The data are fully determined by `seed`, which also serves to
+        give the survey and its associated objects unique names, so
+        multiple surveys can be generated in the same database. Some
+        pages are skipped, some contain only a non-fill action and some
+        have no expectations. Must be called inside an application
+        context. Returns the (committed) survey.
+
+        >>> testapp = get_fixture_app()
+        >>> with testapp.app_context():
+        ...     survey = generate_survey_data(subjects=3, pages=2)
+        ...     len(survey.subjects), len(survey.pages)
+        (3, 2)
+    """
+    rng = random.Random(seed)
+    session = m.db.session
+    suffix = str(seed)
+    colors = m.Color.query.all()
+    if not colors:
+        colors = [
+            m.Color(code='#d01', name='red'),
+            m.Color(code='#06e', name='blue'),
+            m.Color(code='#fff', name='white'),
+        ]
+    drawing = m.Drawing(name='drawing' + suffix)
+    for index in range(areas):
+        drawing.areas.append(m.Area(name='area{}'.format(index)))
+    survey = m.Survey(
+        name='survey' + suffix,
+        simultaneous=False,
+        welcome_text=m.WelcomeText(name=suffix, content='a'),
+        privacy_text=m.PrivacyText(name=suffix, content='a'),
+        success_text=m.SuccessText(name=suffix, content='a'),
+        instruction_text=m.InstructionText(name=suffix, content='a'),
+        starting_form=m.StartingForm(name=suffix, name_label='a', birth_label='a', eyesight_label='a', language_label='a'),
+        ending_form=m.EndingForm(name=suffix, introduction='a', difficulty_label='a', topic_label='a', comments_label='a'),
+        button_set=m.ButtonSet(name=suffix, post_instruction_button='a', post_page_button='a', post_survey_button='a', page_back_button='a'),
+    )
+    page_list = []
+    for index in range(pages):
+        page = m.Page(name='page{}_{}'.format(suffix, index), drawing=drawing)
+        for area in rng.sample(drawing.areas, rng.randint(0, 2)):
+            page.expectations.append(m.Expectation(
+                area=area,
+                color=rng.choice(colors),
+                here=rng.random() < 0.8,
+            ))
+        page_list.append(page)
+    orderings = range(pages)
+    rng.shuffle(orderings)
+    for page, ordering in zip(page_list, orderings):
+        m.SurveyPage(survey=survey, page=page, ordering=ordering)
+    for index in range(subjects):
+        subject = m.Subject(
+            name='subject{}_{}'.format(suffix, index),
+            birth=datetime(2000, 1, 1),
+        )
+        m.SurveySubject(survey=survey, subject=subject)
+        for page in page_list:
+            if rng.random() < 0.15:
+                continue  # skipped page
+            times = sorted(rng.sample(range(1, 10000), rng.randint(0, 4)))
+            for time in times:
+                session.add(m.Fill(
+                    survey=survey,
+                    page=page,
+                    area=rng.choice(drawing.areas),
+                    subject=subject,
+                    time=time,
+                    color=rng.choice(colors),
+                ))
+            if not times:
+                session.add(m.Action(
+                    survey=survey,
+                    page=page,
+                    subject=subject,
+                    time=5000,
+                    action='resume',
+                ))
+    session.add(survey)
+    session.commit()
+    return survey
+
+
+def used_indexes(query, covering=False):
+    """
+        Return the names of the indexes that the database uses for `query`.
+
+        If `covering`, only return the indexes that hold all columns
+        that the query needs, so that the table rows are not read.
+        This runs EXPLAIN QUERY PLAN, so it only works with the SQLite
+        test database. Must be called inside an application context.
+
+        >>> testapp = get_fixture_app()
+        >>> with testapp.app_context():
+        ...     used_indexes(m.Area.query.filter_by(drawing_id=1, name='a'))
+        ...     query = m.Fill.query.filter_by(subject_id=1)
+        ...     used_indexes(query), used_indexes(query, covering=True)
+        set([u'sqlite_autoindex_area_1'])
+        (set([u'ix_fill_subject']), set([]))
+    """
+    session = m.db.session
+    # Labels keep equally named columns of different tables apart.
+    compiled = query.with_labels().statement.compile(dialect=session.bind.dialect)
+    parameters = [compiled.params[name] for name in compiled.positiontup]
+    cursor = session.connection().connection.cursor()
+    cursor.execute('EXPLAIN QUERY PLAN ' + unicode(compiled), parameters)
+    plan = ' '.join(row[-1] for row in cursor.fetchall())
+    pattern = r'USING COVERING INDEX (\w+)' if covering else r'USING (?:COVERING )?INDEX (\w+)'
+    return set(re.findall(pattern, plan))
+
+
+class QueryCounter(object):
+    """
+        Context manager that counts the statements sent to `engine`.
+
+        The count includes the SELECT 1 with which the connection pool
+        tests a connection when it is taken from the pool.
+
+        >>> testapp = get_fixture_app()
+        >>> with testapp.app_context():
+        ...     with QueryCounter(m.db.engine) as counter:
+        ...         m.Color.query.all()
+        ...         m.Color.query.all()
+        ...     m.db.session.remove()
+        []
+        []
+        >>> counter.count
+        3
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
@@ -1,19 +1,33 @@
 from datetime import date
 from flask import current_app
+from sqlalchemy.orm import joinedload
 from .models import *
+from .reference import get_color, get_language
 
 
 MAX_AGE_TOLERANCE = 36524  # approx. number of days in 100 years
 
 
-def get_survey_pages(survey):
-    """Returns all pages that are associated with a survey."""
-    return (
+def get_survey_pages(survey, eager=False):
+    """
+    Returns all pages that are associated with a survey.
+
+    If `eager` is True, the drawing, sound and expectations (with their
+    areas) of the pages are loaded in the same query, so that accessing
+    them does not cost a query per page.
+    """
+    query = (
         Page.query.join(*Page.surveys.attr)
         .filter(Survey.id == survey.id)
         .order_by(SurveyPage.ordering)
-        .all()
     )
+    if eager:
+        query = query.options(
+            joinedload(Page.drawing),
+            joinedload(Page.sound),
+            joinedload(Page.expectations).joinedload(Expectation.area),
+        )
+    return query.all()
 
 
 def subject_from_json(data):
@@ -76,7 +90,7 @@ def subject_from_json(data):
     for name, level in data["languages"]:
         if not name:
             raise ValueError("Incomplete language data")
-        language = Language.query.filter_by(name=name).first()
+        language = get_language(name)
         if language == None:
             language = Language(name=name)
         SubjectLanguage(subject=subject, language=language, level=level)
@@ -169,7 +183,6 @@ def actions_from_json(survey, page, subject, data):
     IndexError: list index out of range
     """
 
-    colors = Color.query
     areas = Area.query.filter_by(drawing=page.drawing)
     actions = []
     for actnum, datum in enumerate(data):
@@ -182,7 +195,7 @@ def actions_from_json(survey, page, subject, data):
                         area=areas.filter_by(name=datum["target"]).one(),
                         subject=subject,
                         time=int(datum["time"]),
-                        color=colors.filter_by(code=datum["color"]).one(),
+                        color=get_color(datum["color"]),
                     )
                 )
             else:
@@ -381,3 +394,106 @@ def evaluate_page_actions(actions, page):
         "color": ', '.join(colors),
         "correct": 0,
     }
+
+
+
+def summarize_subject(survey, subject_data, pages, page_actions):
+    """
+    Summarize the evaluation of all pages of a single subject.
+
+    `subject_data` is the "subject" part of the submitted JSON and
+    `page_actions` contains a list of actions for each of the `pages`.
+    The summary only contains plain values, so it can be used after
+    the session has been committed or closed, e.g. for the email that
+    is sent after storing the data.
+
+    >>> summary = summarize_subject(
+    ...     Survey(name='test'), {'name': 'Bob', 'birth': '2000-01-01'},
+    ...     [Page(name='page1', expectations=[]), Page(name='page2')],
+    ...     [[], []],
+    ... )
+    >>> summary['survey_name'], summary['subject_name'], summary['subject_dob']
+    ('test', 'Bob', '2000-01-01')
+    >>> summary['total_pages'], summary['total_correct'], summary['percentage_correct']
+    (2, 0, 0)
+    """
+    evaluations = [
+        evaluate_page_actions(actions, page)
+        for page, actions in zip(pages, page_actions)
+    ]
+    # The amount of evaluations is equal to the amount of pages in the survey.
+    total_pages = len(pages)
+    total_correct_evaluations = sum([evaluation["correct"] for evaluation in evaluations])
+    # In Python 2, division of integers returns an integer, so we need to cast the total_pages to a float.
+    percentage_correct_unrounded = (total_correct_evaluations / float(total_pages) * 100) if total_pages > 0 else 0
+    percentage_correct_rounded = int(round(percentage_correct_unrounded))
+    return {
+        "survey_name": survey.name,
+        "subject_name": subject_data["name"],
+        "subject_dob": subject_data["birth"],
+        "evaluations": evaluations,
+        "total_pages": total_pages,
+        "total_correct": total_correct_evaluations,
+        "percentage_correct": percentage_correct_rounded,
+    }
+
+def get_page_scores_query(survey_ids):
+    """
+    Compute the per-page scores of all subjects of some surveys in SQL.
+
+    The score is the same as the `correct` score of
+    evaluate_page_actions: a page scores 1 if any of the fills of the
+    subject on that page is in an area for which the page has an
+    expectation, and 0 otherwise (including skipped pages). Returns
+    a query of (survey name, subject ID, page name, correct) rows,
+    ordered by survey, subject and page order.
+
+    >>> import coloringbook.testing as t
+    >>> app = t.get_fixture_app()
+    >>> with app.app_context():
+    ...     survey = t.generate_survey_data(seed=1)
+    ...     pages = get_survey_pages(survey)
+    ...     expected = [
+    ...         (survey.name, subject.id, page.name, evaluate_page_actions(
+    ...             subject.fills.filter_by(survey=survey, page=page)
+    ...             .order_by(Fill.time).all(),
+    ...             page,
+    ...         )['correct'])
+    ...         for subject in sorted(survey.subjects, key=lambda s: s.id)
+    ...         for page in pages
+    ...     ]
+    ...     actual = get_page_scores_query([survey.id]).all()
+    >>> len(actual)
+    100
+    >>> actual == expected
+    True
+    """
+    correct_pages = (
+        db.session.query(Fill.survey_id, Fill.page_id, Fill.subject_id)
+        .join(Expectation, db.and_(
+            Expectation.page_id == Fill.page_id,
+            Expectation.area_id == Fill.area_id,
+        ))
+        .filter(Fill.survey_id.in_(survey_ids))
+        .distinct()
+        .subquery('correct_page')
+    )
+    return (
+        db.session.query(
+            Survey.name,
+            SurveySubject.subject_id,
+            Page.name,
+            db.case([(correct_pages.c.page_id != None, 1)], else_=0),
+        )
+        .select_from(SurveySubject)
+        .join(SurveySubject.survey)
+        .join(SurveyPage, SurveyPage.survey_id == SurveySubject.survey_id)
+        .join(SurveyPage.page)
+        .outerjoin(correct_pages, db.and_(
+            correct_pages.c.survey_id == SurveySubject.survey_id,
+            correct_pages.c.subject_id == SurveySubject.subject_id,
+            correct_pages.c.page_id == SurveyPage.page_id,
+        ))
+        .filter(SurveySubject.survey_id.in_(survey_ids))
+        .order_by(Survey.name, SurveySubject.subject_id, SurveyPage.ordering)
+    )
@@ -19,8 +19,9 @@ from flask import Blueprint, render_template, request, json, abort, jsonify, sen
 
 from .models import Survey, SurveySubject, db
 
-from .mail.utilities import send_email
+from .mail.utilities import notify_subjects_stored
 from .utilities import actions_from_json, subject_from_json, get_survey_pages
+from .actionlog import log_actions
 
 
 site = Blueprint('site', __name__)
@@ -47,6 +48,32 @@ def fetch_coloringbook(survey_name):
         the coloring book HTML backbone (if not XHR) or render the
         pages associated with the current survey in JSON format (if
         XHR).
+
+        The JSON manifest takes the same number of queries regardless
+        of the number of pages:
+
+        >>> import coloringbook.testing as t, coloringbook.models as m
+        >>> testapp = t.get_fixture_app()
+        >>> client = testapp.test_client()
+        >>> def manifest_queries(survey):
+        ...     url = '/book/' + survey.name
+        ...     with t.QueryCounter(m.db.engine) as counter:
+        ...         response = client.get(
+        ...             url,
+        ...             headers={'X-Requested-With': 'XMLHttpRequest'},
+        ...         )
+        ...     return len(json.loads(response.data)['pages']), counter.count
+        >>> with testapp.app_context():
+        ...     small = t.generate_survey_data(seed=1, subjects=1, pages=5)
+        ...     large = t.generate_survey_data(seed=2, subjects=1, pages=50)
+        ...     sounds = [m.Sound(name='sound{}'.format(i)) for i in range(3)]
+        ...     for index, page in enumerate(get_survey_pages(large)):
+        ...         page.sound = sounds[index % 3]
+        ...     m.db.session.commit()
+        ...     manifest_queries(small)
+        ...     manifest_queries(large)
+        (5, 2)
+        (50, 2)
     """
     try:
         survey = Survey.query.filter_by(name=survey_name).one()
@@ -55,7 +82,7 @@ def fetch_coloringbook(survey_name):
                 survey.begin and survey.begin > today):
             raise RuntimeError('Survey not available at this time.')
         if request.is_xhr:
-            pages = get_survey_pages(survey)
+            pages = get_survey_pages(survey, eager=True)
             page_list = []
             audio_set = set()
             image_set = set()
@@ -99,16 +126,14 @@ def submit(survey_name):
             )
         )
         return 'Error'
-    if all(map(partial(store_subject_data, survey), data)):
+    subject_ids = map(partial(store_subject_data, survey), data)
+    if all(subject_ids):
         if survey.email_address:
             try:
-                send_email(
-                    survey_data=data,
-                    survey=survey
-                )
+                notify_subjects_stored(survey, subject_ids)
             except Exception as e:
                 current_app.logger.error(
-                    'Email sending failed for survey "{}".\n{}'.format(
+                    'Email scheduling failed for survey "{}".\n{}'.format(
                         survey_name,
                         traceback.format_exc(),
                     )
@@ -119,7 +144,14 @@ def submit(survey_name):
 
 
 def store_subject_data(survey, data):
-    """ Store complete survey data for a single subject. """
+    """
+        Store complete survey data for a single subject.
+
+        Besides the relational Fill and Action rows, the actions of each
+        page are stored as a packed ActionLog in the same transaction.
+
+        Returns the ID of the stored subject on success, None on failure.
+    """
     s = db.session
     try:
         subject = subject_from_json(data['subject'])
@@ -130,14 +162,16 @@ def store_subject_data(survey, data):
         assert len(pages) == len(results)
         for pagenum, (page, result) in enumerate(zip(pages, results)):
             try:
-                s.add_all(actions_from_json(survey, page, subject, result))
+                actions = actions_from_json(survey, page, subject, result)
+                s.add_all(actions)
+                s.add(log_actions(survey, page, subject, actions))
             except:
                 current_app.logger.error(
                     'Next exception thrown on page {}.'.format(pagenum),
                 )
                 raise
         s.commit()
-        return True
+        return subject.id
     except:
         current_app.logger.error(
             'Subject store failed for survey "{}".\n{}Data:\n{}'.format(
@@ -146,7 +180,7 @@ def store_subject_data(survey, data):
                 json.dumps(data),
             )
         )
-        return False
+        return None
 
 
 def bind_survey_subject(survey, subject, evaluation):
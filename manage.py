@@ -29,17 +29,161 @@
 
     Pass the -d flag to enable debugging. Pass the -r flag to automatically
     reload the application when source files are modified.
+
+    Exporting fill data to a columnar Parquet file:
+
+    python manage.py -c CONFIG_FILE export-fills OUTPUT [-s SURVEY]
+
+    Pass the -s flag to limit the export to a single survey.
+
+    Comparing the former and current storage layout of the fill table:
+
+    python manage.py -Ac CONFIG_FILE benchmark-fills [-n SUBJECTS]
+
+    This creates, fills and drops two scratch tables in the database.
+
+    Moving the fills and actions of closed surveys to the archive tables:
+
+    python manage.py -Ac CONFIG_FILE archive-survey [NAME ...] [-b BATCH]
+
+    Without names, all surveys that ended more than ARCHIVE_AFTER_DAYS
+    (default 30) days ago are archived. The Celery beat schedule does the
+    same every night.
+
+    Showing the queue wait, runtime and throughput of the Celery tasks:
+
+    python manage.py -Ac CONFIG_FILE task-metrics [-m MINUTES] [--reset]
+
+    The throughput is averaged over the last MINUTES (default 15). Pass
+    --reset to clear the figures afterwards.
 """
 
-from flask.ext.script import Manager
+from flask.ext.script import Manager, Command, Option
 from flask_migrate import MigrateCommand
 
 from coloringbook import create_app
+from coloringbook.models import db, Survey
+
+
+class ExportFills(Command):
+    """ Write the raw fill data to a Parquet file. """
+
+    option_list = (
+        Option('output', help='path of the Parquet file to write'),
+        Option('-s', '--survey', dest='survey', help='name of a survey'),
+    )
+
+    def run(self, output, survey):
+        from coloringbook.admin.views import FillView
+        from coloringbook.admin.utilities import write_parquet
+        from coloringbook.archive import include_archive
+        view = FillView(db.session)
+        query = view.get_raw_query()
+        if survey:
+            query = query.filter(Survey.name == survey)
+        query = include_archive(query, db.session)
+        with open(output, 'wb') as sink:
+            count = write_parquet(query, view.column_list, sink)
+        print('Wrote {} fills to {}.'.format(count, output))
+
+
+class BenchmarkFills(Command):
+    """ Compare table size and ingest speed of the fill storage layouts. """
+
+    option_list = (
+        Option('-n', '--subjects', dest='subjects', type=int, default=1000,
+               help='number of synthetic subjects to insert'),
+    )
+
+    def run(self, subjects):
+        from coloringbook.benchmark import benchmark_fill_storage
+        results = benchmark_fill_storage(db.engine, subjects)
+        print('{:<10}{:>12}{:>12}{:>12}'.format('layout', 'rows', 'rows/s', 'MiB'))
+        for name, rows, seconds, size in results:
+            print('{:<10}{:>12}{:>12.0f}{:>12}'.format(
+                name,
+                rows,
+                rows / seconds,
+                '{:.1f}'.format(size / 2.0 ** 20) if size else '-',
+            ))
+
+
+class ArchiveSurvey(Command):
+    """ Move the fills and actions of surveys to the archive tables. """
+
+    option_list = (
+        Option('names', nargs='*', help='names of the surveys to archive'),
+        Option('-b', '--batch-size', dest='batch_size', type=int,
+               help='number of subjects to move per transaction'),
+    )
+
+    def run(self, names, batch_size):
+        from flask import current_app
+        from coloringbook import archive
+        if names:
+            surveys = Survey.query.filter(Survey.name.in_(names)).all()
+            missing = set(names) - set(survey.name for survey in surveys)
+            if missing:
+                print('No such survey: {}'.format(', '.join(sorted(missing))))
+                return 1
+        else:
+            days = current_app.config.get(
+                'ARCHIVE_AFTER_DAYS', archive.ARCHIVE_AFTER_DAYS)
+            surveys = archive.closed_surveys(days).all()
+        batch_size = batch_size or current_app.config.get(
+            'ARCHIVE_BATCH_SIZE', archive.ARCHIVE_BATCH_SIZE)
+        for survey in surveys:
+            fills, actions = archive.archive_survey(survey, batch_size)
+            print('Archived {} fills and {} actions of {}.'.format(
+                fills, actions, survey.name))
+
+
+class TaskMetrics(Command):
+    """ Summarize the queue wait, runtime and throughput of Celery tasks. """
+
+    option_list = (
+        Option('-m', '--minutes', dest='minutes', type=int, default=15,
+               help='number of minutes to average the throughput over'),
+        Option('--reset', dest='reset', action='store_true', default=False,
+               help='clear the figures after showing them'),
+    )
+
+    def run(self, minutes, reset):
+        from coloringbook.task_metrics import task_metrics
+        metrics = task_metrics()
+        summary = metrics.summary(minutes)
+        if not summary:
+            print('No task metrics available.')
+        else:
+            print('{:<48}{:>9}{:>8}{:>8}{:>9}{:>9}{:>9}'.format(
+                'task', 'finished', 'failed', 'retried',
+                'wait (s)', 'run (s)', '/min',
+            ))
+        for task in summary:
+            print('{:<48}{:>9}{:>8}{:>8}{:>9}{:>9}{:>9.1f}'.format(
+                task['name'],
+                task['finished'],
+                task['failed'],
+                task['retried'],
+                '-' if task['mean_wait'] is None else '{:.2f}'.format(task['mean_wait']),
+                '-' if task['mean_runtime'] is None else '{:.2f}'.format(task['mean_runtime']),
+                task['per_minute'],
+            ))
+        for task in summary:
+            if task['last_error']:
+                print('Last error of {}: {}'.format(task['name'], task['last_error']))
+        if reset:
+            metrics.reset()
+
 
 manager = Manager(create_app)
 manager.add_option('-c', '--config', dest='config')
 manager.add_option('-A', '--no-admin', dest='disable_admin', default=False, action='store_true')
 manager.add_command('db', MigrateCommand)
+manager.add_command('export-fills', ExportFills())
+manager.add_command('benchmark-fills', BenchmarkFills())
+manager.add_command('archive-survey', ArchiveSurvey())
+manager.add_command('task-metrics', TaskMetrics())
 
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,27 @@
+"""Add email digest mode to survey
+
+Revision ID: 5b8e1f4c7a20
+Revises: a3d9c6e2f510
+Create Date: 2026-10-19 23:12:44.518000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b8e1f4c7a20'
+down_revision = 'a3d9c6e2f510'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('survey', sa.Column(
+        'email_digest',
+        sa.Boolean(),
+        nullable=False,
+        server_default=sa.false(),
+    ))
+
+
+def downgrade():
+    op.drop_column('survey', 'email_digest')
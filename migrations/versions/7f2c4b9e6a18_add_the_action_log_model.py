@@ -0,0 +1,33 @@
+"""Add the action log model
+
+Revision ID: 7f2c4b9e6a18
+Revises: e1b7a0c93d52
+Create Date: 2026-10-19 19:12:44.530000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7f2c4b9e6a18'
+down_revision = 'e1b7a0c93d52'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+def upgrade():
+    op.create_table('action_log',
+        sa.Column('survey_id', sa.Integer(), nullable=False),
+        sa.Column('subject_id', sa.Integer(), nullable=False),
+        sa.Column('page_id', sa.Integer(), nullable=False),
+        sa.Column('actions', mysql.MEDIUMTEXT(), nullable=False),
+        sa.ForeignKeyConstraint(['page_id'], ['page.id']),
+        sa.ForeignKeyConstraint(['subject_id'], ['subject.id']),
+        sa.ForeignKeyConstraint(['survey_id'], ['survey.id']),
+        sa.PrimaryKeyConstraint('survey_id', 'subject_id', 'page_id'),
+        mysql_engine='InnoDB',
+    )
+
+
+def downgrade():
+    op.drop_table('action_log')
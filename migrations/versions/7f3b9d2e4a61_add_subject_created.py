@@ -0,0 +1,22 @@
+"""Add insertion time to subject
+
+Revision ID: 7f3b9d2e4a61
+Revises: e2a7c5b91d48
+Create Date: 2026-10-20 14:05:32.117000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7f3b9d2e4a61'
+down_revision = 'e2a7c5b91d48'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('subject', sa.Column('created', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('subject', 'created')
@@ -0,0 +1,49 @@
+"""Add archive tables for fills and actions of closed surveys
+
+Revision ID: a3d9c6e2f510
+Revises: 7f2c4b9e6a18
+Create Date: 2026-10-19 21:05:17.240000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a3d9c6e2f510'
+down_revision = '7f2c4b9e6a18'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+def upgrade():
+    op.create_table('fill_archive',
+        sa.Column('id', sa.Integer().with_variant(mysql.INTEGER(unsigned=True), 'mysql'), autoincrement=False, nullable=False),
+        sa.Column('survey_id', sa.Integer(), nullable=False),
+        sa.Column('page_id', sa.Integer(), nullable=False),
+        sa.Column('area_id', sa.Integer().with_variant(mysql.MEDIUMINT(unsigned=True), 'mysql'), nullable=False),
+        sa.Column('subject_id', sa.Integer(), nullable=False),
+        sa.Column('time', sa.Integer(), nullable=False),
+        sa.Column('color_id', sa.Integer().with_variant(mysql.SMALLINT(unsigned=True), 'mysql'), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        mysql_engine='InnoDB',
+        mysql_row_format='COMPRESSED',
+    )
+    op.create_index('ix_fill_archive_survey_subject', 'fill_archive', ['survey_id', 'subject_id'], unique=False)
+    op.create_table('action_archive',
+        sa.Column('survey_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('page_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('subject_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('time', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('action', sa.String(length=30), nullable=False),
+        sa.PrimaryKeyConstraint('survey_id', 'page_id', 'subject_id', 'time'),
+        mysql_engine='InnoDB',
+        mysql_row_format='COMPRESSED',
+    )
+    op.create_index('ix_action_archive_survey_subject', 'action_archive', ['survey_id', 'subject_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_action_archive_survey_subject', table_name='action_archive')
+    op.drop_table('action_archive')
+    op.drop_index('ix_fill_archive_survey_subject', table_name='fill_archive')
+    op.drop_table('fill_archive')
@@ -0,0 +1,40 @@
+"""Add outbox of notification emails
+
+Revision ID: c4e7a2d9b361
+Revises: 5b8e1f4c7a20
+Create Date: 2026-10-20 00:41:09.673000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c4e7a2d9b361'
+down_revision = '5b8e1f4c7a20'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('outbox_message',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('survey_id', sa.Integer(), nullable=True),
+        sa.Column('recipient', sa.String(length=254), nullable=False),
+        sa.Column('subject', sa.String(length=200), nullable=False),
+        sa.Column('html_key', sa.String(length=100), nullable=False),
+        sa.Column('attachment_keys', sa.Text(), nullable=False),
+        sa.Column('state', sa.String(length=10), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.Column('next_attempt', sa.DateTime(), nullable=False),
+        sa.Column('sent', sa.DateTime(), nullable=True),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.ForeignKeyConstraint(['survey_id'], ['survey.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        mysql_engine='InnoDB',
+    )
+    op.create_index('ix_outbox_message_state_next_attempt', 'outbox_message', ['state', 'next_attempt'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_outbox_message_state_next_attempt', table_name='outbox_message')
+    op.drop_table('outbox_message')
@@ -0,0 +1,38 @@
+"""Add secondary indexes on fill and action
+
+Revision ID: c5d3e8a1f2b4
+Revises: f94547b88580
+Create Date: 2026-10-19 18:05:12.418000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c5d3e8a1f2b4'
+down_revision = 'f94547b88580'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_fill_survey_subject_page', 'fill',
+                    ['survey_id', 'subject_id', 'page_id', 'time', 'color_id'],
+                    unique=False)
+    op.create_index('ix_fill_subject', 'fill', ['subject_id'], unique=False)
+    op.create_index('ix_action_survey_subject_page', 'action',
+                    ['survey_id', 'subject_id', 'page_id', 'time'],
+                    unique=False)
+    op.create_index('ix_action_subject', 'action', ['subject_id'], unique=False)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'mysql':
+        # MySQL may have dropped its implicit foreign key index on
+        # subject_id in favour of ix_*_subject, and refuses to drop the
+        # last index that backs a foreign key.
+        op.create_index('fk_action_subject', 'action', ['subject_id'], unique=False)
+        op.create_index('fk_fill_subject', 'fill', ['subject_id'], unique=False)
+    op.drop_index('ix_action_subject', table_name='action')
+    op.drop_index('ix_action_survey_subject_page', table_name='action')
+    op.drop_index('ix_fill_subject', table_name='fill')
+    op.drop_index('ix_fill_survey_subject_page', table_name='fill')
@@ -0,0 +1,72 @@
+"""Compact fill storage layout
+
+Revision ID: e1b7a0c93d52
+Revises: c5d3e8a1f2b4
+Create Date: 2026-10-19 18:40:31.206000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e1b7a0c93d52'
+down_revision = 'c5d3e8a1f2b4'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+def narrow_keys(area_type, color_type):
+    """ Change the type of the area and color keys and their references. """
+    for table, column, autoincrement in (
+            ('area', 'id', True),
+            ('expectation', 'area_id', False) ):
+        op.alter_column(table, column,
+                        type_=area_type,
+                        existing_nullable=False,
+                        autoincrement=autoincrement)
+    for table, column, autoincrement in (
+            ('color', 'id', True),
+            ('expectation', 'color_id', False) ):
+        op.alter_column(table, column,
+                        type_=color_type,
+                        existing_nullable=False,
+                        autoincrement=autoincrement)
+
+
+def upgrade():
+    # Foreign keys are only checked again for new changes, so the key
+    # and its references can be changed one after the other.
+    op.execute('SET FOREIGN_KEY_CHECKS = 0')
+    narrow_keys(mysql.MEDIUMINT(unsigned=True), mysql.SMALLINT(unsigned=True))
+    # A single ALTER TABLE, so that the fill table is rebuilt only once.
+    op.execute(
+        'ALTER TABLE fill '
+        'DROP PRIMARY KEY, '
+        'ADD COLUMN id INTEGER UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY FIRST, '
+        'MODIFY area_id MEDIUMINT UNSIGNED NOT NULL, '
+        'MODIFY color_id SMALLINT UNSIGNED NOT NULL, '
+        'DROP INDEX ix_fill_survey_subject_page, '
+        'ADD UNIQUE INDEX uq_fill_click '
+        '(survey_id, subject_id, page_id, time, area_id), '
+        'ADD INDEX ix_fill_survey_subject_page '
+        '(survey_id, subject_id, page_id, time, color_id, area_id)'
+    )
+    op.execute('SET FOREIGN_KEY_CHECKS = 1')
+
+
+def downgrade():
+    op.execute('SET FOREIGN_KEY_CHECKS = 0')
+    op.execute(
+        'ALTER TABLE fill '
+        'DROP PRIMARY KEY, '
+        'DROP COLUMN id, '
+        'ADD PRIMARY KEY (survey_id, page_id, area_id, subject_id, time), '
+        'MODIFY area_id INTEGER NOT NULL, '
+        'MODIFY color_id INTEGER NOT NULL, '
+        'DROP INDEX uq_fill_click, '
+        'DROP INDEX ix_fill_survey_subject_page, '
+        'ADD INDEX ix_fill_survey_subject_page '
+        '(survey_id, subject_id, page_id, time, color_id)'
+    )
+    narrow_keys(sa.Integer(), sa.Integer())
+    op.execute('SET FOREIGN_KEY_CHECKS = 1')
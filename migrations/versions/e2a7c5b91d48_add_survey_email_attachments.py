@@ -0,0 +1,27 @@
+"""Add email attachment format to survey
+
+Revision ID: e2a7c5b91d48
+Revises: c4e7a2d9b361
+Create Date: 2026-10-20 10:41:07.203000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e2a7c5b91d48'
+down_revision = 'c4e7a2d9b361'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('survey', sa.Column(
+        'email_attachments',
+        sa.String(length=10),
+        nullable=False,
+        server_default='separate',
+    ))
+
+
+def downgrade():
+    op.drop_column('survey', 'email_attachments')
@@ -11,7 +11,12 @@
 from doctest import testmod, ELLIPSIS
 import unittest
 
-import coloringbook, coloringbook.testing
+import coloringbook, coloringbook.testing, coloringbook.scoring, coloringbook.benchmark
+import coloringbook.actionlog, coloringbook.archive, coloringbook.pool, coloringbook.replica
+import coloringbook.reference
+import coloringbook.duplicate
+import coloringbook.broker, coloringbook.task_metrics
+import coloringbook.mail.attachments, coloringbook.mail.outbox
 
 def test_all():
     testmod(coloringbook.testing)
@@ -23,6 +28,18 @@ def test_all():
     testmod(coloringbook.admin.forms)
     testmod(coloringbook.admin.views)
     testmod(coloringbook.utilities)
+    testmod(coloringbook.scoring)
+    testmod(coloringbook.benchmark)
+    testmod(coloringbook.actionlog)
+    testmod(coloringbook.archive)
+    testmod(coloringbook.pool)
+    testmod(coloringbook.replica)
+    testmod(coloringbook.reference)
+    testmod(coloringbook.duplicate)
+    testmod(coloringbook.broker)
+    testmod(coloringbook.task_metrics)
+    testmod(coloringbook.mail.attachments)
+    testmod(coloringbook.mail.outbox)
     testmod(coloringbook.mail.utilities)
 
     unittest.main()